@@ -0,0 +1,351 @@
+"""
+Micro-benchmarks for the hot paths of the library, run them with:
+
+    $ python benchmarks.py [name ...]
+
+All network benchmarks run against a local server, no Clickatell account
+or outside network access is needed.
+"""
+import os
+import sys
+import time
+import socket
+import shutil
+import urllib2
+import tempfile
+from array import array
+from StringIO import StringIO
+from datetime import timedelta
+from clickatell import url
+from clickatell.api import Clickatell, AsyncClickatell
+from clickatell.client import Client
+from clickatell.coalesce import Coalescer
+from clickatell.coverage import CoverageCache
+from clickatell.callbacks import CallbackApp, CallbackReceiver, \
+    CallbackServer, MicroBatcher, SQLiteSink
+from clickatell.outbox import Outbox, SenderPool
+from clickatell.validators import validator, numpy
+from clickatell.response import Response
+from clickatell.tests.server import LocalServer, ClickatellServer
+
+def timeit(fn, number):
+    start = time.time()
+    for i in xrange(number):
+        fn()
+    return (time.time() - start) / number
+
+def report(name, seconds):
+    print '%-40s %10.1f us/call' % (name, seconds * 1000000)
+
+def bench_keepalive(number=200, handshake=0.005):
+    """
+    Per call latency of urllib2.urlopen versus the keep-alive pool, with
+    a simulated 5ms connection setup cost on the server.
+    """
+    server = LocalServer(response='ID: apimsgid', handshake=handshake).start()
+    try:
+        target = '%s/http/sendmsg?to=27123456789' % server.url
+        report('urllib2.urlopen',
+                timeit(lambda: urllib2.urlopen(target).read(), number))
+        pool = url.ConnectionPool()
+        report('ConnectionPool.urlopen',
+                timeit(lambda: pool.urlopen('GET', target).read(), number))
+        pool.clear()
+    finally:
+        server.stop()
+
+def bench_parse_content(number=20, lines=5000):
+    """
+    Parsing a 5000 line multi-recipient sendmsg body into Response objects,
+    the previous implementation is inlined for comparison.
+    """
+    content = ''.join('ID: %032x To: 2712%07d\n' % (i, i) 
+                        for i in xrange(lines))
+    client = Client()
+    def previous_parse():
+        return [map(lambda s: s.strip(), line.strip().split(":", 1))
+                    for line in content.split('\n')
+                    if line.strip()]
+    def previous():
+        return [client.dispatcher.dispatch(*response) 
+                    for response in previous_parse()]
+    def current():
+        return client.process_response(client.parse_content(content))
+    report('previous parsing', timeit(previous_parse, number))
+    report('parse_content', timeit(lambda: client.parse_content(content), 
+                                    number))
+    report('previous parsing & dispatching', timeit(previous, number))
+    report('parse_content & process_response', timeit(current, number))
+
+def bench_parse_parts(number=20000):
+    """
+    Response.parse_parts on realistic getmsgcharge, querymsg and sendmsg
+    bodies, the previous search & replace loop is inlined for comparison.
+    """
+    bodies = {
+        'getmsgcharge': 'ce7f181a44a4a5b7e43fe2b9a0b1f0c1 charge: 1 '
+                        'status: 002',
+        'querymsg': 'ce7f181a44a4a5b7e43fe2b9a0b1f0c1 Status: 002',
+        'sendmsg': 'ce7f181a44a4a5b7e43fe2b9a0b1f0c1 To: 27123456789',
+        'routeCoverage': 'This prefix is currently supported. Messages sent '
+                        'to this prefix will be routed. Charge: 1',
+    }
+    response = Response()
+    def previous(data):
+        collection = {}
+        while 1:
+            match = response.key_value_pattern.search(data)
+            if match is None:
+                break
+            key, value = match.group(1, 2)
+            collection[key] = value
+            data = data.replace(match.group(0), '')
+        return data.strip(), collection
+    for name, body in sorted(bodies.items()):
+        report('previous %s' % name, timeit(lambda: previous(body), number))
+        report('parse_parts %s' % name, 
+                timeit(lambda: response.parse_parts(body), number))
+
+def bench_sendmsg(number=200, handshake=0.005, latency=0.002):
+    """
+    sendmsg through the whole library against the local stand-in server,
+    with a simulated 5ms connection setup and 2ms of latency per request.
+    """
+    server = ClickatellServer(credit=number * 10, handshake=handshake,
+                                latency=latency).start()
+    def client():
+        return Client(server.url)
+    def urllib_client():
+        return Client(server.url, transport=url.URLLibTransport())
+    try:
+        for name, client_class in [('urllib2', urllib_client), 
+                                    ('pooled', client)]:
+            clickatell = Clickatell('username', 'password', 'api_id',
+                                    client_class=client_class)
+            report('sendmsg %s' % name, 
+                    timeit(lambda: clickatell.sendmsg(
+                                        recipients=['27123456789'], 
+                                        text='hello world'), number))
+        for workers in (1, 4, 16):
+            clickatell = AsyncClickatell('username', 'password', 'api_id',
+                                    client_class=client, max_workers=workers)
+            def send_all():
+                futures = [clickatell.sendmsg(recipients=['27123456789'],
+                                                text='hello world')
+                            for i in xrange(number)]
+                [future.result() for future in futures]
+            report('AsyncClickatell.sendmsg %s workers' % workers, 
+                    timeit(send_all, 1) / number)
+    finally:
+        url.pool.clear()
+        server.stop()
+
+def bench_outbox(number=500, latency=0.002):
+    """
+    Queueing sendmsg jobs in the outbox, and draining it with 1, 2, 4 & 8
+    sender processes against the local stand-in server with 2ms of
+    latency per request.
+    """
+    server = ClickatellServer(credit=number * 10, latency=latency).start()
+    directory = tempfile.mkdtemp()
+    def clickatell():
+        return Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(server.url))
+    try:
+        for processes in (1, 2, 4, 8):
+            path = os.path.join(directory, 'outbox-%s.db' % processes)
+            outbox = Outbox(path)
+            report('Outbox.sendmsg', 
+                    timeit(lambda: outbox.sendmsg(recipients=['27123456789'],
+                                                    text='hello world'), 
+                            number))
+            outbox.close()
+            pool = SenderPool(path, clickatell, processes=processes)
+            report('SenderPool.drain %s processes' % processes,
+                    timeit(pool.drain, 1) / number)
+    finally:
+        url.pool.clear()
+        server.stop()
+        shutil.rmtree(directory)
+
+def bench_coalesce(number=500, latency=0.002):
+    """
+    Sending the same text to 500 recipients in separate calls, each one
+    on its own from 4 workers, and coalesced with a 10ms deadline.
+    """
+    server = ClickatellServer(credit=number * 10, latency=latency).start()
+    try:
+        clickatell = AsyncClickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(server.url),
+                            max_workers=4)
+        def separate():
+            [future.result() for future in 
+                [clickatell.sendmsg(recipients=['2712%07d' % i],
+                                    text='hello world')
+                    for i in xrange(number)]]
+        report('AsyncClickatell.sendmsg', timeit(separate, 1) / number)
+        coalescer = Coalescer(Clickatell('username', 'password', 'api_id',
+                                client_class=lambda: Client(server.url)),
+                                deadline=0.01)
+        def coalesced():
+            [future.result() for future in 
+                [coalescer.sendmsg(recipients=['2712%07d' % i],
+                                    text='hello world')
+                    for i in xrange(number)]]
+        report('Coalescer.sendmsg', timeit(coalesced, 1) / number)
+        coalescer.close()
+    finally:
+        url.pool.clear()
+        server.stop()
+
+def bench_validate_recipients(number=1, recipients=1000000):
+    """
+    Validating 1M recipients with validate_to, which only rejects bad 
+    ones, and normalising them with validate_recipients, from a list of
+    strings, a list with formatting to strip and an array of integers.
+    """
+    msisdns = ['2712%07d' % i for i in xrange(recipients)]
+    formatted = ['+27 12 %03d %04d' % divmod(i, 10000) 
+                    for i in xrange(recipients)]
+    integers = array('l', (27120000000 + i for i in xrange(recipients)))
+    report('validate_to', timeit(lambda: validator.validate_to(msisdns), 
+                                    number))
+    report('validate_recipients', 
+            timeit(lambda: validator.validate_recipients(msisdns), number))
+    report('validate_recipients formatted', 
+            timeit(lambda: validator.validate_recipients(formatted), number))
+    report('validate_recipients dedupe', 
+            timeit(lambda: validator.validate_recipients(msisdns, 
+                                                        dedupe=True), number))
+    report('validate_recipients array', 
+            timeit(lambda: validator.validate_recipients(integers), number))
+    if numpy is not None:
+        report('validate_recipients numpy', 
+                timeit(lambda: validator.validate_recipients(
+                                    numpy.array(integers)), number))
+        report('validate_recipients numpy strings', 
+                timeit(lambda: validator.validate_recipients(
+                                    numpy.array(formatted)), number))
+
+def bench_validate(number=100000):
+    """
+    Validating the options of a sendmsg call with defaults, the previous
+    implementation is inlined for comparison.
+    """
+    defaults = {
+        'callback': 3,
+        'deliv_ack': 1,
+        'req_feat': 8240,
+        'msg_type': 'SMS_TEXT',
+        'validity': timedelta(hours=1),
+    }
+    compiled = validator.compile_defaults(defaults)
+    def previous_validate(options):
+        for option in ['deliv_time', 'validity']:
+            if option in options:
+                options[option] = validator.dispatch('timedelta', 
+                                                        options.pop(option))
+        for option in ['concat', 'max_credits', 'req_feat']:
+            if option in options:
+                options[option] = validator.dispatch('number', 
+                                                        options.pop(option))
+        for option in ['scheduled_time']:
+            if option in options:
+                options[option] = validator.dispatch('timestamp', 
+                                                        options.pop(option))
+        if 'sender' in options:
+            options['from'] = validator.dispatch('from', options.pop('sender'))
+        return options
+    def previous():
+        options = {'sender': 'Company', 'text': 'hello world', 'concat': 2}
+        options.update(defaults.copy())
+        options = previous_validate(options)
+        options['text'] = validator.dispatch('text', options.pop('text'))
+    def current():
+        validator.validate_with_defaults({'sender': 'Company', 
+                                            'text': 'hello world',
+                                            'concat': 2}, compiled)
+    report('previous validate', timeit(previous, number))
+    report('validate_with_defaults', timeit(current, number))
+
+def bench_callbacks(number=20000, connections=4, pipeline=100):
+    """
+    Receiving 20000 callbacks on 4 keep-alive connections that pipeline
+    100 requests at a time, written to SQLite in micro-batches, and calling
+    the WSGI app directly for the parsing & acknowledging overhead alone.
+    """
+    body = ('apiMsgId=996411ad91fa211e7d17bc873aa4a41d&cliMsgId=abc&'
+            'to=27123456789&timestamp=1218007814&from=27987654321&'
+            'status=004&charge=0.800000')
+    request = ('POST /callback HTTP/1.1\r\nHost: localhost\r\n'
+                'Content-Type: application/x-www-form-urlencoded\r\n'
+                'Content-Length: %s\r\n\r\n%s' % (len(body), body))
+    directory = tempfile.mkdtemp()
+    batcher = MicroBatcher(SQLiteSink(os.path.join(directory, 'cb.db')))
+    server = CallbackServer(CallbackReceiver(batcher), '127.0.0.1', 0).start()
+    try:
+        sockets = [socket.create_connection(server.address)
+                    for i in xrange(connections)]
+        def receive():
+            for i in xrange(number // (connections * pipeline)):
+                for sock in sockets:
+                    sock.sendall(request * pipeline)
+                for sock in sockets:
+                    received = ''
+                    while received.count('HTTP/1.1 200') < pipeline:
+                        received += sock.recv(65536)
+        seconds = timeit(receive, 1)
+        report('CallbackServer', seconds / number)
+        print '%-40s %10.0f callbacks/s' % ('', number / seconds)
+        for sock in sockets:
+            sock.close()
+    finally:
+        server.stop()
+        batcher.close()
+        shutil.rmtree(directory)
+    app = CallbackApp(MicroBatcher(SQLiteSink(':memory:')))
+    def call():
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': StringIO(body)}, lambda status, headers: None)
+    seconds = timeit(call, number)
+    report('CallbackApp', seconds)
+    print '%-40s %10.0f callbacks/s' % ('', 1 / seconds)
+    app.batcher.close()
+
+def bench_coverage(number=1000, prefixes=20, latency=0.002):
+    """
+    Checking the coverage of 1000 numbers spread over 20 network prefixes
+    one by one, and with check_coverage_many on an empty cache.
+    """
+    server = ClickatellServer(latency=latency).start()
+    try:
+        clickatell = Clickatell('username', 'password', 'api_id',
+                                client_class=lambda: Client(server.url))
+        msisdns = ['27%03d%06d' % (i % prefixes, i) for i in xrange(number)]
+        def separate():
+            [clickatell.check_coverage(msisdn) for msisdn in msisdns]
+        report('check_coverage', timeit(separate, 1) / number)
+        def many():
+            CoverageCache(clickatell).check_coverage_many(msisdns)
+        report('CoverageCache.check_coverage_many', timeit(many, 1) / number)
+    finally:
+        url.pool.clear()
+        server.stop()
+
+benchmarks = {
+    'coverage': bench_coverage,
+    'callbacks': bench_callbacks,
+    'validate': bench_validate,
+    'validate_recipients': bench_validate_recipients,
+    'coalesce': bench_coalesce,
+    'outbox': bench_outbox,
+    'keepalive': bench_keepalive,
+    'parse_content': bench_parse_content,
+    'parse_parts': bench_parse_parts,
+    'sendmsg': bench_sendmsg,
+}
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or sorted(benchmarks)):
+        print '%s:' % name
+        benchmarks[name]()
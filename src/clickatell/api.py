@@ -1,12 +1,17 @@
-from datetime import datetime, timedelta
+import itertools
+from datetime import timedelta
 from contextlib import contextmanager
 
 from clickatell import url
+from clickatell import futures
+from clickatell.utils import chunks
 from clickatell.client import Client
-from clickatell.response import OKResponse, ERRResponse, CreditResponse, IDResponse
-from clickatell.errors import ClickatellError
+from clickatell.response import OKResponse, ERRResponse, CreditResponse, \
+                                    IDResponse, ApiMsgIdResponse, ResponseSet
+from clickatell.session import SessionManager
+from clickatell import idempotency
+from clickatell.errors import ClickatellError, PartialSendError
 from clickatell.validators import validator
-from clickatell import constants as cc
 
 class Batch(object):
     def __init__(self, clickatell, options):
@@ -38,12 +43,31 @@ class Batch(object):
         options = validator.validate(options)
         options.update(context)
         options.update({
-            'session_id': self.clickatell.session_id,
             'batch_id': batch_id,
         })
-        [resp] = self.clickatell.client.batch('senditem', options)
+        [resp] = self.clickatell.call('batch', 'senditem', options)
+        if self.clickatell.status_store is not None:
+            self.clickatell.status_store.track([resp], [options.get('to')],
+                                                options.get('climsgid'))
         return resp
     
+    def sendmany(self, contexts, max_in_flight=10, **options):
+        """
+        Send an item for every context, each with a `to` and the fields
+        for the template, with at most `max_in_flight` requests at a time.
+        
+        Returns a Pipeline, iterating over it yields (index, Response, 
+        error) tuples in the order the requests complete, the error is the
+        exception of a request that failed. Contexts are read from the 
+        iterable as the results are consumed, so a generator or a CSV 
+        reader is never read into memory. Its `submitted`, `completed`, 
+        `failed` and `in_flight` counters report progress.
+        """
+        self.clickatell.ensure_connections(max_in_flight)
+        def senditem(context):
+            return self.sendmsg(context, **options)
+        return futures.Pipeline(senditem, contexts, max_in_flight)
+    
     def quicksend(self, **options):
         """
         Where one has the requirement to send the same message to multiple 
@@ -52,6 +76,10 @@ class Batch(object):
         to a predefined template and a string of destination addresses.
         
         Note: quicksend does not allow for templating
+        
+        Pass `response_set=True` to get a compact ResponseSet back instead
+        of a list of responses, or `stream=True` to get a generator that 
+        yields the responses as they are read from the socket.
         """
         
         if 'context' in options:
@@ -60,13 +88,22 @@ class Batch(object):
         batch_id = options.get('batch_id', self.batch_id)
         if not batch_id:
             raise ClickatellError, 'No batch_id set'
+        response_set = options.pop('response_set', False)
+        stream = options.pop('stream', False)
         options = validator.validate(options)
+        tos = self.clickatell.chunk_recipients(options.pop('recipients'))
         options.update({
-            'session_id': self.clickatell.session_id,
             'batch_id': batch_id,
-            'to': validator.dispatch('to', options.pop('recipients'))
         })
-        return self.clickatell.client.batch('quicksend', options)
+        def quicksend(to):
+            params = dict(options, to=to)
+            responses = self.clickatell.call('batch', 'quicksend', params,
+                                    method=self.clickatell.method_for(params),
+                                    response_set=response_set, stream=stream)
+            if not stream:
+                self.clickatell.track(responses, params)
+            return responses
+        return self.clickatell.fan_out(quicksend, tos, stream)
     
     def start(self, options={}):
         """
@@ -82,10 +119,7 @@ class Batch(object):
         be used before either the senditem or quicksend command.
         """
         options.update(self.options)
-        options.update({
-            'session_id': self.clickatell.session_id
-        })
-        [resp] = self.clickatell.client.batch('startbatch', options)
+        [resp] = self.clickatell.call('batch', 'startbatch', options)
         if isinstance(resp, IDResponse):
             return resp.value
         raise ClickatellError, resp
@@ -95,8 +129,7 @@ class Batch(object):
         This command ends a batch and is not required (following a batch send). 
         Batches will expire automatically after 24 hours.
         """
-        [resp] = self.clickatell.client.batch('endbatch', {
-            'session_id': self.clickatell.session_id,
+        [resp] = self.clickatell.call('batch', 'endbatch', {
             'batch_id': batch_id
         })
         if isinstance(resp, OKResponse):
@@ -105,14 +138,64 @@ class Batch(object):
 
 class Clickatell(object):
     SESSION_TIME_OUT = timedelta(minutes=15)
+    # error codes for an invalid, expired or missing session id
+    SESSION_ERROR_CODES = (1, 3, 5)
     def __init__(self, username, password, api_id, client_class=Client,
-                    sendmsg_defaults={}):
+                    sendmsg_defaults={}, max_recipients=100, max_fan_out=4,
+                    max_url_length=2000, keepalive=False, 
+                    session_store=None, retry_policy=None, dedup_index=None,
+                    governor=None, text_analyzer=None, status_store=None):
         self.username = username
         self.password = password
         self.api_id = api_id
         self.sendmsg_defaults = sendmsg_defaults
         self.client = client_class()
-        self._session_start_time = None
+        if retry_policy:
+            self.client.retry_policy = retry_policy
+        if governor:
+            self.client.governor = governor
+        self.session = SessionManager(self, self.SESSION_TIME_OUT, 
+                                        store=session_store)
+        if keepalive:
+            self.session.start_keepalive()
+        # recipient lists are split into requests of at most max_recipients,
+        # which are sent concurrently by at most max_fan_out workers
+        self.max_recipients = max_recipients
+        self.fan_out_pool = futures.WorkerPool(size=max_fan_out)
+        self.ensure_connections(max_fan_out)
+        # requests with longer query strings are sent as POST bodies
+        self.max_url_length = max_url_length
+        # a clickatell.idempotency.DedupIndex makes sendmsg idempotent
+        self.dedup_index = dedup_index
+        # a clickatell.text.TextAnalyzer sets the unicode, concat and 
+        # req_feat options every text needs
+        self.text_analyzer = text_analyzer
+        # a clickatell.status.StatusStore answers querymsg & getmsgcharge
+        # for messages whose status is known locally. Sends, querymsg,
+        # getmsgcharge and StatusPoller update it, use it as the sink of a
+        # callbacks.MicroBatcher to feed it callbacks too
+        self.status_store = status_store
+    
+    @property
+    def sendmsg_defaults(self):
+        return self._sendmsg_defaults
+    
+    @sendmsg_defaults.setter
+    def sendmsg_defaults(self, defaults):
+        """
+        Sets the defaults and validates them once, rather than on every
+        call. Assign a new dict to change them.
+        """
+        self._sendmsg_defaults = defaults
+        self.compiled_defaults = validator.compile_defaults(defaults)
+    
+    def with_defaults(self, options):
+        """
+        Returns the validated options with the sendmsg defaults, which take
+        precedence over them.
+        """
+        return validator.validate_with_defaults(options, 
+                                                self.compiled_defaults)
     
     @property
     def session_id(self):
@@ -124,21 +207,34 @@ class Clickatell(object):
         a new session id. It'll return the current session id if it is 
         still valid.
         """
-        if self.session_expired():
-            self.session_id = self.get_new_session_id()
-        return self._session_id
+        return self.session.get()
     
     @session_id.setter
     def session_id(self, session_token):
         """
         Sets the session token and resets the session time-out.
         """
-        self.reset_session_timeout()
-        self._session_id = session_token
-        return self._session_id
+        self.session.set(session_token)
+        return session_token
+    
+    @property
+    def _session_start_time(self):
+        return self.session.start_time
+    
+    @_session_start_time.setter
+    def _session_start_time(self, start_time):
+        self.session.touch(start_time)
+    
+    def close(self):
+        """
+        Stop the keep alive thread and the workers requests are fanned out
+        on. They're started again if the instance is used after closing.
+        """
+        self.session.stop_keepalive()
+        self.fan_out_pool.shutdown()
     
     def reset_session_timeout(self):
-        self._session_start_time = datetime.now()
+        self.session.touch()
     
     def get_new_session_id(self):
         """
@@ -161,12 +257,37 @@ class Clickatell(object):
         Return True or False depending on whether a session has expired
         or not. Calculated locally based on the time out value.
         """
-        # If session_start_time hasn't been set then we do not have
-        # a session yet
-        if not self._session_start_time:
-            return True
-        return (datetime.now() - self._session_start_time) >= \
-                    self.SESSION_TIME_OUT
+        return self.session.expired()
+    
+    def session_rejected(self, responses):
+        """
+        Return True if Clickatell rejected the session id of a call
+        """
+        if isinstance(responses, ResponseSet):
+            codes = responses.error_codes()
+        elif isinstance(responses, list):
+            codes = [resp.code for resp in responses 
+                        if isinstance(resp, ERRResponse)]
+        else:
+            # streamed responses can't be inspected without consuming them
+            return False
+        return any(code in self.SESSION_ERROR_CODES for code in codes)
+    
+    def call(self, endpoint, command, params, **options):
+        """
+        Call the command on the client's `http`, `batch` or `utils` endpoint
+        with the session id added to the params. If Clickatell rejects the 
+        session id a new session is started and the call is retried once.
+        """
+        fn = getattr(self.client, endpoint)
+        session_id = self.session_id
+        responses = fn(command, dict(params, session_id=session_id), 
+                        **options)
+        if self.session_rejected(responses):
+            session_id = self.session.refresh(stale=session_id)
+            responses = fn(command, dict(params, session_id=session_id), 
+                            **options)
+        return responses
     
     def ping(self):
         """
@@ -181,21 +302,178 @@ class Clickatell(object):
             return True
         raise ClickatellError, resp
     
+    def method_for(self, params):
+        """
+        Returns the HTTP method to use for the given parameters, POST if 
+        they would make for an overly long URL.
+        """
+        if len(url.urlencode(params)) > self.max_url_length:
+            return 'post'
+        return 'get'
+    
+    def ensure_connections(self, size):
+        """
+        Let the client's connection pool serve at least `size` requests at 
+        a time, for callers running that many concurrently.
+        """
+        ensure = getattr(self.client, 'ensure_connections', None)
+        if ensure is not None:
+            ensure(size)
+    
+    def chunk_recipients(self, recipients):
+        """
+        Validate the recipients and return comma separated `to` values for
+        every chunk of at most `max_recipients`.
+        """
+        recipients = list(recipients)
+        return [validator.validate_to(chunk) 
+                for chunk in chunks(recipients, self.max_recipients)] or \
+                [validator.validate_to(recipients)]
+    
+    def fan_out(self, send, tos, stream=False):
+        """
+        Call `send` for every `to` value, concurrently if there is more than
+        one. The responses are returned in the order of the `to` values.
+        
+        When streaming the `to` values are sent one after the other, as
+        the responses of the previous one have been consumed.
+        
+        If some of the requests fail a PartialSendError with the responses
+        of the others is raised. If they all fail with the same kind of 
+        error the first one is raised instead.
+        """
+        if stream:
+            return itertools.chain.from_iterable(itertools.imap(send, tos))
+        if len(tos) == 1:
+            return send(tos[0])
+        pending = [self.fan_out_pool.submit(send, to) for to in tos]
+        results, errors = [], []
+        for to, future in zip(tos, pending):
+            error = future.exception()
+            if error is None:
+                results.append(future.result())
+            else:
+                results.append(None)
+                errors.append((to, error))
+        if len(errors) == len(tos) and \
+            len(set(type(error) for to, error in errors)) == 1:
+            pending[0].result()
+        if errors:
+            raise PartialSendError('%s of %s requests failed' % (len(errors),
+                                    len(tos)), results, errors)
+        merged = results[0]
+        for result in results[1:]:
+            merged.extend(result)
+        return merged
+    
+    def reconcile(self, climsgid):
+        """
+        Ask Clickatell whether it accepted the message with the given 
+        climsgid. Returns its IDResponse, or None if it doesn't know it.
+        """
+        [resp] = self.call('http', 'querymsg', {'climsgid': climsgid})
+        if isinstance(resp, IDResponse):
+            return resp
+    
+    def send_once(self, send, params, response_set=False):
+        """
+        Call `send` with the params unless the dedup index shows the 
+        message was already accepted, in which case the responses it 
+        got back then are returned. A message whose earlier attempt had 
+        an unknown outcome is reconciled with querymsg first.
+        
+        Clickatell only reports one message per climsgid, a lost request
+        to more than one recipient that it did accept can't be answered
+        and raises a ClickatellError, as does a message that is still
+        being sent by another thread or process.
+        """
+        climsgid = params['climsgid']
+        state, pairs = self.dedup_index.claim(climsgid)
+        if state in (idempotency.PENDING, idempotency.UNKNOWN):
+            resp = self.reconcile(climsgid)
+            if resp and ',' in params['to']:
+                raise ClickatellError, 'Message %s was accepted but its ' \
+                        'responses were lost, its outcome per recipient is ' \
+                        'unknown' % climsgid
+            if resp:
+                pairs = [('ID', resp.value)]
+                self.dedup_index.sent(climsgid, pairs)
+                state = idempotency.SENT
+            elif not self.dedup_index.takeover(climsgid):
+                raise ClickatellError, 'Message %s is already being sent' % \
+                                            climsgid
+        if state == idempotency.SENT:
+            return self.client.process_response(pairs, response_set)
+        try:
+            responses = send(params)
+        except:
+            # the outcome is unknown, reconcile it on the next attempt
+            self.dedup_index.unknown(climsgid)
+            raise
+        pairs = idempotency.to_pairs(responses)
+        if any(kind != 'ERR' for kind, payload in pairs):
+            self.dedup_index.sent(climsgid, pairs)
+        else:
+            self.dedup_index.discard(climsgid)
+        return responses
+    
+    def track(self, responses, params):
+        """
+        Add the messages of a send to the status store, if there is one
+        """
+        if self.status_store is not None:
+            self.status_store.track(responses, params['to'].split(','),
+                                    params.get('climsgid'))
+    
     def sendmsg(self, **options):
         """
         send an SMS message. Accepts all the variables as documented by
         Clickatell in the HTTP api. Since `to` and `from` are keywords for 
         python they should be specified as 'sender' and 'recipients'. The
         recipients should be a list of MSISDNs.
+        
+        Long lists of recipients are split over several concurrent requests,
+        the responses are returned in the order of the recipients. Pass
+        `response_set=True` to get a compact ResponseSet back instead of a
+        list of responses, or `stream=True` to get a generator that yields
+        the responses as they are read from the socket. Streamed responses
+        can't be checked before they're handed out, so a rejected session
+        id is not refreshed and the request not retried, and they're not
+        tracked in the status store.
+        
+        With a dedup index every request gets a deterministic climsgid and
+        retries of a message Clickatell already accepted are answered from
+        the index. Pass an `idempotency_key` to send the same text to the
+        same recipients more than once. Streaming can't be combined with a
+        dedup index.
         """
-        options.update(self.sendmsg_defaults.copy())
-        options = validator.validate(options)
-        options.update({
-            'to': validator.dispatch('to', options.pop('recipients')),
-            'text': validator.dispatch('text', options.pop('text')),
-            'session_id': self.session_id
-        })
-        return self.client.http('sendmsg', options)
+        response_set = options.pop('response_set', False)
+        stream = options.pop('stream', False)
+        idempotency_key = options.pop('idempotency_key', None)
+        if stream and self.dedup_index is not None:
+            raise ClickatellError, "Streamed sends can't be deduplicated, " \
+                                    "send without stream=True"
+        options = self.with_defaults(options)
+        if self.text_analyzer is not None:
+            self.text_analyzer.apply(options)
+        tos = self.chunk_recipients(options.pop('recipients'))
+        def call(params):
+            return self.call('http', 'sendmsg', params, 
+                                    method=self.method_for(params),
+                                    response_set=response_set, stream=stream)
+        def sendmsg(to):
+            params = dict(options, to=to)
+            if self.dedup_index is None:
+                responses = call(params)
+            else:
+                if 'climsgid' not in params:
+                    params['climsgid'] = idempotency.climsgid_for(params,
+                                                            idempotency_key)
+                responses = self.send_once(call, params, response_set)
+            if not stream:
+                self.track(responses, params)
+            return responses
+        return self.fan_out(sendmsg, tos, stream)
     
     def querymsg(self,**kwargs):
         """
@@ -205,10 +483,22 @@ class Clickatell(object):
         successfully submitted. If you specified your own unique client 
         message ID (climsgid) on submission, you may query the message status 
         using this value.
+        
+        With a status store messages with a final or fresh status are
+        answered from the store, without asking Clickatell.
         """
-        kwargs.update({'session_id': self.session_id})
-        [resp] = self.client.http('querymsg', kwargs)
+        if self.status_store is not None:
+            resp = self.status_store.querymsg_response(**kwargs)
+            if resp is not None:
+                return resp
+        [resp] = self.call('http', 'querymsg', kwargs)
         if isinstance(resp, IDResponse):
+            if self.status_store is not None:
+                self.status_store.update_many([{
+                    'apimsgid': resp.value,
+                    'status': resp.extra.get('Status'),
+                    'climsgid': kwargs.get('climsgid'),
+                }])
             return resp
         raise ClickatellError, resp
     
@@ -216,9 +506,7 @@ class Clickatell(object):
         """
         Returns the current balance as a float.
         """
-        [resp] = self.client.http('getbalance', {
-            'session_id': self.session_id
-        })
+        [resp] = self.call('http', 'getbalance', {})
         if isinstance(resp, CreditResponse):
             return resp.value
         raise ClickatellError, resp
@@ -229,9 +517,8 @@ class Clickatell(object):
         OKResponse with the Charge specified in the extra dictionary or 
         an ERRResponse with the reason.
         """
-        [resp] = self.client.utils('routeCoverage.php', {
+        [resp] = self.call('utils', 'routeCoverage.php', {
             'msisdn': msisdn,
-            'session_id': self.session_id
         })
         return resp
     
@@ -239,17 +526,134 @@ class Clickatell(object):
         """
         Returns an ApiMsgIdResponse with the 'charge' and the 'status' in the
         extra dictionary or an ERRResponse with the error code and the reason
+        
+        With a status store messages with a final or fresh status and a
+        known charge are answered from the store.
         """
-        [resp] = self.client.http('getmsgcharge', {
-            'session_id': self.session_id,
+        if self.status_store is not None:
+            resp = self.status_store.getmsgcharge_response(apimsgid)
+            if resp is not None:
+                return resp
+        [resp] = self.call('http', 'getmsgcharge', {
             'apimsgid': apimsgid
         })
+        if self.status_store is not None and \
+            isinstance(resp, ApiMsgIdResponse):
+            self.status_store.update_many([{
+                'apimsgid': resp.value,
+                'status': resp.extra.get('status'),
+                'charge': float(resp.extra['charge']) 
+                            if 'charge' in resp.extra else None,
+            }])
         return resp
     
     def batch(self, **options):
         """
         Return a Batch messaging instance
         """
-        options.update(self.sendmsg_defaults.copy())
-        return Batch(self, validator.validate(options))
-    
\ No newline at end of file
+        return Batch(self, self.with_defaults(options))
+    
+class AsyncBatch(Batch):
+    """
+    A Batch whose calls run in the background and return Futures.
+    
+    Used as a context manager the batch is started in the background on
+    entry, items sent inside the block wait for the batch_id without 
+    blocking the caller. On exit it waits for all pending items before 
+    ending the batch.
+    """
+    def __init__(self, clickatell, options):
+        super(AsyncBatch, self).__init__(clickatell, options)
+        self.started = None
+        self.pending = []
+    
+    def __enter__(self, *args, **kwargs):
+        self.started = self.start()
+        return self
+    
+    def __exit__(self, *args, **kwargs):
+        futures.wait(self.pending)
+        self.pending = []
+        self.end(self.get_batch_id()).result()
+    
+    def get_batch_id(self):
+        if not self.batch_id and self.started:
+            self.batch_id = self.started.result()
+        return self.batch_id
+    
+    def submit(self, fn, *args, **kwargs):
+        def call():
+            self.get_batch_id()
+            return fn(self, *args, **kwargs)
+        future = self.clickatell.submit(call)
+        self.pending.append(future)
+        return future
+    
+    def sendmsg(self, context={}, **options):
+        return self.submit(Batch.sendmsg, context, **options)
+    
+    def sendmany(self, contexts, max_in_flight=10, **options):
+        # the pipeline makes its own requests, it needs the batch_id first
+        self.get_batch_id()
+        self.clickatell.ensure_connections(max_in_flight)
+        def senditem(context):
+            return Batch.sendmsg(self, context, **options)
+        return futures.Pipeline(senditem, contexts, max_in_flight)
+    
+    def quicksend(self, **options):
+        return self.submit(Batch.quicksend, **options)
+    
+    def start(self, options={}):
+        return self.clickatell.submit(Batch.start, self, options)
+    
+    def end(self, batch_id):
+        return self.clickatell.submit(Batch.end, self, batch_id)
+
+class AsyncClickatell(Clickatell):
+    """
+    A Clickatell whose API calls return Futures instead of blocking. The
+    calls run on a shared pool of workers, which all send their requests
+    over the keep-alive connection pool.
+    """
+    def __init__(self, username, password, api_id, workers=None,
+                    max_workers=10, **kwargs):
+        super(AsyncClickatell, self).__init__(username, password, api_id,
+                                                **kwargs)
+        # only workers created here are shut down by close()
+        self.own_workers = workers is None
+        self.workers = workers or futures.WorkerPool(size=max_workers)
+        self.ensure_connections(self.workers.size)
+    
+    def submit(self, fn, *args, **kwargs):
+        return self.workers.submit(fn, *args, **kwargs)
+    
+    def close(self):
+        super(AsyncClickatell, self).close()
+        if self.own_workers:
+            self.workers.shutdown()
+    
+    def ping(self):
+        return self.submit(super(AsyncClickatell, self).ping)
+    
+    def sendmsg(self, **options):
+        return self.submit(super(AsyncClickatell, self).sendmsg, **options)
+    
+    def querymsg(self, **kwargs):
+        return self.submit(super(AsyncClickatell, self).querymsg, **kwargs)
+    
+    def getbalance(self):
+        return self.submit(super(AsyncClickatell, self).getbalance)
+    
+    def check_coverage(self, msisdn):
+        return self.submit(super(AsyncClickatell, self).check_coverage, 
+                            msisdn)
+    
+    def getmsgcharge(self, apimsgid):
+        return self.submit(super(AsyncClickatell, self).getmsgcharge, 
+                            apimsgid)
+    
+    def batch(self, **options):
+        """
+        Return an asynchronous Batch messaging instance
+        """
+        return AsyncBatch(self, self.with_defaults(options))
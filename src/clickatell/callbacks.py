@@ -0,0 +1,454 @@
+import time
+import socket
+import base64
+import sqlite3
+import asyncore
+import asynchat
+import logging
+import threading
+from Queue import Queue
+from urlparse import parse_qsl
+
+class CallbackRecord(object):
+    """
+    A status update Clickatell posted for a message
+    """
+
+    __slots__ = ('apimsgid', 'climsgid', 'to', 'sender', 'timestamp',
+                    'status', 'charge')
+
+    def __init__(self, apimsgid, climsgid=None, to=None, sender=None,
+                    timestamp=None, status=None, charge=None):
+        self.apimsgid = apimsgid
+        self.climsgid = climsgid
+        self.to = to
+        self.sender = sender
+        self.timestamp = timestamp
+        self.status = status
+        self.charge = charge
+
+    def __repr__(self):
+        return 'CallbackRecord: %s %s' % (self.apimsgid, self.status)
+
+    def __eq__(self, other):
+        return isinstance(other, CallbackRecord) and \
+                self.as_tuple() == other.as_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def as_tuple(self):
+        return (self.apimsgid, self.climsgid, self.to, self.sender,
+                self.timestamp, self.status, self.charge)
+
+def parse_callback(data):
+    """
+    Parses the urlencoded parameters of a callback into a CallbackRecord,
+    returns None if there's no apiMsgId.
+    """
+    params = dict(parse_qsl(data))
+    apimsgid = params.get('apiMsgId')
+    if not apimsgid:
+        return None
+    timestamp = params.get('timestamp')
+    charge = params.get('charge')
+    return CallbackRecord(apimsgid, params.get('cliMsgId') or None,
+                            params.get('to'), params.get('from'),
+                            int(timestamp) if timestamp else None,
+                            params.get('status'),
+                            float(charge) if charge else None)
+
+
+class QueueSink(object):
+    """
+    Puts every record on a Queue.Queue, for consumers in the same process
+    """
+
+    def __init__(self, queue=None):
+        self.queue = queue or Queue()
+
+    def write(self, records):
+        for record in records:
+            self.queue.put(record)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """
+    Appends the records to a file as tab separated lines
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, 'a')
+
+    def write(self, records):
+        self.fp.write(''.join('%s\n' % '\t'.join('' if value is None
+                                else str(value) for value in record.as_tuple())
+                                for record in records))
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class SQLiteSink(object):
+    """
+    Inserts the records in a `callbacks` table of an SQLite database,
+    every micro-batch in a single transaction.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS callbacks ('
+                        'apimsgid TEXT, climsgid TEXT, recipient TEXT, '
+                        'sender TEXT, timestamp INTEGER, status TEXT, '
+                        'charge REAL)')
+
+    def write(self, records):
+        with self.db:
+            self.db.executemany('INSERT INTO callbacks VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?)',
+                                [record.as_tuple() for record in records])
+
+    def close(self):
+        self.db.close()
+
+
+class MicroBatcher(object):
+    """
+    Collects records and writes them to the sink in batches of up to
+    `max_batch` records, at most `max_delay` seconds after the first one
+    of a batch came in. Writes happen on a background thread so requests
+    are acknowledged without waiting for the sink.
+
+    A batch the sink failed to write is put back in front of the queue
+    and retried after `retry_delay` seconds, doubling for every failure
+    in a row up to `max_retry_delay`. Once closing, records are dropped
+    if the sink still fails after `max_retries` more attempts.
+    """
+
+    def __init__(self, sink, max_batch=500, max_delay=0.05, retry_delay=0.1,
+                    max_retry_delay=30, max_retries=3):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.records = []
+        self.stopped = False
+        self.written = 0
+        # sink writes that failed in a row
+        self.failures = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add(self, record):
+        with self.condition:
+            self.records.append(record)
+            if len(self.records) == 1 or \
+                len(self.records) >= self.max_batch:
+                self.condition.notify()
+
+    def take(self):
+        """
+        Wait for the next batch of records
+        """
+        with self.condition:
+            while not self.records and not self.stopped:
+                self.condition.wait()
+            deadline = time.time() + self.max_delay
+            while len(self.records) < self.max_batch and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            records = self.records[:self.max_batch]
+            del self.records[:self.max_batch]
+            return records
+
+    def requeue(self, records):
+        with self.condition:
+            self.records[:0] = records
+
+    def run(self):
+        while True:
+            records = self.take()
+            if records:
+                try:
+                    self.sink.write(records)
+                except Exception:
+                    self.failures += 1
+                    logging.exception('Writing %s callbacks failed' %
+                                        len(records))
+                    self.requeue(records)
+                    if self.stopped and self.failures > self.max_retries:
+                        logging.error('Dropping %s callbacks' %
+                                        len(self.records))
+                        break
+                    time.sleep(min(self.max_retry_delay, self.retry_delay *
+                                    2 ** (self.failures - 1)))
+                else:
+                    self.failures = 0
+                    self.written += len(records)
+            elif self.stopped:
+                break
+
+    def close(self):
+        """
+        Write the remaining records and close the sink
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.sink.close()
+
+
+class CallbackReceiver(object):
+    """
+    Turns callback requests into records for a MicroBatcher. If a
+    `username` is set requests need to authenticate with it and the
+    `password` using HTTP basic authentication, as set in the callback
+    preferences of the Clickatell account. Request bodies over `max_body`
+    bytes are refused.
+    """
+
+    max_body = 64 * 1024
+
+    def __init__(self, batcher, username=None, password=None):
+        self.batcher = batcher
+        self.authorization = None
+        if username is not None:
+            self.authorization = 'Basic %s' % base64.b64encode(
+                                    '%s:%s' % (username, password))
+
+    def handle(self, method, query, body, authorization=None):
+        """
+        Returns the HTTP status to answer the request with
+        """
+        if self.authorization and authorization != self.authorization:
+            return 401
+        try:
+            record = parse_callback(body if method == 'POST' else query)
+        except ValueError:
+            return 400
+        if record is None:
+            return 400
+        self.batcher.add(record)
+        return 200
+
+
+class CallbackApp(CallbackReceiver):
+    """
+    A WSGI application receiving the callbacks
+    """
+
+    reasons = {200: '200 OK', 400: '400 Bad Request', 401: '401 Unauthorized',
+                413: '413 Request Entity Too Large'}
+
+    def read_body(self, environ):
+        """
+        Returns the status to refuse the request with, or None, and the body
+        """
+        if environ['REQUEST_METHOD'] != 'POST':
+            return None, ''
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 400, ''
+        if length < 0:
+            return 400, ''
+        if length > self.max_body:
+            return 413, ''
+        return None, environ['wsgi.input'].read(length)
+
+    def __call__(self, environ, start_response):
+        status, body = self.read_body(environ)
+        if status is None:
+            status = self.handle(environ['REQUEST_METHOD'],
+                                    environ.get('QUERY_STRING', ''), body,
+                                    environ.get('HTTP_AUTHORIZATION'))
+        start_response(self.reasons[status], [('Content-Type', 'text/plain'),
+                                                ('Content-Length', '0')])
+        return ['']
+
+
+responses = {
+    200: 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n',
+    400: 'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n',
+    401: 'HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n'
+            'WWW-Authenticate: Basic realm="clickatell"\r\n\r\n',
+    413: 'HTTP/1.1 413 Request Entity Too Large\r\nContent-Length: 0\r\n'
+            'Connection: close\r\n\r\n',
+}
+
+def header_value(headers, name):
+    """
+    Returns the value of a header in a raw header block, or None
+    """
+    start = headers.lower().find('\r\n%s:' % name)
+    if start < 0:
+        return None
+    start += len(name) + 3
+    end = headers.find('\r\n', start)
+    return headers[start:end if end >= 0 else None].strip()
+
+
+class CallbackChannel(asynchat.async_chat):
+    """
+    A keep-alive HTTP/1.1 connection to the CallbackServer. Request heads
+    over `max_head` bytes and bodies over the receiver's `max_body` are
+    refused and the connection is closed.
+    """
+
+    max_head = 8 * 1024
+
+    def __init__(self, sock, receiver, map):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.receiver = receiver
+        self.buffer = []
+        self.buffered = 0
+        self.head = None
+        self.refused = False
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        if self.refused:
+            return
+        if self.head is None:
+            self.buffered += len(data)
+            if self.buffered > self.max_head:
+                self.refuse(400)
+                return
+        self.buffer.append(data)
+
+    def refuse(self, status):
+        """
+        Answer with an error and close the connection once it is sent,
+        without reading the rest of the request.
+        """
+        self.buffer, self.buffered, self.head = [], 0, None
+        self.refused = True
+        self.set_terminator(None)
+        self.push(responses[status])
+        self.close_when_done()
+
+    def found_terminator(self):
+        data, self.buffer, self.buffered = ''.join(self.buffer), [], 0
+        if self.head is None:
+            try:
+                length = int(header_value(data, 'content-length') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.refuse(400)
+                return
+            if length > self.receiver.max_body:
+                self.refuse(413)
+                return
+            if length:
+                self.head = data
+                self.set_terminator(length)
+                return
+            self.respond(data, '')
+        else:
+            head, self.head = self.head, None
+            self.set_terminator('\r\n\r\n')
+            self.respond(head, data)
+
+    def respond(self, head, body):
+        request_line, _, headers = head.partition('\r\n')
+        headers = '\r\n' + headers
+        try:
+            method, target, version = request_line.split(' ', 2)
+        except ValueError:
+            self.push(responses[400])
+            self.close_when_done()
+            return
+        path, _, query = target.partition('?')
+        status = self.receiver.handle(method, query, body,
+                                    header_value(headers, 'authorization'))
+        self.push(responses[status])
+        connection = (header_value(headers, 'connection') or '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and
+                                        connection != 'keep-alive'):
+            self.close_when_done()
+
+
+class CallbackServer(asyncore.dispatcher):
+    """
+    A standalone single threaded callback receiver, it serves any number
+    of keep-alive connections from one asyncore loop.
+    """
+
+    def __init__(self, receiver, host='0.0.0.0', port=8080):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.receiver = receiver
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.address = self.socket.getsockname()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.address
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            sock, address = pair
+            CallbackChannel(sock, self.receiver, self.map)
+
+    def serve_forever(self, timeout=0.1):
+        asyncore.loop(timeout, map=self.map)
+
+    def start(self):
+        """
+        Serve from a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        for channel in self.map.values():
+            channel.close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] sqlite_path')
+    parser.add_option('--host', default='0.0.0.0')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--username', help='for HTTP basic authentication')
+    parser.add_option('--password')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a path for the SQLite database is required')
+    batcher = MicroBatcher(SQLiteSink(args[0]))
+    server = CallbackServer(CallbackReceiver(batcher, options.username,
+                                                options.password),
+                            options.host, options.port)
+    print 'Receiving Clickatell callbacks on %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from clickatell.http import HttpClient
 from clickatell import response
 from clickatell.errors import ClickatellError
 from clickatell.utils import Dispatcher
+from clickatell.futures import WorkerPool
 
 class ResponseDispatcher(Dispatcher):
     
@@ -28,22 +29,106 @@ class Client(HttpClient):
     http_batch_url = "%s/http_batch" % base_url
     utils_url = "%s/utils" % base_url
     
-    def __init__(self):
+    # a clickatell.retry.RetryPolicy, calls are made only once without one
+    retry_policy = None
+    # commands that send messages, a retry could send them twice
+    send_commands = ('sendmsg', 'quicksend', 'senditem')
+    # a clickatell.ratelimit.Governor, requests are sent straight away 
+    # without one
+    governor = None
+    
+    def __init__(self, base_url=None, transport=None, retry_policy=None,
+                    governor=None):
         self.dispatcher = ResponseDispatcher()
+        self.breakers = {}
+        if retry_policy:
+            self.retry_policy = retry_policy
+        if governor:
+            self.governor = governor
+        if transport:
+            self.transport = transport
+        if base_url:
+            self.base_url = base_url
+            self.http_url = "%s/http" % base_url
+            self.http_batch_url = "%s/http_batch" % base_url
+            self.utils_url = "%s/utils" % base_url
+    
+    def process_response(self, data, response_set=False):
+        """
+        Returns a list of Response objects for the parsed data, or a compact 
+        ResponseSet if `response_set` is True.
+        """
+        handler = self.dispatcher.handler
+        if response_set:
+            return response.ResponseSet(handler, data)
+        return [handler(kind)(payload) for kind, payload in data]
+    
+    def stream_response(self, data):
+        handler = self.dispatcher.handler
+        for kind, payload in data:
+            yield handler(kind)(payload)
+    
+    def circuit_breaker(self, endpoint):
+        """
+        Returns the circuit breaker for an endpoint (http, batch or utils)
+        """
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = self.retry_policy.circuit_breaker()
+        return self.breakers[endpoint]
     
-    def process_response(self, data):
-        return [self.dispatcher.dispatch(*response) for response in data]
+    def call(self, url, kwargs={}, method='get', response_set=False, 
+                stream=False, endpoint=None):
+        """
+        Call the API and return the responses. If `stream` is True a 
+        generator is returned that yields every Response as soon as its 
+        line has been read from the socket.
+        
+        With a retry policy transient failures are retried, and calls fail
+        fast with a CircuitOpenError while the endpoint is unhealthy. With a
+        governor every attempt waits for its turn within the rate limit.
+        """
+        def attempt():
+            if self.governor is not None:
+                self.governor.throttle(kwargs)
+            return self.request(url, kwargs, method, response_set, stream)
+        if self.retry_policy is None:
+            return attempt()
+        idempotent = url.rsplit('/', 1)[-1] not in self.send_commands
+        return self.retry_policy.call(attempt, self.circuit_breaker(endpoint),
+                                        idempotent)
     
-    def call(self, url, kwargs={}):
-        response = self.get(url, kwargs)
+    def request(self, url, kwargs={}, method='get', response_set=False,
+                stream=False):
+        if stream:
+            return self.stream_response(self.stream(method, url, kwargs))
+        response = getattr(self, method)(url, kwargs)
         logging.debug("Got response: %s" % response)
-        return self.process_response(response)
+        return self.process_response(response, response_set)
     
-    def http(self, command, kwargs={}):
-        return self.call('%s/%s' % (self.http_url, command), kwargs)
+    def http(self, command, kwargs={}, **options):
+        return self.call('%s/%s' % (self.http_url, command), kwargs, 
+                            endpoint='http', **options)
+    
+    def batch(self, command, kwargs={}, **options):
+        return self.call('%s/%s' % (self.http_batch_url, command), kwargs, 
+                            endpoint='http_batch', **options)
+    
+    def utils(self, command, kwargs={}, **options):
+        return self.call('%s/%s' % (self.utils_url, command), kwargs, 
+                            endpoint='utils', **options)
+
+class AsyncClient(Client):
+    """
+    A Client whose calls run on a pool of workers sharing the keep-alive
+    connection pool. Every call returns a Future instead of blocking.
+    The other arguments are those of Client.
+    """
     
-    def batch(self, command, kwargs={}):
-        return self.call('%s/%s' % (self.http_batch_url, command), kwargs)
+    def __init__(self, workers=None, max_workers=10, **kwargs):
+        super(AsyncClient, self).__init__(**kwargs)
+        self.workers = workers or WorkerPool(size=max_workers)
+        self.ensure_connections(self.workers.size)
     
-    def utils(self, command, kwargs={}):
-        return self.call('%s/%s' % (self.utils_url, command), kwargs)
+    def call(self, url, kwargs={}, **options):
+        return self.workers.submit(super(AsyncClient, self).call, url, kwargs,
+                                    **options)
@@ -0,0 +1,216 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+from clickatell.errors import ClickatellError, PartialSendError
+from clickatell.futures import Future, WorkerPool
+from clickatell.response import ERRResponse, parse_parts
+from clickatell.validators import validator
+
+class Group(object):
+    """
+    The sends with the same text & options that are waiting to be sent
+    together, with the recipients and Future of every caller.
+    """
+
+    def __init__(self, options, deadline):
+        self.options = options
+        self.deadline = deadline
+        self.recipients = []
+        self.callers = []
+
+    def add(self, recipients):
+        future = Future()
+        start = len(self.recipients)
+        self.recipients.extend(recipients)
+        self.callers.append((future, start, len(self.recipients)))
+        return future
+
+    def match(self, recipients, responses):
+        """
+        Returns the responses for the recipients by recipient.
+        Multi-recipient responses name their recipient, a single response
+        without one belongs to the only recipient left. A single error
+        for all recipients is an error for the whole request and belongs
+        to all of them.
+        """
+        by_recipient, unnamed = {}, []
+        for resp in responses:
+            to = parse_parts(resp.data)[1].get('To')
+            if to is None:
+                unnamed.append(resp)
+            else:
+                by_recipient[to] = resp
+        rest = set(recipients).difference(by_recipient)
+        if len(unnamed) == 1 and (len(rest) == 1 or (not by_recipient and
+                                    isinstance(unnamed[0], ERRResponse))):
+            by_recipient.update(dict.fromkeys(rest, unnamed[0]))
+        return by_recipient
+
+    def resolve(self, responses, failed={}):
+        """
+        Hand every caller the responses for its own recipients. Callers
+        with a recipient in `failed`, a dict of recipient to exc_info,
+        get that error instead.
+        """
+        by_recipient = self.match([to for to in self.recipients
+                                    if to not in failed], responses)
+        for future, start, end in self.callers:
+            recipients = self.recipients[start:end]
+            errors = [failed[to] for to in recipients if to in failed]
+            missing = [to for to in recipients if to not in by_recipient]
+            if errors:
+                future.set_exception(errors[0])
+            elif missing:
+                try:
+                    raise ClickatellError, 'No response for %s' % \
+                                            ','.join(missing)
+                except ClickatellError:
+                    future.set_exception(sys.exc_info())
+            else:
+                future.set_result([by_recipient[to] for to in recipients])
+
+    def resolve_partial(self, error):
+        """
+        Resolve the callers of a group that was split into several
+        requests from the PartialSendError of the requests that failed.
+        """
+        failed = {}
+        for to, exception in error.errors:
+            failed.update(dict.fromkeys(to.split(','),
+                            (type(exception), exception, None)))
+        responses = []
+        for result in error.results:
+            if result is not None:
+                responses.extend(result)
+        self.resolve(responses, failed)
+
+    def fail(self, exc_info):
+        for future, start, end in self.callers:
+            if not future.done():
+                future.set_exception(exc_info)
+
+
+class Coalescer(object):
+    """
+    Holds sendmsg calls with the same text and options for up to `deadline`
+    seconds and sends them as a single multi-recipient sendmsg.
+
+    Every call returns a Future for the list of responses for its own
+    recipients. A group is sent early once it has `max_recipients`
+    recipients, by default the max_recipients of the Clickatell instance.
+
+    With a BatchRegistry groups are sent with quicksend, to a shared batch
+    with the text as its template.
+    """
+
+    def __init__(self, clickatell, deadline=0.05, max_recipients=None,
+                    workers=None, max_workers=4, clock=time.time,
+                    registry=None):
+        self.clickatell = clickatell
+        self.registry = registry
+        self.deadline = deadline
+        self.max_recipients = max_recipients or clickatell.max_recipients
+        self.workers = workers or WorkerPool(size=max_workers)
+        clickatell.ensure_connections(self.workers.size)
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.groups = OrderedDict()
+        self.thread = None
+        self.stopped = False
+
+    def key_for(self, options):
+        return tuple(sorted((name, repr(value))
+                            for name, value in options.items()))
+
+    def sendmsg(self, **options):
+        """
+        Queue a sendmsg, takes the same options as Clickatell.sendmsg.
+        Recipients are validated before the send joins a group, a call
+        with an invalid one gets a Future with a ClickatellError.
+        """
+        to, bad = validator.validate_recipients(options.pop('recipients'))
+        if bad or not to:
+            future = Future()
+            try:
+                raise ClickatellError, 'Invalid recipients at indices %s' % \
+                                        bad if bad else 'No recipients'
+            except ClickatellError:
+                future.set_exception(sys.exc_info())
+            return future
+        recipients = to.split(',')
+        key = self.key_for(options)
+        with self.condition:
+            if self.thread is None:
+                self.start()
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = Group(options,
+                                            self.clock() + self.deadline)
+                self.condition.notify()
+            future = group.add(recipients)
+            if len(group.recipients) >= self.max_recipients:
+                self.submit(self.groups.pop(key))
+        return future
+
+    def send(self, group):
+        try:
+            if self.registry is None:
+                responses = self.clickatell.sendmsg(
+                                recipients=group.recipients, **group.options)
+            else:
+                options = dict(group.options)
+                batch = self.registry.batch(template=options.pop('text'),
+                                            **options)
+                responses = batch.quicksend(recipients=group.recipients)
+            group.resolve(responses)
+        except PartialSendError, error:
+            group.resolve_partial(error)
+        except Exception:
+            group.fail(sys.exc_info())
+
+    def submit(self, group):
+        self.workers.submit(self.send, group)
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Submit every group once its deadline has passed
+        """
+        with self.condition:
+            while not self.stopped:
+                if not self.groups:
+                    self.condition.wait()
+                    continue
+                key, group = next(self.groups.iteritems())
+                delay = group.deadline - self.clock()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self.submit(self.groups.pop(key))
+
+    def flush(self):
+        """
+        Submit all waiting groups straight away
+        """
+        with self.condition:
+            groups, self.groups = self.groups.values(), OrderedDict()
+        for group in groups:
+            self.submit(group)
+
+    def close(self):
+        """
+        Send all waiting groups and stop the deadline thread
+        """
+        self.flush()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -22,6 +22,12 @@ NO = 0
 YES = 1
 
 
+"""
+The character set of the text, Clickatell assumes ISO-8859-1 without one
+"""
+CHARSET_UTF8 = 'UTF-8'
+
+
 """
 This parameter specifies the features that must be present in order for 
 message delivery to occur. If all features are not present, the message will 
@@ -85,4 +91,27 @@ SMS_NOKIA_RTTL = "SMS_NOKIA_RTTL"
 SMS_NOKIA_CLEAN = "SMS_NOKIA_CLEAN"
 SMS_NOKIA_VCARD = "SMS_NOKIA_VCARD"
 SMS_NOKIA_VCAL = "SMS_NOKIA_VCAL"
-SMS_DEFAULT = SMS_TEXT
\ No newline at end of file
+SMS_DEFAULT = SMS_TEXT
+
+"""
+The status codes querymsg and getmsgcharge return for a message. Messages
+in one of the FINAL_STATUSES won't change status anymore.
+"""
+STATUS_UNKNOWN = '001'
+STATUS_QUEUED = '002'
+STATUS_DELIVERED_TO_GATEWAY = '003'
+STATUS_RECEIVED = '004'
+STATUS_MESSAGE_ERROR = '005'
+STATUS_CANCELLED = '006'
+STATUS_DELIVERY_ERROR = '007'
+STATUS_OK = '008'
+STATUS_ROUTING_ERROR = '009'
+STATUS_EXPIRED = '010'
+STATUS_DELAYED = '011'
+STATUS_OUT_OF_CREDIT = '012'
+STATUS_MAX_MT_EXCEEDED = '014'
+
+FINAL_STATUSES = (STATUS_RECEIVED, STATUS_MESSAGE_ERROR, STATUS_CANCELLED,
+                    STATUS_DELIVERY_ERROR, STATUS_ROUTING_ERROR, 
+                    STATUS_EXPIRED, STATUS_OUT_OF_CREDIT, 
+                    STATUS_MAX_MT_EXCEEDED)
@@ -0,0 +1,162 @@
+import time
+import threading
+from collections import OrderedDict
+from clickatell.futures import Pipeline
+from clickatell.errors import ClickatellError
+from clickatell.response import OKResponse, ERRResponse
+
+# marks a node of the trie that has an answer for its prefix
+END = ''
+
+def cacheable(resp):
+    """
+    Only real coverage answers are cached, Clickatell's "not supported"
+    answer is an error without a code.
+    """
+    return isinstance(resp, OKResponse) or \
+            (isinstance(resp, ERRResponse) and resp.code == 0)
+
+
+class CoverageCache(object):
+    """
+    Caches routeCoverage answers by MSISDN prefix, coverage and charge are
+    decided by the country code and network prefix of a number.
+
+    Answers are kept in a trie of digits and looked up by the longest
+    prefix of a number that has one. Answers from Clickatell are stored
+    for the first `prefix_length` digits of the number that was checked,
+    `add()` stores one for any prefix, like a whole country code. They
+    expire after `ttl` seconds and at most `maxsize` are kept, the least
+    recently used ones are dropped first.
+    """
+
+    def __init__(self, clickatell, prefix_length=5, ttl=24 * 60 * 60,
+                    maxsize=10000, max_in_flight=10, clock=time.time):
+        self.clickatell = clickatell
+        self.prefix_length = prefix_length
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_in_flight = max_in_flight
+        clickatell.ensure_connections(max_in_flight)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.trie = {}
+        # prefix -> (response, expires) in least recently used order
+        self.answers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prefix_for(self, msisdn):
+        return str(msisdn).lstrip('+')[:self.prefix_length]
+
+    def add(self, prefix, resp):
+        """
+        Store the coverage answer for every number starting with `prefix`
+        """
+        with self.lock:
+            node = self.trie
+            for digit in prefix:
+                node = node.setdefault(digit, {})
+            node[END] = True
+            self.answers.pop(prefix, None)
+            self.answers[prefix] = (resp, self.clock() + self.ttl)
+            while len(self.answers) > self.maxsize:
+                self.remove(self.answers.popitem(last=False)[0])
+
+    def remove(self, prefix):
+        """
+        Take a prefix out of the trie, pruning the nodes left empty
+        """
+        path = [(None, self.trie)]
+        for digit in prefix:
+            node = path[-1][1].get(digit)
+            if node is None:
+                return
+            path.append((digit, node))
+        path[-1][1].pop(END, None)
+        while len(path) > 1 and not path[-1][1]:
+            digit, node = path.pop()
+            del path[-1][1][digit]
+
+    def lookup(self, msisdn):
+        """
+        Returns the cached answer for an MSISDN, or None
+        """
+        msisdn = str(msisdn).lstrip('+')
+        with self.lock:
+            node, found = self.trie, None
+            for length, digit in enumerate(msisdn):
+                node = node.get(digit)
+                if node is None:
+                    break
+                if END in node:
+                    found = msisdn[:length + 1]
+            if found is not None:
+                resp, expires = self.answers.pop(found)
+                if expires > self.clock():
+                    self.answers[found] = (resp, expires)
+                    self.hits += 1
+                    return resp
+                self.remove(found)
+            self.misses += 1
+
+    def check_coverage(self, msisdn):
+        """
+        Like Clickatell.check_coverage, but answered from the cache when
+        another number with the same prefix was checked before.
+        """
+        resp = self.lookup(msisdn)
+        if resp is None:
+            resp = self.clickatell.check_coverage(msisdn)
+            if cacheable(resp):
+                self.add(self.prefix_for(msisdn), resp)
+        return resp
+
+    def check_coverage_many(self, msisdns):
+        """
+        Returns a dict with the coverage answer for every MSISDN. Only one
+        number per unknown prefix is checked with Clickatell, at most
+        `max_in_flight` at a time. If a check raised its exception is
+        raised once all checks are done, the answers of the others are
+        cached by then.
+        """
+        answers, unknown = {}, OrderedDict()
+        for msisdn in msisdns:
+            resp = self.lookup(msisdn)
+            if resp is None:
+                unknown.setdefault(self.prefix_for(msisdn), []).append(msisdn)
+            else:
+                answers[msisdn] = resp
+        groups = unknown.values()
+        errors = []
+        for index, resp, error in Pipeline(self.clickatell.check_coverage,
+                                            [group[0] for group in groups],
+                                            self.max_in_flight):
+            if error is not None:
+                errors.append(error)
+                continue
+            if cacheable(resp):
+                self.add(self.prefix_for(groups[index][0]), resp)
+            for msisdn in groups[index]:
+                answers[msisdn] = resp
+        if errors:
+            raise errors[0]
+        return answers
+
+    def filter(self, recipients):
+        """
+        Split recipients in the ones with coverage and the ones without,
+        to drop the numbers a sendmsg would fail for. Raises the error of
+        a check that failed or got an error other than "not supported".
+        """
+        answers = self.check_coverage_many(recipients)
+        covered, uncovered = [], []
+        for msisdn in recipients:
+            resp = answers[msisdn]
+            if not cacheable(resp):
+                raise ClickatellError, resp
+            if isinstance(resp, OKResponse):
+                covered.append(msisdn)
+            else:
+                uncovered.append(msisdn)
+        return covered, uncovered
@@ -1 +1,19 @@
+import socket
+
 class ClickatellError(Exception): pass
+class CircuitOpenError(ClickatellError): pass
+class PoolTimeoutError(ClickatellError): pass
+
+class PartialSendError(ClickatellError):
+    """
+    Some of the requests a send was split into failed. `results` has the
+    responses of every request in the order of the `to` values, None for
+    the failed ones, and `errors` a (to, exception) tuple for each of those.
+    """
+    def __init__(self, message, results, errors):
+        ClickatellError.__init__(self, message)
+        self.results = results
+        self.errors = errors
+
+# connecting failed, the request was never sent
+class ConnectError(socket.error): pass
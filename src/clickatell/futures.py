@@ -0,0 +1,216 @@
+import sys
+import logging
+import threading
+from Queue import Queue
+
+class Future(object):
+    """
+    The result of a call that is running in the background. Calling
+    result() blocks until it is available and re-raises any exception
+    the call raised.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.isSet()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logging.exception('Exception in Future callback %s' % callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """
+        Store the exception, `exc_info` is the tuple returned by
+        sys.exc_info() so the original traceback is preserved.
+        """
+        self._exc_info = exc_info
+        self._finish()
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for result')
+        if self._exc_info:
+            return self._exc_info[1]
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for result')
+        if self._exc_info:
+            exc_type, exc_value, tb = self._exc_info
+            raise exc_type, exc_value, tb
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback` with the future as its only argument once it is
+        done, or straight away if it already is.
+        """
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        self._run_callback(callback)
+
+
+class WorkerPool(object):
+    """
+    A fixed size pool of daemon threads that run submitted calls and
+    resolve the Future returned for each of them.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            future, fn, args, kwargs = task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule `fn(*args, **kwargs)` to be run and return a Future
+        """
+        if len(self.threads) < self.size:
+            self.start()
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def map(self, fn, iterable):
+        """
+        Run `fn` for every item concurrently and return the results in the
+        order of the items.
+        """
+        futures = [self.submit(fn, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self.lock.acquire()
+        try:
+            threads, self.threads = self.threads, []
+        finally:
+            self.lock.release()
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class Pipeline(object):
+    """
+    Calls `fn` for every item of an iterable with at most `max_in_flight`
+    calls running at a time, iterating over it yields (index, result,
+    error) tuples as the calls complete. The error is None for calls that
+    succeeded, for calls that raised it is the exception and the result
+    is None.
+
+    Items are only pulled from the iterable when there's room for another
+    call, and no more calls are started while the results aren't being
+    consumed, so memory stays bounded however long the iterable is. The
+    counters can be read from any thread to report progress. Callers
+    sending requests need a connection pool as large as `max_in_flight`,
+    see Clickatell.ensure_connections.
+    """
+
+    def __init__(self, fn, iterable, max_in_flight=10):
+        self.fn = fn
+        self.iterable = iterable
+        self.max_in_flight = max_in_flight
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def in_flight(self):
+        return self.submitted - self.completed
+
+    def collect(self, queue):
+        index, future = queue.get()
+        self.completed += 1
+        exception = future.exception()
+        if exception is not None:
+            self.failed += 1
+            return index, None, exception
+        return index, future.result(), None
+
+    def __iter__(self):
+        pool = WorkerPool(size=self.max_in_flight)
+        queue = Queue()
+        try:
+            for index, item in enumerate(self.iterable):
+                while self.in_flight >= self.max_in_flight:
+                    yield self.collect(queue)
+                future = pool.submit(self.fn, item)
+                future.add_done_callback(
+                    lambda future, index=index: queue.put((index, future)))
+                self.submitted += 1
+            while self.in_flight:
+                yield self.collect(queue)
+        finally:
+            pool.shutdown(wait=False)
+
+
+def as_completed(futures):
+    """
+    Yield the given futures as they complete.
+    """
+    queue = Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(queue.put)
+    for i in range(len(futures)):
+        yield queue.get()
+
+def wait(futures):
+    """
+    Block until all futures are done, returns their results in order.
+    """
+    return [future.result() for future in futures]
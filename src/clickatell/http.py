@@ -1,22 +1,102 @@
 from clickatell import url as urllib
 import logging
 
+def tokenize_lines(lines):
+    """
+    Yields a (kind, payload) tuple for every line, skipping blank lines. 
+    Lines without a colon have an empty payload.
+    """
+    for line in lines:
+        kind, colon, payload = line.partition(':')
+        kind = kind.strip()
+        if colon or kind:
+            yield kind, payload.strip()
+
+def tokenize(content):
+    return tokenize_lines(content.split('\n'))
+
+def iter_lines(response, chunk_size=8192):
+    """
+    Yields the lines of a response body as they are read from the socket.
+    The response is closed when done, or when the generator is discarded 
+    before the body has been read completely.
+    """
+    pending = ''
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+    finally:
+        response.close()
+
+class LineStream(object):
+    """
+    Iterates over the parsed lines of a response as they're read. The 
+    response is closed once it has been read, by `close()`, or when the 
+    stream is dropped before it was read completely, so its connection 
+    is never held on to.
+    """
+    
+    def __init__(self, response):
+        self.response = response
+        self.lines = tokenize_lines(iter_lines(response))
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        return self.lines.next()
+    
+    def close(self):
+        self.lines.close()
+        self.response.close()
+    
+    def __del__(self):
+        self.close()
+
 class HttpClient(object):
     
+    # the transport requests are sent through, see clickatell.url.Transport
+    transport = urllib.url_dispatcher
+    
+    def ensure_connections(self, size):
+        """
+        Allow at least `size` requests through the transport at a time
+        """
+        self.transport.ensure(size)
+    
     def parse_line(self, line):
-        return map(lambda s: s.strip(), line.split(":", 1))
+        kind, colon, payload = line.partition(':')
+        return kind.strip(), payload.strip()
     
     def parse_content(self, content):
-        return [self.parse_line(line.strip())
-                for line in content.split('\n')
-                if line.strip()]
+        return list(tokenize(content))
     
     def open(self, method, url, data, headers):
-        request, response = urllib.open(method, url, data, headers)
-        content = response.read()
+        request, response = self.transport.open(method, url, data, headers)
+        try:
+            content = response.read()
+        except Exception:
+            response.close()
+            raise
         logging.debug('Received: %s' % content)
         return self.parse_content(content)
     
+    def stream(self, method, url, data={}, headers={}):
+        """
+        Send the request and return a generator of parsed lines, which are
+        parsed as the body is read from the socket.
+        """
+        request, response = self.transport.open(method, url, data, headers)
+        return LineStream(response)
+    
     def get(self, url, data={}, headers={}):
         return self.open('get', url, data, headers)
     
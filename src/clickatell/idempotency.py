@@ -0,0 +1,221 @@
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+PENDING = 'pending'
+SENT = 'sent'
+# the request of a pending id raised, it may or may not have been accepted
+UNKNOWN = 'unknown'
+
+def climsgid_for(params, key=None):
+    """
+    Returns a deterministic client message id for the request parameters,
+    the same message to the same recipients always gets the same id. Pass
+    a `key` to tell apart messages that are meant to be sent more than once.
+    """
+    def update(line):
+        # unicode values are sent as UTF-8, hash them the same way
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        digest.update(line)
+    digest = hashlib.sha1()
+    for name, value in sorted(params.items()):
+        if name != 'session_id':
+            update('%s=%s\n' % (name, value))
+    if key is not None:
+        update('key=%s\n' % key)
+    # Clickatell accepts client message ids of up to 32 characters
+    return digest.hexdigest()[:32]
+
+def to_pairs(responses):
+    """
+    Returns the (kind, payload) pairs the responses were parsed from
+    """
+    if hasattr(responses, 'kinds'):
+        return zip(responses.kinds, responses.payloads)
+    return [(resp.__class__.__name__[:-len('Response')], resp.data)
+                for resp in responses]
+
+
+class DedupIndex(object):
+    """
+    An in-memory index of recently sent client message ids.
+
+    An id is claimed as pending before the request is made and marked as
+    sent, with the (kind, payload) pairs of the responses, once the gateway
+    accepted it, or as unknown if the request raised. Entries expire after
+    `ttl` seconds and the oldest entries are evicted once there are more
+    than `maxsize`. A pending id is taken to belong to a sender that died
+    once it is older than `pending_timeout` seconds.
+    """
+
+    def __init__(self, ttl=3600, maxsize=100000, clock=time.time,
+                    pending_timeout=300):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.pending_timeout = pending_timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def evict(self):
+        expired = self.clock() - self.ttl
+        while self.entries:
+            climsgid, (created, state, pairs) = next(self.entries.iteritems())
+            if created > expired and len(self.entries) <= self.maxsize:
+                break
+            del self.entries[climsgid]
+
+    def get(self, climsgid):
+        """
+        Returns a (state, pairs) tuple, (None, None) for unknown ids.
+        """
+        with self.lock:
+            self.evict()
+            created, state, pairs = self.entries.get(climsgid,
+                                                        (None, None, None))
+            return state, pairs
+
+    def claim(self, climsgid):
+        """
+        Mark an id as pending unless it is known already, in one step.
+        Returns the (state, pairs) of the known entry, or (None, None) if
+        the caller claimed it and should send it.
+        """
+        with self.lock:
+            self.evict()
+            if climsgid in self.entries:
+                created, state, pairs = self.entries[climsgid]
+                return state, pairs
+            self.entries[climsgid] = (self.clock(), PENDING, None)
+            return None, None
+
+    def takeover(self, climsgid):
+        """
+        Claim an id whose earlier attempt raised, or whose sender died,
+        returns whether the caller claimed it.
+        """
+        with self.lock:
+            created, state, pairs = self.entries.get(climsgid,
+                                                        (None, None, None))
+            if state == UNKNOWN or (state == PENDING and 
+                    created <= self.clock() - self.pending_timeout):
+                self.entries.pop(climsgid)
+                self.entries[climsgid] = (self.clock(), PENDING, None)
+                return True
+            return False
+
+    def set(self, climsgid, state, pairs=None):
+        with self.lock:
+            self.entries.pop(climsgid, None)
+            self.entries[climsgid] = (self.clock(), state, pairs)
+            self.evict()
+
+    def pending(self, climsgid):
+        self.set(climsgid, PENDING)
+
+    def sent(self, climsgid, pairs):
+        self.set(climsgid, SENT, pairs)
+
+    def unknown(self, climsgid):
+        self.set(climsgid, UNKNOWN)
+
+    def discard(self, climsgid):
+        with self.lock:
+            self.entries.pop(climsgid, None)
+
+
+class SQLiteDedupIndex(DedupIndex):
+    """
+    A DedupIndex kept in an SQLite database, so it survives restarts and
+    can be shared by processes on the same host.
+
+    Expired and surplus entries are deleted every `evict_every` writes
+    rather than on every write, there may be that many more than `maxsize`
+    entries in between.
+    """
+
+    def __init__(self, path, ttl=3600, maxsize=1000000, clock=time.time,
+                    pending_timeout=300, evict_every=1000):
+        super(SQLiteDedupIndex, self).__init__(ttl, maxsize, clock,
+                                                pending_timeout)
+        self.evict_every = evict_every
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS dedup ('
+                        'climsgid TEXT PRIMARY KEY, created REAL, '
+                        'state TEXT, pairs TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS dedup_created '
+                        'ON dedup (created)')
+
+    def written(self):
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        self.db.execute('DELETE FROM dedup WHERE created <= ?',
+                        (self.clock() - self.ttl,))
+        [count] = self.db.execute('SELECT COUNT(*) FROM dedup').fetchone()
+        if count > self.maxsize:
+            self.db.execute('DELETE FROM dedup WHERE climsgid IN ('
+                            'SELECT climsgid FROM dedup ORDER BY created '
+                            'LIMIT ?)', (count - self.maxsize,))
+
+    def select(self, climsgid):
+        row = self.db.execute('SELECT state, pairs FROM dedup '
+                                'WHERE climsgid = ? AND created > ?',
+                                (climsgid, self.clock() - self.ttl)
+                                ).fetchone()
+        if row is None:
+            return None, None
+        state, pairs = row
+        return str(state), pairs and [tuple(map(str, pair))
+                                        for pair in json.loads(pairs)]
+
+    def get(self, climsgid):
+        with self.lock:
+            return self.select(climsgid)
+
+    def claim(self, climsgid):
+        with self.lock:
+            # an immediate transaction locks out other processes too
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                state, pairs = self.select(climsgid)
+                if state is None:
+                    self.db.execute('INSERT OR REPLACE INTO dedup '
+                                    'VALUES (?, ?, ?, NULL)',
+                                    (climsgid, self.clock(), PENDING))
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            self.written()
+            return state, pairs
+
+    def takeover(self, climsgid):
+        with self.lock:
+            now = self.clock()
+            return self.db.execute('UPDATE dedup SET state = ?, created = ? '
+                                    'WHERE climsgid = ? AND (state = ? OR '
+                                    '(state = ? AND created <= ?))',
+                                    (PENDING, now, climsgid, UNKNOWN, PENDING,
+                                    now - self.pending_timeout)).rowcount == 1
+
+    def set(self, climsgid, state, pairs=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO dedup '
+                            'VALUES (?, ?, ?, ?)',
+                            (climsgid, self.clock(), state,
+                                pairs and json.dumps(pairs)))
+            self.written()
+
+    def discard(self, climsgid):
+        with self.lock:
+            self.db.execute('DELETE FROM dedup WHERE climsgid = ?',
+                            (climsgid,))
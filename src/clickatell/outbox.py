@@ -0,0 +1,458 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import urllib2
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from clickatell import url
+from clickatell.errors import ConnectError, PoolTimeoutError, \
+    CircuitOpenError
+from clickatell.idempotency import to_pairs, SQLiteDedupIndex
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+# a quicksend that may or may not have been sent, it is never retried
+UNKNOWN = 'unknown'
+
+def never_sent(error):
+    """
+    Whether an error was raised before the request went out
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return False
+    return isinstance(error, (ConnectError, PoolTimeoutError,
+                                CircuitOpenError, urllib2.URLError))
+
+time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode(value):
+    """
+    Convert job options & results into something JSON can hold. Dates,
+    durations and byte strings that aren't ASCII are tagged so they are
+    decoded to what they were.
+    """
+    if isinstance(value, dict):
+        return dict((key, encode(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, datetime):
+        return {'__datetime__': value.strftime(time_format)}
+    if isinstance(value, timedelta):
+        return {'__timedelta__': [value.days, value.seconds,
+                                    value.microseconds]}
+    if isinstance(value, str) and any(ord(char) > 127 for char in value):
+        return {'__bytes__': value.decode('iso-8859-1')}
+    return value
+
+def decode(value):
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.strptime(value['__datetime__'], time_format)
+        if '__timedelta__' in value:
+            return timedelta(*value['__timedelta__'])
+        if '__bytes__' in value:
+            return value['__bytes__'].encode('iso-8859-1')
+        return dict((str(key), decode(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    return value
+
+def dumps(value):
+    return json.dumps(encode(value))
+
+def loads(data):
+    # str() of the BLOBs older versions wrote, dumps only writes ASCII
+    return decode(json.loads(str(data)))
+
+
+class Job(object):
+    """
+    A sendmsg or quicksend job in the outbox, `result` holds the (kind,
+    payload) pairs of the responses once it is done. `started` is when a
+    worker began sending a quicksend job.
+    """
+
+    __slots__ = ('id', 'kind', 'options', 'state', 'attempts', 'result',
+                    'started')
+
+    def __init__(self, id, kind, options, state=QUEUED, attempts=0,
+                    result=None, started=None):
+        self.id = id
+        self.kind = kind
+        self.options = options
+        self.state = state
+        self.attempts = attempts
+        self.result = result
+        self.started = started
+
+    def __repr__(self):
+        return 'Job %s: %s %s' % (self.id, self.kind, self.state)
+
+    def apimsgids(self):
+        return [payload.split(' ')[0] for kind, payload in self.result or []
+                    if kind == 'ID']
+
+
+class Outbox(object):
+    """
+    A durable queue of outgoing messages in an SQLite database.
+
+    A job is on disk once `sendmsg` or `quicksend` returns. Jobs added by
+    concurrent threads are written in a single transaction, so they share
+    the cost of syncing to disk. Workers lease jobs for `lease_time`
+    seconds, jobs of a worker that crashed are leased again once that
+    time has passed.
+    """
+
+    def __init__(self, path, max_attempts=5, timeout=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                    check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'kind TEXT, options BLOB, state TEXT, '
+                        'attempts INTEGER DEFAULT 0, owner TEXT, '
+                        'lease_expires REAL, result BLOB, started REAL)')
+        columns = [row[1] for row in 
+                    self.db.execute('PRAGMA table_info(outbox)')]
+        if 'started' not in columns:
+            self.db.execute('ALTER TABLE outbox ADD COLUMN started REAL')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_state '
+                        'ON outbox (state, id)')
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.flushing = False
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def put_many(self, jobs):
+        """
+        Add a list of (kind, options) jobs in a single transaction, returns
+        their ids.
+        """
+        with self.transaction() as db:
+            return [db.execute('INSERT INTO outbox (kind, options, state) '
+                                'VALUES (?, ?, ?)', (kind, dumps(options),
+                                QUEUED)).lastrowid
+                    for kind, options in jobs]
+
+    def put(self, kind, options):
+        """
+        Add a job and return its id once it has been written to disk. The
+        first caller writes the jobs of every caller waiting behind it.
+        """
+        entry = {'job': (kind, options)}
+        with self.condition:
+            self.pending.append(entry)
+            while 'id' not in entry and 'error' not in entry:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+                self.flushing = True
+                entries, self.pending = self.pending, []
+                self.condition.release()
+                try:
+                    ids = self.put_many([e['job'] for e in entries])
+                    for e, id in zip(entries, ids):
+                        e['id'] = id
+                except Exception, error:
+                    for e in entries:
+                        e['error'] = error
+                finally:
+                    self.condition.acquire()
+                    self.flushing = False
+                    self.condition.notifyAll()
+        if 'error' in entry:
+            raise entry['error']
+        return entry['id']
+
+    def sendmsg(self, **options):
+        """
+        Queue a Clickatell.sendmsg call with the given options
+        """
+        return self.put('sendmsg', options)
+
+    def quicksend(self, batch={}, **options):
+        """
+        Queue a quicksend to a new batch started with the `batch` options
+        """
+        return self.put('quicksend', dict(options, batch=batch))
+
+    def lease(self, owner, limit=10, lease_time=60):
+        """
+        Lease at most `limit` queued jobs, or jobs whose lease expired.
+        Jobs whose options don't parse, like the pickled options of older
+        versions, are marked as failed.
+        """
+        now = time.time()
+        jobs, broken = [], []
+        with self.transaction() as db:
+            rows = db.execute('SELECT id, kind, options, attempts, started '
+                                'FROM outbox WHERE state = ? OR '
+                                '(state = ? AND lease_expires < ?) '
+                                'ORDER BY id LIMIT ?',
+                                (QUEUED, LEASED, now, limit)).fetchall()
+            for id, kind, options, attempts, started in rows:
+                try:
+                    jobs.append(Job(id, str(kind), loads(options), LEASED,
+                                    attempts, started=started))
+                except ValueError:
+                    logging.error('Options of job %s do not parse' % id)
+                    broken.append(id)
+            db.executemany('UPDATE outbox SET state = ?, owner = ?, '
+                            'lease_expires = ? WHERE id = ?',
+                            [(LEASED, owner, now + lease_time, job.id)
+                                for job in jobs])
+            db.executemany('UPDATE outbox SET state = ? WHERE id = ?',
+                            [(FAILED, id) for id in broken])
+        return jobs
+
+    def renew(self, owner, jobs, lease_time=60):
+        """
+        Extend the lease of jobs, returns the ids of the ones that are
+        still leased by `owner`.
+        """
+        expires = time.time() + lease_time
+        renewed = set()
+        with self.transaction() as db:
+            for job in jobs:
+                if db.execute('UPDATE outbox SET lease_expires = ? '
+                                'WHERE id = ? AND owner = ? AND state = ?',
+                                (expires, job.id, owner, LEASED)).rowcount:
+                    renewed.add(job.id)
+        return renewed
+
+    def start(self, job):
+        """
+        Record that sending a job began, on disk before it is sent
+        """
+        job.started = time.time()
+        with self.transaction() as db:
+            db.execute('UPDATE outbox SET started = ? WHERE id = ?',
+                        (job.started, job.id))
+
+    def unknown(self, job):
+        """
+        Set aside a job that may have been sent, for manual reconciliation
+        """
+        job.state = UNKNOWN
+        with self.transaction() as db:
+            db.execute('UPDATE outbox SET state = ?, owner = NULL '
+                        'WHERE id = ?', (UNKNOWN, job.id))
+
+    def complete(self, jobs):
+        """
+        Checkpoint the results of jobs that have been sent
+        """
+        with self.transaction() as db:
+            db.executemany('UPDATE outbox SET state = ?, result = ?, '
+                            'owner = NULL WHERE id = ?',
+                            [(DONE, dumps(job.result), job.id)
+                                for job in jobs])
+
+    def fail(self, job):
+        """
+        Queue a job that failed again, or mark it as failed once it has
+        been attempted `max_attempts` times. Only for jobs that weren't
+        sent, a quicksend job is safe to send again after this.
+        """
+        job.attempts += 1
+        job.started = None
+        if job.attempts >= self.max_attempts:
+            job.state = FAILED
+        else:
+            job.state = QUEUED
+        with self.transaction() as db:
+            db.execute('UPDATE outbox SET state = ?, attempts = ?, '
+                        'owner = NULL, started = NULL WHERE id = ?',
+                        (job.state, job.attempts, job.id))
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute('SELECT id, kind, options, state, '
+                                    'attempts, result, started FROM outbox '
+                                    'WHERE id = ?', (job_id,)).fetchone()
+        if row:
+            id, kind, options, state, attempts, result, started = row
+            return Job(id, str(kind), loads(options), str(state), attempts,
+                        result and [tuple(pair) for pair in loads(result)],
+                        started)
+
+    def counts(self):
+        """
+        Returns the number of jobs in every state
+        """
+        with self.lock:
+            return dict((str(state), count) for state, count in
+                        self.db.execute('SELECT state, COUNT(*) FROM outbox '
+                                        'GROUP BY state'))
+
+    def close(self):
+        self.db.close()
+
+
+class OutboxWorker(object):
+    """
+    Sends the jobs in an outbox with the Clickatell instance returned by
+    `clickatell_factory`, and checkpoints their responses.
+
+    Messages get a climsgid derived from their job id, which is kept in a
+    dedup index in the outbox database. A sendmsg job that was sent by a
+    worker that crashed before checkpointing it is reconciled with
+    querymsg instead of being sent again.
+
+    Quicksend messages share their batch's climsgid and can't be
+    reconciled that way. A quicksend job is marked as started on disk
+    before it is sent, if it comes back from a crashed worker or fails
+    after the request may have gone out it is set aside as `unknown`
+    instead of being sent again.
+
+    The leases of a worker's jobs are renewed before every job it sends,
+    so `lease_time` only has to cover sending a single job.
+    """
+
+    def __init__(self, path, clickatell_factory, owner=None, batch_size=10,
+                    lease_time=60, poll_interval=0.5):
+        self.path = path
+        self.clickatell_factory = clickatell_factory
+        self.owner = owner
+        self.batch_size = batch_size
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+
+    def send(self, clickatell, job, outbox=None):
+        options = dict(job.options)
+        if job.kind == 'quicksend':
+            batch = clickatell.batch(**options.pop('batch'))
+            batch.batch_id = batch.start()
+            if outbox is not None:
+                outbox.start(job)
+            responses = batch.quicksend(**options)
+            try:
+                batch.end(batch.batch_id)
+            except Exception, e:
+                # the messages were sent, the batch expires by itself
+                logging.warning('Ending batch %s failed: %s' % (
+                                    batch.batch_id, e))
+            return responses
+        return clickatell.sendmsg(idempotency_key='outbox-%s' % job.id,
+                                    **options)
+
+    def run(self, stopped=None, until_empty=False):
+        """
+        Send jobs until `stopped` is set, or until the outbox is empty.
+        """
+        owner = self.owner or '%s:%s' % (socket.gethostname(), os.getpid())
+        outbox = Outbox(self.path)
+        clickatell = self.clickatell_factory()
+        if clickatell.dedup_index is None:
+            clickatell.dedup_index = SQLiteDedupIndex(self.path)
+        try:
+            while not (stopped and stopped.is_set()):
+                jobs = outbox.lease(owner, self.batch_size,
+                                    self.lease_time)
+                if not jobs:
+                    if until_empty:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                done = []
+                for job in jobs:
+                    if job.id not in outbox.renew(owner, jobs,
+                                                    self.lease_time):
+                        logging.warning('Lease of %r expired' % job)
+                        continue
+                    if job.kind == 'quicksend' and job.started:
+                        logging.error('%r may have been sent already, not '
+                                        'sending it again' % job)
+                        outbox.unknown(job)
+                        continue
+                    try:
+                        job.result = to_pairs(self.send(clickatell, job,
+                                                        outbox))
+                        done.append(job)
+                    except Exception, e:
+                        logging.exception('Sending %r failed' % job)
+                        if job.kind == 'quicksend' and job.started and \
+                            not never_sent(e):
+                            outbox.unknown(job)
+                        else:
+                            outbox.fail(job)
+                outbox.complete(done)
+        finally:
+            outbox.close()
+
+
+def run_worker(worker, stopped, until_empty):
+    # keep-alive connections inherited from the parent are shared with it
+    url.pool.reset()
+    worker.run(stopped, until_empty)
+
+class SenderPool(object):
+    """
+    Drains an outbox with `processes` worker processes, each with its
+    own Clickatell instance and session.
+    """
+
+    def __init__(self, path, clickatell_factory, processes=4, **options):
+        self.path = path
+        self.clickatell_factory = clickatell_factory
+        self.processes = processes
+        self.options = options
+        self.stopped = multiprocessing.Event()
+        self.workers = []
+
+    def start(self, until_empty=False):
+        # make sure the database exists before the workers race to create it
+        Outbox(self.path).close()
+        self.stopped.clear()
+        for i in range(self.processes):
+            worker = OutboxWorker(self.path, self.clickatell_factory,
+                                    **self.options)
+            process = multiprocessing.Process(target=run_worker,
+                                    args=(worker, self.stopped, until_empty))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+        return self
+
+    def join(self):
+        for process in self.workers:
+            process.join()
+        self.workers = []
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def drain(self):
+        """
+        Send all queued jobs and return once the outbox is empty
+        """
+        self.start(until_empty=True)
+        self.join()
@@ -0,0 +1,269 @@
+import os
+import re
+import heapq
+import pickle
+import shutil
+import tempfile
+import itertools
+from array import array
+from clickatell import constants as cc
+from clickatell.validators import validator
+from clickatell.errors import PartialSendError
+
+template_field_pattern = re.compile(r'#(field[0-9]+)#')
+
+def as_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+def is_ascii(value):
+    if isinstance(value, basestring):
+        return not any(ord(char) > 127 for char in value)
+    return True
+
+def render(template, fields):
+    """
+    Fill in the #field1# .. #fieldN# placeholders of a batch template,
+    returns unicode. Byte strings are taken to be UTF-8.
+    """
+    return template_field_pattern.sub(
+                lambda match: as_unicode(fields.get(match.group(1), u'')),
+                as_unicode(template))
+
+def ceil_div(a, b):
+    return -(-a // b)
+
+
+class Step(object):
+    """
+    A request shape in a plan: a `sendmsg` or `quicksend` to a list of
+    recipients or `senditem`s with a list of contexts. `options` hold the
+    text, or the template for batch steps, and the other sendmsg options.
+    """
+
+    __slots__ = ('kind', 'options', 'items')
+
+    def __init__(self, kind, options, items):
+        self.kind = kind
+        self.options = options
+        self.items = items
+
+    def __repr__(self):
+        return 'Step: %s to %s' % (self.kind, len(self.items))
+
+
+class Plan(object):
+    """
+    The request shapes for a job, the number of requests it takes is known
+    before anything is sent. Steps are generated lazily from the sorted
+    rows so a plan never has to fit in memory.
+    """
+
+    def __init__(self, planner, source, directory=None):
+        self.planner = planner
+        self.source = source
+        self.directory = directory
+        # the shape of every group, in the order of the sorted rows
+        self.sizes = array('l')
+        self.shapes = []
+        self.requests = {'sendmsg': 0, 'quicksend': 0, 'senditem': 0,
+                            'startbatch': 0, 'endbatch': 0}
+        self.messages = 0
+        for key, rows in self.groups():
+            size = sum(1 for row in rows)
+            shape, counts = planner.shape(key, size)
+            self.sizes.append(size)
+            self.shapes.append(shape)
+            for kind, count in counts.items():
+                self.requests[kind] += count
+            self.messages += size
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def groups(self):
+        return itertools.groupby(self.source(), lambda row: row[0])
+
+    def steps(self):
+        """
+        Yields the steps of the plan, consecutive batch steps with the same
+        options share a batch.
+        """
+        chunk_size = self.planner.max_recipients
+        for (key, rows), shape in itertools.izip(self.groups(), self.shapes):
+            kind, body, options = key
+            options = dict(options)
+            if shape == 'sendmsg' and kind == 'template':
+                # every row gets its own text
+                for (row_key, msisdn, fields) in rows:
+                    yield Step('sendmsg', dict(options,
+                                    text=render(body, dict(fields))),
+                                    [msisdn])
+                continue
+            if kind == 'template':
+                options['template'] = body
+                items = (dict(fields, to=msisdn)
+                            for (row_key, msisdn, fields) in rows)
+            else:
+                options['text' if shape == 'sendmsg' else 'template'] = body
+                items = (msisdn for (row_key, msisdn, fields) in rows)
+            while True:
+                chunk = list(itertools.islice(items, chunk_size))
+                if not chunk:
+                    break
+                yield Step(shape, options, chunk)
+
+    def execute(self, clickatell, registry=None, max_in_flight=10):
+        """
+        Send the plan, yields a (step, responses) tuple for every step with
+        a response for every recipient or context. With a BatchRegistry
+        batches are shared with other jobs instead of started & ended.
+        If some items of a senditem step fail a PartialSendError with the
+        responses of the others is raised.
+        """
+        batch, batch_options = None, None
+        try:
+            for step in self.steps():
+                if step.kind == 'sendmsg':
+                    options = dict(step.options)
+                    yield step, clickatell.sendmsg(recipients=step.items,
+                                                    **options)
+                    continue
+                if batch is None or batch_options != step.options:
+                    if batch is not None and registry is None:
+                        batch.end(batch.batch_id)
+                    batch_options = step.options
+                    if registry is not None:
+                        batch = registry.batch(**dict(step.options))
+                    else:
+                        batch = clickatell.batch(**dict(step.options))
+                        batch.batch_id = batch.start()
+                if step.kind == 'quicksend':
+                    yield step, batch.quicksend(recipients=step.items)
+                else:
+                    responses, errors = [None] * len(step.items), []
+                    for index, resp, error in batch.sendmany(step.items,
+                                                            max_in_flight):
+                        responses[index] = resp
+                        if error is not None:
+                            errors.append((step.items[index]['to'], error))
+                    if errors:
+                        raise PartialSendError('%s of %s items failed' % (
+                                                len(errors), len(step.items)),
+                                                responses, errors)
+                    yield step, responses
+        finally:
+            if batch is not None and registry is None:
+                batch.end(batch.batch_id)
+
+    def close(self):
+        """
+        Remove the sorted runs of an external sort
+        """
+        if self.directory:
+            shutil.rmtree(self.directory)
+            self.directory = None
+
+
+class Planner(object):
+    """
+    Plans a bulk job of (msisdn, text, options) rows into as few requests
+    as possible.
+
+    Rows with the same text & options are sent together, rows with a
+    `template` and `field1` .. `fieldN` in their options only differ in
+    their fields. A batch costs `batch_overhead` extra requests for its
+    startbatch & endbatch, use 0 if batches are shared through a
+    BatchRegistry. Batches are only used when `batch_overhead` is 0, then
+    they take as many requests as sendmsg does and their requests are
+    smaller.
+
+    Rows are validated with the sendmsg `defaults` of the Clickatell
+    instance the plan is sent with, rows with non-ASCII texts, templates
+    or fields are sent with `charset=UTF-8`.
+
+    With a `run_size` the rows are sorted on disk in runs of that many
+    rows, for jobs that don't fit in memory.
+    """
+
+    def __init__(self, max_recipients=100, batch_overhead=2, run_size=None,
+                    tempdir=None, defaults={}):
+        self.max_recipients = max_recipients
+        self.batch_overhead = batch_overhead
+        self.run_size = run_size
+        self.tempdir = tempdir
+        self.compiled_defaults = validator.compile_defaults(defaults)
+
+    def row_for(self, msisdn, text, options):
+        """
+        Returns a sortable (key, msisdn, fields) row, rows with the same
+        key can be sent together.
+        """
+        options = dict(options)
+        template = options.pop('template', None)
+        fields = tuple(sorted((name, options.pop(name)) for name in
+                                options.keys() if name.startswith('field')))
+        if 'charset' not in options and not all(is_ascii(value) for value in
+                [text, template] + [value for name, value in fields]):
+            # bodies & fields are rendered as unicode and sent as UTF-8
+            options['charset'] = cc.CHARSET_UTF8
+        # fail early on invalid options, they're validated again when sent
+        validator.validate_with_defaults(dict(options),
+                                            self.compiled_defaults)
+        options = tuple(sorted(options.items()))
+        if template is not None:
+            return ('template', template, options), msisdn, fields
+        return ('text', text, options), msisdn, ()
+
+    def shape(self, key, size):
+        """
+        Returns the kind of step for a group of rows and the number of
+        requests of every kind it takes.
+        """
+        kind, body, options = key
+        if kind == 'template':
+            if self.batch_overhead == 0:
+                return 'senditem', {'senditem': size}
+            return 'sendmsg', {'sendmsg': size}
+        chunks = ceil_div(size, self.max_recipients)
+        if size > 1 and self.batch_overhead == 0:
+            return 'quicksend', {'quicksend': chunks}
+        return 'sendmsg', {'sendmsg': chunks}
+
+    def plan(self, rows):
+        """
+        Returns the Plan for an iterable of (msisdn, text, options) rows
+        """
+        rows = (self.row_for(*row) for row in rows)
+        if not self.run_size:
+            rows = sorted(rows)
+            return Plan(self, lambda: iter(rows))
+        directory = tempfile.mkdtemp(dir=self.tempdir)
+        paths = []
+        while True:
+            run = sorted(itertools.islice(rows, self.run_size))
+            if not run:
+                break
+            path = os.path.join(directory, 'run-%s' % len(paths))
+            fp = open(path, 'wb')
+            try:
+                for row in run:
+                    pickle.dump(row, fp, 2)
+            finally:
+                fp.close()
+            paths.append(path)
+        return Plan(self, lambda: heapq.merge(*map(read_run, paths)),
+                    directory)
+
+def read_run(path):
+    fp = open(path, 'rb')
+    try:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                break
+    finally:
+        fp.close()
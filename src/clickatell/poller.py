@@ -0,0 +1,174 @@
+import time
+import heapq
+import logging
+import itertools
+from Queue import Queue, Empty
+from clickatell import constants as cc
+from clickatell.futures import WorkerPool
+from clickatell.response import IDResponse
+
+class Poll(object):
+    """
+    The polling state of a single message id
+    """
+
+    __slots__ = ('message_id', 'status', 'repeats', 'errors', 'polls')
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.status = None
+        self.repeats = 0
+        self.errors = 0
+        self.polls = 0
+
+
+class StatusPoller(object):
+    """
+    Polls the status of many messages with querymsg, running at most
+    `max_in_flight` queries at a time.
+
+    Every message is polled again after the delay for its last status in
+    `delays`, or `default_delay`, which grows by `backoff` for every poll
+    that returns the same status, up to `max_delay`. Messages drop out once
+    they reach one of the `final_statuses` or Clickatell returns an error
+    for them. Queries go through Clickatell.call, sharing the session and
+    the connection pool, and wait their turn in the QUEUE_LOW lane of the
+    client's governor if it has one. Status changes are saved in the
+    Clickatell instance's status store if it has one.
+    """
+
+    delays = {
+        cc.STATUS_UNKNOWN: 10,
+        cc.STATUS_QUEUED: 10,
+        cc.STATUS_OK: 10,
+        cc.STATUS_DELIVERED_TO_GATEWAY: 30,
+        cc.STATUS_DELAYED: 300,
+    }
+
+    def __init__(self, clickatell, max_in_flight=10, id_kind='apimsgid',
+                    delays=None, default_delay=30, backoff=2, max_delay=600,
+                    max_errors=3, final_statuses=cc.FINAL_STATUSES,
+                    clock=time.time, sleep=time.sleep):
+        self.clickatell = clickatell
+        self.max_in_flight = max_in_flight
+        clickatell.ensure_connections(max_in_flight)
+        self.id_kind = id_kind
+        if delays is not None:
+            self.delays = delays
+        self.default_delay = default_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_errors = max_errors
+        self.final_statuses = final_statuses
+        self.clock = clock
+        self.sleep = sleep
+
+    def delay(self, poll):
+        base = self.delays.get(poll.status, self.default_delay)
+        repeats = max(poll.repeats, poll.errors)
+        return min(self.max_delay, base * self.backoff ** repeats)
+
+    def query(self, message_id):
+        governor = self.clickatell.client.governor
+        if governor is not None:
+            governor.acquire(1, cc.QUEUE_LOW)
+        [resp] = self.clickatell.call('http', 'querymsg', {
+            self.id_kind: message_id,
+        })
+        return resp
+
+    def handle(self, poll, future):
+        """
+        Update the state of a poll with its outcome, returns a result to
+        yield, if any, and whether the message is done.
+        """
+        poll.polls += 1
+        exception = future.exception()
+        if exception is not None:
+            poll.errors += 1
+            logging.warning('Polling %s failed: %s' % (poll.message_id,
+                                                        exception))
+            if poll.errors >= self.max_errors:
+                return (poll.message_id, None, exception), True
+            return None, False
+        poll.errors = 0
+        resp = future.result()
+        if not isinstance(resp, IDResponse):
+            return (poll.message_id, None, resp), True
+        status = resp.extra.get('Status')
+        changed = status != poll.status
+        if changed:
+            poll.status, poll.repeats = status, 0
+        else:
+            poll.repeats += 1
+        done = status in self.final_statuses
+        if changed or done:
+            return (poll.message_id, status, resp), done
+        return None, False
+
+    def poll(self, message_ids, timeout=None):
+        """
+        Yields a (message_id, status, response) tuple every time the status
+        of a message changes, until all of them reached a final status or
+        `timeout` seconds passed. For errors the status is None and the
+        response is the ERRResponse or the exception raised.
+        """
+        pool = WorkerPool(size=self.max_in_flight)
+        completed = Queue()
+        counter = itertools.count()
+        now = self.clock()
+        deadline = timeout and now + timeout
+        due = [(now, next(counter), Poll(message_id))
+                for message_id in message_ids]
+        heapq.heapify(due)
+        in_flight = 0
+        try:
+            while due or in_flight:
+                now = self.clock()
+                if deadline and now >= deadline:
+                    break
+                while due and due[0][0] <= now and \
+                    in_flight < self.max_in_flight:
+                    when, count, poll = heapq.heappop(due)
+                    future = pool.submit(self.query, poll.message_id)
+                    future.add_done_callback(
+                        lambda future, poll=poll: completed.put((poll,
+                                                                future)))
+                    in_flight += 1
+                wait = None
+                if due and in_flight < self.max_in_flight:
+                    wait = max(0, due[0][0] - now)
+                if deadline:
+                    wait = min(wait, deadline - now) if wait is not None \
+                            else deadline - now
+                if not in_flight:
+                    self.sleep(wait)
+                    continue
+                try:
+                    poll, future = completed.get(timeout=wait)
+                except Empty:
+                    continue
+                in_flight -= 1
+                result, done = self.handle(poll, future)
+                if result:
+                    if self.clickatell.status_store is not None:
+                        self.clickatell.status_store.observe(*result)
+                    yield result
+                if not done:
+                    heapq.heappush(due, (self.clock() + self.delay(poll),
+                                            next(counter), poll))
+        finally:
+            pool.shutdown(wait=False)
+
+    def run(self, message_ids, callback, timeout=None):
+        """
+        Poll the messages and call `callback(message_id, status, response)`
+        for every status change. Returns the number of messages that are
+        still pending because of the timeout.
+        """
+        pending = set(message_ids)
+        for message_id, status, resp in self.poll(pending, timeout):
+            if status is None or status in self.final_statuses:
+                pending.discard(message_id)
+            callback(message_id, status, resp)
+        return len(pending)
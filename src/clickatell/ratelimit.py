@@ -0,0 +1,158 @@
+import os
+import time
+import heapq
+import struct
+import itertools
+import threading
+from clickatell import constants as cc
+from clickatell.session import FileLock
+
+class TokenBucket(object):
+    """
+    Allows `rate` messages per second on average, in bursts of at most
+    `capacity` messages.
+
+    Taking more tokens than the capacity is allowed once the bucket is
+    full, the bucket goes into debt and the following calls wait for it
+    to be paid back, so big requests are paced rather than refused.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def fill(self, tokens, updated):
+        now = self.clock()
+        return min(self.capacity, tokens + (now - updated) * self.rate), now
+
+    def take(self, tokens, available):
+        """
+        Returns a tuple of (seconds to wait, tokens left), the tokens are
+        only taken if there is nothing to wait for.
+        """
+        needed = min(tokens, self.capacity)
+        if available >= needed:
+            return 0, available - tokens
+        return (needed - available) / self.rate, available
+
+    def acquire(self, tokens=1):
+        """
+        Take the tokens if they're available, returns 0 if they were or
+        the number of seconds to wait before trying again.
+        """
+        with self.lock:
+            available, self.updated = self.fill(self.tokens, self.updated)
+            wait, self.tokens = self.take(tokens, available)
+            return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    A TokenBucket kept in a file, shared by all processes on a host that
+    use the same path. Updates are serialized with a lock file next to it.
+    """
+
+    format = '!dd'
+
+    def __init__(self, path, rate, capacity=None, clock=time.time):
+        super(FileTokenBucket, self).__init__(rate, capacity, clock)
+        self.path = path
+
+    def load(self):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return self.capacity, self.clock()
+        try:
+            data = fp.read(struct.calcsize(self.format))
+        finally:
+            fp.close()
+        if len(data) != struct.calcsize(self.format):
+            return self.capacity, self.clock()
+        return struct.unpack(self.format, data)
+
+    def save(self, tokens, updated):
+        # the state is smaller than a disk block, overwriting it in place
+        # while holding the lock is safe
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            os.write(fd, struct.pack(self.format, tokens, updated))
+        finally:
+            os.close(fd)
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            with FileLock('%s.lock' % self.path):
+                available, updated = self.fill(*self.load())
+                wait, left = self.take(tokens, available)
+                self.save(left, updated)
+                return wait
+
+
+class Governor(object):
+    """
+    Schedules requests over a TokenBucket in priority order.
+
+    Every request waits in the lane of its `queue` option, QUEUE_HIGH
+    requests are let through before QUEUE_MEDIUM ones and those before
+    QUEUE_LOW ones, requests in the same lane go first come first served.
+    Priorities are honoured between the threads of a process, a bucket
+    shared with other processes only limits their combined rate.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def cost(self, params):
+        """
+        Returns the number of messages a request sends, one per recipient.
+        """
+        to = params.get('to')
+        if not to:
+            return 0
+        return to.count(',') + 1
+
+    def priority(self, params):
+        return int(params.get('queue', cc.QUEUE_LOW))
+
+    def acquire(self, tokens=1, priority=cc.QUEUE_LOW):
+        """
+        Block until the request is first in line and the bucket has the
+        tokens for it.
+        """
+        entry = (priority, next(self.counter))
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    if self.waiting[0] == entry:
+                        delay = self.bucket.acquire(tokens)
+                        if not delay:
+                            return
+                        # woken early if a request with a higher 
+                        # priority is done and it's our turn again
+                        self.condition.wait(delay)
+                    else:
+                        self.condition.wait()
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def throttle(self, params):
+        """
+        Wait until the request with the given parameters can be sent.
+        """
+        tokens = self.cost(params)
+        if tokens:
+            self.acquire(tokens, self.priority(params))
@@ -0,0 +1,137 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from clickatell.api import Batch
+from clickatell.errors import ClickatellError
+from clickatell.response import ERRResponse
+
+# the error code Clickatell returns for an unknown or expired batch_id
+INVALID_BATCH_ID = 201
+
+def key_for(options):
+    """
+    Returns a hash of the validated batch options
+    """
+    digest = hashlib.sha1()
+    for name, value in sorted(options.items()):
+        digest.update('%s=%r\n' % (name, value))
+    return digest.hexdigest()
+
+
+class SharedBatch(Batch):
+    """
+    A Batch that is shared by many jobs and threads. It is started the
+    first time it is used and again once it is older than `max_age`
+    seconds or Clickatell no longer knows its batch_id. It is never ended
+    by a job, using it as a context manager doesn't start or end it.
+    """
+
+    def __init__(self, clickatell, options, max_age, clock=time.time):
+        super(SharedBatch, self).__init__(clickatell, options)
+        self.max_age = max_age
+        self.clock = clock
+        self.started_at = None
+        self.lock = threading.Lock()
+
+    def __enter__(self, *args, **kwargs):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    def expired(self):
+        return self.batch_id is None or \
+                self.clock() - self.started_at >= self.max_age
+
+    def live_batch_id(self, stale=None):
+        """
+        Returns a batch_id that is still valid, starting a new batch if
+        needed. `stale` is the batch_id Clickatell rejected, if any.
+        """
+        with self.lock:
+            if self.expired() or self.batch_id == stale:
+                self.batch_id = self.start(dict(self.options))
+                self.started_at = self.clock()
+            return self.batch_id
+
+    def rejected(self, responses):
+        if isinstance(responses, ERRResponse):
+            return responses.code == INVALID_BATCH_ID
+        if isinstance(responses, list) and responses:
+            return isinstance(responses[0], ERRResponse) and \
+                    responses[0].code == INVALID_BATCH_ID
+        if hasattr(responses, 'codes') and len(responses):
+            return responses.codes[0] == INVALID_BATCH_ID
+        return False
+
+    def call(self, fn, **options):
+        batch_id = self.live_batch_id()
+        responses = fn(self, batch_id=batch_id, **options)
+        if self.rejected(responses):
+            batch_id = self.live_batch_id(stale=batch_id)
+            responses = fn(self, batch_id=batch_id, **options)
+        return responses
+
+    def sendmsg(self, context={}, **options):
+        return self.call(Batch.sendmsg, context=context, **options)
+
+    def quicksend(self, **options):
+        return self.call(Batch.quicksend, **options)
+
+    def end(self, batch_id=None):
+        with self.lock:
+            batch_id, self.batch_id = batch_id or self.batch_id, None
+            if batch_id:
+                return super(SharedBatch, self).end(batch_id)
+
+
+class BatchRegistry(object):
+    """
+    Hands out shared batches keyed on their template and options, so
+    recurring jobs don't pay for a startbatch and endbatch each.
+
+    Batches expire after 24 hours, they are started again once they're
+    older than `max_age` seconds. At most `maxsize` batches are kept, the
+    least recently used ones are dropped and left to expire.
+    """
+
+    def __init__(self, clickatell, max_age=23 * 60 * 60, maxsize=100,
+                    clock=time.time):
+        self.clickatell = clickatell
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.batches = OrderedDict()
+
+    def batch(self, **options):
+        """
+        Returns the shared batch for the given options, which take the
+        same options as Clickatell.batch
+        """
+        options = self.clickatell.with_defaults(options)
+        key = key_for(options)
+        with self.lock:
+            batch = self.batches.pop(key, None)
+            if batch is None:
+                batch = SharedBatch(self.clickatell, options, self.max_age,
+                                    self.clock)
+            self.batches[key] = batch
+            while len(self.batches) > self.maxsize:
+                self.batches.popitem(last=False)
+            return batch
+
+    def close(self):
+        """
+        End all live batches
+        """
+        with self.lock:
+            batches, self.batches = self.batches.values(), OrderedDict()
+        for batch in batches:
+            try:
+                batch.end()
+            except ClickatellError, e:
+                # it may have expired already
+                logging.warning('Ending batch failed: %s' % e)
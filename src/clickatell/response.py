@@ -1,32 +1,58 @@
 import re
+from array import array
+
+key_value_pattern = re.compile(r'([a-zA-Z]+)\: ([a-zA-Z0-9]+(?:\.[0-9]+)?)')
+
+def parse_parts(data, pattern=key_value_pattern):
+    """
+    Parses incoming data like:
+    
+        312312312312 To: 27123456789
+    
+    To:
+    
+        '312312312312', {'To':'27123456789'}
+    
+    """
+    collection = {}
+    remainder = []
+    position = 0
+    for match in pattern.finditer(data):
+        key, value = match.group(1, 2)
+        collection[key] = value
+        remainder.append(data[position:match.start()])
+        position = match.end()
+    if not position:
+        return data.strip(), collection
+    remainder.append(data[position:])
+    return ''.join(remainder).strip(), collection
+
+def parse_error(string):
+    """
+    Parses error data like `301, No Credit Left` into a (code, reason) tuple.
+    The code is None if the error doesn't start with one.
+    """
+    parts = string.split(", ", 1)
+    code = parts[0]
+    reason = ''.join(parts[1:]).strip() # ugly but always returns an empty
+                                        # string even if the list only has 
+                                        # one item
+    # Hideous but Clickatell is very "liberal" in how they format their
+    # error responses
+    if code.isdigit():
+        return int(code), reason
+    return None, code
 
 class Response(object):
-    key_value_pattern = re.compile(r'([a-zA-Z]+)\: ([a-zA-Z0-9]+)')
+    __slots__ = ('data', 'value', 'extra')
+    key_value_pattern = key_value_pattern
     
     def __init__(self, data=''):
         self.data = data
         self.process(self.data)
     
     def parse_parts(self, data):
-        """
-        Parses incoming data like:
-        
-            312312312312 To: 27123456789
-        
-        To:
-        
-            '312312312312', {'To':'27123456789'}
-        
-        """
-        collection = {}
-        while 1:
-            match = self.key_value_pattern.search(data)
-            if match is None:
-                break
-            key, value = match.group(1, 2)
-            collection[key] = value
-            data = data.replace(match.group(0), '')
-        return data.strip(), collection
+        return parse_parts(data, self.key_value_pattern)
     
     def process(self, data):
         """
@@ -38,33 +64,133 @@ class Response(object):
         return "%s: %s" % (self.__class__.__name__, self.data)
 
 class OKResponse(Response):
-    pass
+    __slots__ = ()
 
 class ERRResponse(Response):
+    __slots__ = ('code', 'reason')
     
     def process(self, string):
-        parts = string.split(", ", 1)
-        code = parts[0]
-        reason = ''.join(parts[1:]).strip() # ugly but always returns an empty
-                                            # string even if the list only has 
-                                            # one item
-        # Hideous but Clickatell is very "liberal" in how they format their
-        # error responses
-        if code.isdigit():
-            self.code = int(code)
+        code, reason = parse_error(string)
+        if code is not None:
+            self.code = code
             self.reason = reason
         else:
             self.code = 0
-            self.value = code
+            self.value = reason
 
 class IDResponse(Response): 
-    pass
+    __slots__ = ()
 
 class CreditResponse(Response):
+    __slots__ = ()
     kind = "Credit"
     
     def process(self, string):
         self.value = float(string)
 
 class ApiMsgIdResponse(Response):
-    pass
+    __slots__ = ()
+
+class ResponseSet(object):
+    """
+    A compact list of responses for large multi-recipient results.
+    
+    Instead of a Response object per line it keeps the kind, value, 
+    recipient (`To`), error code and reason of every line in parallel 
+    lists. Response objects are only created when indexing or iterating, 
+    and the aggregate queries don't create any at all.
+    
+    `handler` returns the response class for a kind, like 
+    `ResponseDispatcher.handler`.
+    """
+    
+    def __init__(self, handler, pairs=()):
+        self.handler = handler
+        self.kinds = []
+        self.payloads = []
+        self.values = []
+        self.recipients = []
+        # error code per line, -1 for lines that aren't errors
+        self.codes = array('l')
+        self.reasons = []
+        self._by_recipient = None
+        for kind, payload in pairs:
+            self.append(kind, payload)
+    
+    def append(self, kind, payload):
+        kind = intern(str(kind))
+        # resolve the kind first so unknown kinds fail like they do for lists
+        self.handler(kind)
+        if kind.upper() == 'ERR':
+            code, reason = parse_error(payload)
+            self.codes.append(code or 0)
+            self.reasons.append(reason)
+            self.values.append(None)
+            self.recipients.append(parse_parts(reason)[1].get('To'))
+        else:
+            value, extra = parse_parts(payload)
+            self.codes.append(-1)
+            self.reasons.append(None)
+            self.values.append(value)
+            self.recipients.append(extra.get('To'))
+        self.kinds.append(kind)
+        self.payloads.append(payload)
+        self._by_recipient = None
+    
+    def extend(self, other):
+        if isinstance(other, ResponseSet):
+            self.kinds.extend(other.kinds)
+            self.payloads.extend(other.payloads)
+            self.values.extend(other.values)
+            self.recipients.extend(other.recipients)
+            self.codes.extend(other.codes)
+            self.reasons.extend(other.reasons)
+            self._by_recipient = None
+        else:
+            for kind, payload in other:
+                self.append(kind, payload)
+    
+    def __len__(self):
+        return len(self.kinds)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.handler(self.kinds[index])(self.payloads[index])
+    
+    def __iter__(self):
+        handler = self.handler
+        for kind, payload in zip(self.kinds, self.payloads):
+            yield handler(kind)(payload)
+    
+    def __repr__(self):
+        return '<%s: %s responses, %s errors>' % (self.__class__.__name__,
+                    len(self), len(self.errors()))
+    
+    def errors(self):
+        """
+        Returns a list of (index, code, reason) tuples for all errors
+        """
+        return [(index, code, self.reasons[index]) 
+                    for index, code in enumerate(self.codes) if code != -1]
+    
+    def error_codes(self):
+        return [code for code in self.codes if code != -1]
+    
+    def apimsgids(self):
+        """
+        Returns the apimsgids, None for lines that are errors
+        """
+        return list(self.values)
+    
+    def apimsgid_for(self, recipient):
+        """
+        Returns the apimsgid for a recipient, or None if it was not sent
+        or the response didn't specify the recipient.
+        """
+        if self._by_recipient is None:
+            self._by_recipient = dict((to, index) 
+                for index, to in enumerate(self.recipients) if to)
+        index = self._by_recipient.get(recipient)
+        if index is not None:
+            return self.values[index]
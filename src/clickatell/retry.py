@@ -0,0 +1,172 @@
+import time
+import random
+import socket
+import httplib
+import urllib2
+import logging
+import threading
+from clickatell.errors import CircuitOpenError, ConnectError
+from clickatell.response import ResponseSet, ERRResponse
+
+class CircuitBreaker(object):
+    """
+    Fails calls fast while an endpoint is unhealthy.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls raise CircuitOpenError without being made. Once `reset_timeout`
+    seconds have passed a single trial call is let through, if it succeeds
+    the circuit closes again, otherwise it stays open for another period.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and \
+                self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError, 'Circuit open after %s failures' % \
+                                        self.failures
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class RetryPolicy(object):
+    """
+    Retries calls that failed for a transient reason with jittered
+    exponential backoff.
+
+    Transport errors, HTTP statuses in `retryable_statuses` and responses
+    that are all errors with a code in `retryable_codes` are retried, up to
+    `max_attempts` attempts in total. Anything else is fatal and returned
+    or raised straight away. The delay before retry n is a random value
+    between 0 and `min(max_backoff, backoff * 2 ** n)` seconds.
+
+    Calls that aren't idempotent, sends, are only retried if they failed
+    before the request went out or with one of the
+    `retryable_send_statuses`. A read timeout or a dropped connection after
+    the request was sent may hide a message Clickatell accepted, those are
+    raised so they can be reconciled by climsgid instead.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=5,
+                    retryable_codes=(901,),
+                    retryable_statuses=(500, 502, 503, 504),
+                    retryable_send_statuses=(503,),
+                    failure_threshold=5, reset_timeout=30,
+                    sleep=time.sleep, random=random.random):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retryable_codes = retryable_codes
+        self.retryable_statuses = retryable_statuses
+        self.retryable_send_statuses = retryable_send_statuses
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.random = random
+
+    def circuit_breaker(self):
+        return CircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+    def delay(self, attempt):
+        return self.random() * min(self.max_backoff,
+                                    self.backoff * 2 ** attempt)
+
+    def transient_error(self, error):
+        """
+        Whether the error says the endpoint is failing, rather than the call
+        """
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.retryable_statuses
+        return isinstance(error, (socket.error, httplib.HTTPException,
+                                    urllib2.URLError))
+
+    def retryable_error(self, error, idempotent=True):
+        if not self.transient_error(error):
+            return False
+        if idempotent:
+            return True
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.retryable_send_statuses
+        # urllib2 only raises URLError for failures while sending
+        return isinstance(error, (ConnectError, urllib2.URLError))
+
+    def retryable_responses(self, responses):
+        """
+        Only retry if the whole request failed, retrying a partially
+        accepted multi-recipient request would send messages twice.
+        """
+        if isinstance(responses, ResponseSet):
+            codes = list(responses.codes)
+        elif isinstance(responses, list):
+            codes = [resp.code for resp in responses
+                        if isinstance(resp, ERRResponse)]
+            if len(codes) != len(responses):
+                return False
+        else:
+            return False
+        return bool(codes) and \
+                all(code in self.retryable_codes for code in codes)
+
+    def call(self, fn, breaker=None, idempotent=True):
+        """
+        Call `fn` until it succeeds, fails fatally or runs out of attempts.
+        Every attempt records its outcome with the breaker, so a trial call
+        of a half-open circuit always closes or opens it again.
+        """
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.before_call()
+            attempt += 1
+            try:
+                result = fn()
+            except Exception, e:
+                if breaker:
+                    if self.transient_error(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not self.retryable_error(e, idempotent) or \
+                    attempt >= self.max_attempts:
+                    raise
+                logging.warning('Attempt %s failed with %r, retrying' % (
+                                    attempt, e))
+            else:
+                if not self.retryable_responses(result):
+                    if breaker:
+                        breaker.record_success()
+                    return result
+                if breaker:
+                    breaker.record_failure()
+                if attempt >= self.max_attempts:
+                    return result
+                logging.warning('Attempt %s returned %s, retrying' % (
+                                    attempt, result))
+            self.sleep(self.delay(attempt - 1))
@@ -0,0 +1,224 @@
+import os
+import fcntl
+import json
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from clickatell.errors import ClickatellError
+from clickatell.futures import Future
+
+class MemorySessionStore(object):
+    """
+    Keeps the session in memory, it is only shared by the threads using
+    the same Clickatell instance.
+    """
+    
+    def __init__(self):
+        self.session = (None, None)
+        self._lock = threading.RLock()
+    
+    def lock(self):
+        return self._lock
+    
+    def load(self):
+        """
+        Returns a (session_id, start_time) tuple
+        """
+        return self.session
+    
+    def save(self, session_id, start_time):
+        self.session = (session_id, start_time)
+
+class FileLock(object):
+    """
+    An exclusive lock on a file, shared by all processes on the host.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+    
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+class FileSessionStore(object):
+    """
+    Keeps the session in a file so all processes on a host can share it.
+    Refreshes are serialized with a lock file next to it so only one 
+    process authenticates at a time.
+    
+    The session id and start time are stored as JSON, a file that doesn't
+    parse is treated as having no session.
+    """
+    
+    time_format = '%Y-%m-%dT%H:%M:%S.%f'
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def lock(self):
+        return FileLock('%s.lock' % self.path)
+    
+    def load(self):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return None, None
+        try:
+            session = json.load(fp)
+            session_id = session['session_id']
+            start_time = session['start_time']
+            return (session_id and str(session_id), start_time and 
+                    datetime.strptime(start_time, self.time_format))
+        except (ValueError, KeyError, TypeError):
+            return None, None
+        finally:
+            fp.close()
+    
+    def save(self, session_id, start_time):
+        # write to a temporary file and rename it so readers never see a
+        # partially written session
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        fp = os.fdopen(fd, 'wb')
+        try:
+            json.dump({
+                'session_id': session_id,
+                'start_time': start_time and 
+                                start_time.strftime(self.time_format),
+            }, fp)
+        finally:
+            fp.close()
+        os.rename(temp_path, self.path)
+
+class SessionManager(object):
+    """
+    Keeps track of the session id for a Clickatell instance and shares it
+    safely between threads.
+
+    Only one thread authenticates at a time, other threads that need a new
+    session while that is in flight wait for it and use its session id.
+    The keep alive thread pings Clickatell before the session times out
+    so requests never have to wait for an authentication round trip.
+
+    The session is kept in a store, a FileSessionStore shares it with all 
+    processes on a host so only one of them has to authenticate.
+    """
+
+    def __init__(self, clickatell, timeout, refresh_margin=timedelta(minutes=1),
+                    store=None):
+        self.clickatell = clickatell
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.store = store or MemorySessionStore()
+        self.lock = threading.Lock()
+        self.session_id, self.start_time = self.store.load()
+        self.stopped = threading.Event()
+        self.keepalive_thread = None
+
+    def expired(self, start_time=None):
+        """
+        Return True or False depending on whether a session has expired
+        or not. Calculated locally based on the time out value.
+        """
+        start_time = start_time or self.start_time
+        # If start_time hasn't been set then we do not have a session yet
+        if not start_time:
+            return True
+        return (datetime.now() - start_time) >= self.timeout
+
+    def get(self):
+        if self.expired():
+            return self.refresh()
+        return self.session_id
+
+    def set(self, session_id):
+        """
+        Sets the session id and resets the session time-out.
+        """
+        self.session_id = session_id
+        self.touch()
+
+    def touch(self, start_time=None):
+        self.start_time = start_time or datetime.now()
+        self.store.save(self.session_id, self.start_time)
+
+    def refresh(self, stale=None):
+        """
+        Authenticate for a new session id. If another thread or process 
+        refreshed the session while this one was waiting for the lock its 
+        session id is returned instead of authenticating again.
+
+        `stale` is the session id Clickatell rejected, if any.
+        """
+        with self.lock:
+            if not self.expired() and self.session_id != stale:
+                return self.session_id
+            with self.store.lock():
+                session_id, start_time = self.store.load()
+                if session_id and session_id != stale and \
+                    not self.expired(start_time):
+                    self.session_id, self.start_time = session_id, start_time
+                    return session_id
+                session_id = self.clickatell.get_new_session_id()
+                self.set(session_id)
+                return session_id
+
+    def start_keepalive(self):
+        """
+        Start a daemon thread that keeps the session alive by pinging
+        Clickatell `refresh_margin` before the session times out.
+        """
+        if self.keepalive_thread:
+            return
+        self.stopped.clear()
+        self.keepalive_thread = threading.Thread(target=self.keepalive)
+        self.keepalive_thread.setDaemon(True)
+        self.keepalive_thread.start()
+
+    def stop_keepalive(self):
+        self.stopped.set()
+        if self.keepalive_thread:
+            self.keepalive_thread.join()
+            self.keepalive_thread = None
+
+    def seconds_until_refresh(self):
+        if not self.start_time:
+            return 0
+        delta = self.start_time + self.timeout - self.refresh_margin - \
+                    datetime.now()
+        return max(0, delta.days * 86400 + delta.seconds +
+                        delta.microseconds / 1e6)
+
+    def keepalive(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.seconds_until_refresh())
+            if self.stopped.isSet():
+                break
+            if self.seconds_until_refresh() > 0:
+                continue
+            try:
+                if self.expired():
+                    self.refresh()
+                else:
+                    try:
+                        result = self.clickatell.ping()
+                        # an AsyncClickatell pings in the background, wait
+                        # for it so its errors are seen
+                        if isinstance(result, Future):
+                            result.result()
+                    except ClickatellError, e:
+                        logging.warning('Session keep alive failed: %s' % e)
+                        self.refresh(stale=self.session_id)
+            except Exception, e:
+                logging.exception('Session refresh failed: %s' % e)
+                # don't hammer the auth endpoint
+                self.stopped.wait(self.refresh_margin.seconds or 1)
@@ -0,0 +1,348 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from clickatell import constants as cc
+from clickatell.response import IDResponse, ApiMsgIdResponse
+
+class Entry(object):
+    """
+    What is known locally about a message, `updated` is when its status
+    last changed and `touched` when anything about it did.
+    """
+
+    __slots__ = ('apimsgid', 'climsgid', 'recipient', 'status', 'charge',
+                    'updated', 'touched')
+
+    def __init__(self, apimsgid, climsgid=None, recipient=None, status=None,
+                    charge=None, updated=None, touched=None):
+        self.apimsgid = apimsgid
+        self.climsgid = climsgid
+        self.recipient = recipient
+        self.status = status
+        self.charge = charge
+        self.updated = updated
+        self.touched = touched
+
+    def __repr__(self):
+        return 'Entry: %s %s' % (self.apimsgid, self.status)
+
+    def as_tuple(self):
+        return (self.apimsgid, self.climsgid, self.recipient, self.status,
+                self.charge, self.updated, self.touched)
+
+    def copy(self):
+        return Entry(*self.as_tuple())
+
+
+class StatusStore(object):
+    """
+    Keeps the status of sent messages, indexed by apimsgid, climsgid,
+    recipient and status.
+
+    Messages are added with `track()` as they're sent and updated from
+    callbacks, it is a sink for a callbacks.MicroBatcher, and from polls,
+    `observe` is a callback for StatusPoller.run. Clickatell.querymsg and
+    getmsgcharge are answered from the store when the status is one of
+    the `final_statuses` or was updated less than `max_age` seconds ago.
+
+    Messages nothing was heard about for `ttl` seconds are dropped, and
+    at most `maxsize` are kept, the ones untouched the longest go first.
+    """
+
+    def __init__(self, max_age=60, final_statuses=cc.FINAL_STATUSES,
+                    clock=time.time, ttl=3 * 24 * 60 * 60, maxsize=100000):
+        self.max_age = max_age
+        self.final_statuses = final_statuses
+        self.clock = clock
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        # apimsgid -> entry, in the order they were last touched
+        self.entries = OrderedDict()
+        self.climsgids = {}
+        self.recipients = {}
+        self.statuses = {}
+
+    def index(self, entry):
+        self.entries[entry.apimsgid] = entry
+        if entry.climsgid:
+            self.climsgids[entry.climsgid] = entry.apimsgid
+        if entry.recipient:
+            self.recipients.setdefault(entry.recipient, set()).add(
+                                                            entry.apimsgid)
+        self.statuses.setdefault(entry.status, set()).add(entry.apimsgid)
+
+    def unindex(self, apimsgid):
+        entry = self.entries.pop(apimsgid, None)
+        if entry is None:
+            return
+        if self.climsgids.get(entry.climsgid) == apimsgid:
+            del self.climsgids[entry.climsgid]
+        for index, key in ((self.recipients, entry.recipient),
+                            (self.statuses, entry.status)):
+            apimsgids = index.get(key)
+            if apimsgids is not None:
+                apimsgids.discard(apimsgid)
+                if not apimsgids:
+                    del index[key]
+
+    def evict(self):
+        expired = self.clock() - self.ttl
+        while self.entries:
+            apimsgid, entry = next(self.entries.iteritems())
+            if len(self.entries) <= self.maxsize and entry.touched > expired:
+                break
+            self.unindex(apimsgid)
+
+    def update(self, apimsgid, status=None, charge=None, climsgid=None,
+                recipient=None):
+        """
+        Add what's known about a message to its entry and save it, returns
+        the entry.
+        """
+        [entry] = self.update_many([{'apimsgid': apimsgid, 'status': status,
+                                        'charge': charge,
+                                        'climsgid': climsgid,
+                                        'recipient': recipient}])
+        return entry
+
+    def apply(self, entry, status=None, charge=None, climsgid=None,
+                recipient=None):
+        """
+        Add an update to an entry. A final status is never replaced by an
+        intermediate one arriving out of order.
+        """
+        now = self.clock()
+        if status is not None and (entry.status not in
+                self.final_statuses or status in self.final_statuses):
+            entry.status = status
+            entry.updated = now
+        entry.charge = charge if charge is not None else entry.charge
+        entry.climsgid = climsgid or entry.climsgid
+        entry.recipient = recipient or entry.recipient
+        entry.touched = now
+
+    def update_many(self, updates):
+        """
+        Apply an iterable of keyword dicts for `update` and save them
+        together, returns the entries.
+        """
+        with self.lock:
+            changed, entries = OrderedDict(), []
+            for update in updates:
+                update = dict(update)
+                apimsgid = update.pop('apimsgid')
+                entry = changed.get(apimsgid)
+                if entry is None:
+                    entry = self.load(apimsgid) or Entry(apimsgid)
+                self.apply(entry, **update)
+                changed[apimsgid] = entry
+                entries.append(entry)
+            self.save(changed.values())
+            return entries
+
+    def load(self, apimsgid):
+        """
+        Returns a copy of the entry for a message to apply updates to, or
+        None if there's none.
+        """
+        entry = self.entries.get(apimsgid)
+        if entry is not None:
+            return entry.copy()
+
+    def save(self, entries):
+        """
+        Replace the entries of changed messages and drop expired ones
+        """
+        for entry in entries:
+            self.unindex(entry.apimsgid)
+            self.index(entry)
+        self.evict()
+
+    def track(self, responses, recipients, climsgid=None):
+        """
+        Link the responses of a sendmsg, quicksend or senditem to their
+        recipients. Multi-recipient responses name their recipient, a
+        single response belongs to the only recipient.
+        """
+        updates = []
+        for resp in responses:
+            if not isinstance(resp, IDResponse):
+                continue
+            recipient = resp.extra.get('To')
+            if recipient is None and len(recipients) == 1:
+                recipient = recipients[0]
+            updates.append({'apimsgid': resp.value, 'climsgid': climsgid,
+                            'recipient': recipient})
+        return self.update_many(updates)
+
+    def write(self, records):
+        """
+        Update the store from callbacks.CallbackRecords
+        """
+        self.update_many({'apimsgid': record.apimsgid,
+                            'status': record.status,
+                            'charge': record.charge,
+                            'climsgid': record.climsgid,
+                            'recipient': record.to} for record in records)
+
+    def close(self):
+        pass
+
+    def observe(self, message_id, status, resp):
+        """
+        Update the store from a StatusPoller result
+        """
+        if isinstance(resp, IDResponse) and status is not None:
+            self.update_many([{'apimsgid': resp.value, 'status': status}])
+
+    def get(self, apimsgid=None, climsgid=None):
+        with self.lock:
+            if apimsgid is None:
+                apimsgid = self.climsgids.get(climsgid)
+            return self.entries.get(apimsgid)
+
+    def for_recipient(self, recipient):
+        with self.lock:
+            return [self.entries[apimsgid] for apimsgid in
+                        self.recipients.get(recipient, ())]
+
+    def with_status(self, status):
+        with self.lock:
+            return [self.entries[apimsgid] for apimsgid in
+                        self.statuses.get(status, ())]
+
+    def counts(self):
+        """
+        Returns the number of messages with every status
+        """
+        with self.lock:
+            return dict((status, len(apimsgids)) for status, apimsgids
+                            in self.statuses.items() if apimsgids)
+
+    def fresh(self, apimsgid=None, climsgid=None):
+        """
+        Returns the entry if its status can be trusted without asking
+        Clickatell, otherwise None.
+        """
+        entry = self.get(apimsgid, climsgid)
+        if entry is None or entry.status is None:
+            return None
+        if entry.status in self.final_statuses or \
+            self.clock() - entry.updated < self.max_age:
+            return entry
+
+    def querymsg_response(self, **kwargs):
+        entry = self.fresh(kwargs.get('apimsgid'), kwargs.get('climsgid'))
+        if entry is not None:
+            return IDResponse('%s Status: %s' % (entry.apimsgid,
+                                                    entry.status))
+
+    def getmsgcharge_response(self, apimsgid):
+        entry = self.fresh(apimsgid)
+        if entry is not None and entry.charge is not None:
+            return ApiMsgIdResponse('%s charge: %s status: %s' % (
+                                    entry.apimsgid, entry.charge,
+                                    entry.status))
+
+
+class SQLiteStatusStore(StatusStore):
+    """
+    A StatusStore that is saved in an SQLite database and queried as
+    entries are needed, nothing is kept in memory.
+
+    Expired and surplus entries are deleted every `evict_every` writes
+    rather than on every write, there may be that many more than `maxsize`
+    entries in between.
+    """
+
+    columns = ('apimsgid', 'climsgid', 'recipient', 'status', 'charge',
+                'updated', 'touched')
+
+    def __init__(self, path, max_age=60, final_statuses=cc.FINAL_STATUSES,
+                    clock=time.time, ttl=3 * 24 * 60 * 60, maxsize=1000000,
+                    evict_every=1000):
+        super(SQLiteStatusStore, self).__init__(max_age, final_statuses,
+                                                clock, ttl, maxsize)
+        self.evict_every = evict_every
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS statuses ('
+                        'apimsgid TEXT PRIMARY KEY, climsgid TEXT, '
+                        'recipient TEXT, status TEXT, charge REAL, '
+                        'updated REAL, touched REAL)')
+        columns = [row[1] for row in
+                    self.db.execute('PRAGMA table_info(statuses)')]
+        if 'touched' not in columns:
+            # databases from before entries expired
+            self.db.execute('ALTER TABLE statuses ADD COLUMN touched REAL')
+            self.db.execute('UPDATE statuses SET touched = ?', (clock(),))
+        for column in ('climsgid', 'recipient', 'status', 'touched'):
+            self.db.execute('CREATE INDEX IF NOT EXISTS statuses_%s '
+                            'ON statuses (%s)' % (column, column))
+        self.db.commit()
+
+    def select(self, where, params=()):
+        """
+        Returns the unexpired entries matching an SQL condition
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT %s FROM statuses WHERE %s AND '
+                                    'touched > ?' % (', '.join(self.columns),
+                                    where), tuple(params) +
+                                    (self.clock() - self.ttl,)).fetchall()
+        return [Entry(*[str(value) if isinstance(value, unicode) else value
+                        for value in row]) for row in rows]
+
+    def load(self, apimsgid):
+        entries = self.select('apimsgid = ?', (apimsgid,))
+        return entries[0] if entries else None
+
+    def save(self, entries):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO statuses (%s) '
+                                'VALUES (%s)' % (', '.join(self.columns),
+                                ', '.join('?' * len(self.columns))),
+                                [entry.as_tuple() for entry in entries])
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        with self.db:
+            self.db.execute('DELETE FROM statuses WHERE touched <= ?',
+                            (self.clock() - self.ttl,))
+            [count] = self.db.execute('SELECT COUNT(*) FROM statuses'
+                                        ).fetchone()
+            if count > self.maxsize:
+                self.db.execute('DELETE FROM statuses WHERE apimsgid IN ('
+                                'SELECT apimsgid FROM statuses ORDER BY '
+                                'touched LIMIT ?)', (count - self.maxsize,))
+
+    def get(self, apimsgid=None, climsgid=None):
+        if apimsgid is not None:
+            return self.load(apimsgid)
+        entries = self.select('climsgid = ?', (climsgid,))
+        if entries:
+            return max(entries, key=lambda entry: entry.touched)
+
+    def for_recipient(self, recipient):
+        return self.select('recipient = ?', (recipient,))
+
+    def with_status(self, status):
+        if status is None:
+            return self.select('status IS NULL')
+        return self.select('status = ?', (status,))
+
+    def counts(self):
+        with self.lock:
+            return dict((str(status) if status is not None else None, count)
+                        for status, count in self.db.execute(
+                            'SELECT status, COUNT(*) FROM statuses '
+                            'WHERE touched > ? GROUP BY status',
+                            (self.clock() - self.ttl,)))
+
+    def close(self):
+        self.db.close()
@@ -1,4 +1,5 @@
 import logging
+import threading
 from clickatell.http import HttpClient
 from clickatell.client import Client
 from clickatell.errors import ClickatellError
@@ -9,6 +10,7 @@ class TestHttpClient(HttpClient):
     def __init__(self):
         super(TestHttpClient, self).__init__()
         self.queue = {}
+        self.lock = threading.RLock()
     
     def mock(self, method, url, data={}, headers={}, response={}):
         method = method.upper()
@@ -16,6 +18,10 @@ class TestHttpClient(HttpClient):
         self.queue[method].append((url, data, headers, response))
     
     def get_mocked(self, method, url, data={}, headers={}):
+        with self.lock:
+            return self._get_mocked(method, url, data, headers)
+    
+    def _get_mocked(self, method, url, data={}, headers={}):
         method = method.upper()
         method_queue = self.queue.get(method, [])
         enumeration = enumerate(method_queue)
@@ -47,6 +53,9 @@ class TestHttpClient(HttpClient):
                                 "headers (%(headers)s):" % locals())
                 logging.debug("\t\t `-> %s" % response)
     
+    def stream(self, method, *args, **kwargs):
+        return iter(self.get_mocked(method, *args, **kwargs))
+    
     def get(self, *args, **kwargs):
         return self.get_mocked('get', *args, **kwargs)
     
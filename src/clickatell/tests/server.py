@@ -0,0 +1,330 @@
+import time
+import random
+import socket
+import urlparse
+import optparse
+import itertools
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+class LocalRequestHandler(BaseHTTPRequestHandler):
+    """Answers every request with the server's canned response body"""
+
+    protocol_version = 'HTTP/1.1'
+    # buffer writes so headers & body go out in a single segment
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+        self.server.sockets.append(self.connection)
+        # simulate the cost of setting up a connection, e.g. a TLS handshake
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+
+    def respond(self):
+        body = self.server.response
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, None))
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.server.requests.append(('POST', self.path,
+                                        self.rfile.read(length)))
+        self.respond()
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    """
+    A local HTTP/1.1 server running in a background thread, it keeps track
+    of the connections made to it and the requests received.
+    """
+
+    daemon_threads = True
+    # SocketServer's default backlog of 5 drops the SYNs of clients opening
+    # more connections at once, which then only retry after a second
+    request_queue_size = 128
+
+    def __init__(self, response='OK: ', handshake=0, port=0,
+                    handler_class=LocalRequestHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', port), handler_class)
+        self.response = response
+        self.handshake = handshake
+        self.connections = []
+        self.sockets = []
+        self.requests = []
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, 
+                                        kwargs={'poll_interval': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # hang up on keep-alive connections so their threads finish
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+
+class ClickatellRequestHandler(LocalRequestHandler):
+    """
+    Implements the parts of Clickatell's HTTP API the library uses, with the
+    latency, error rate and throttling configured on the server.
+    """
+
+    def respond_with(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method, path, query):
+        server = self.server
+        server.requests.append((method, path, query))
+        if server.latency:
+            time.sleep(server.latency)
+        fault = server.next_fault()
+        if fault:
+            return self.respond_with(*fault)
+        if server.throttled():
+            return self.respond_with(503, 'Service Unavailable')
+        if server.random.random() < server.error_rate:
+            return self.respond_with(500, 'Internal Server Error')
+        params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        handler = server.routes.get(path)
+        if handler is None:
+            return self.respond_with(404, 'Not Found')
+        self.respond_with(200, handler(params))
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.handle_request('GET', path, query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.handle_request('POST', self.path.partition('?')[0],
+                            self.rfile.read(length))
+
+
+class ClickatellServer(LocalServer):
+    """
+    A local stand-in for api.clickatell.com, for tests, load tests and
+    benchmarks of the real network path without an outside network.
+
+    `latency` is added to every request in seconds, `handshake` to every
+    new connection, `error_rate` is the
+    fraction of requests answered with an HTTP 500, and requests beyond
+    `throttle` per second are answered with an HTTP 503. Messages sent to
+    MSISDNs starting with one of the `coverage` prefixes are accepted.
+    """
+
+    covered_response = 'OK: This prefix is currently supported. Messages ' \
+                        'sent to this prefix will be routed. Charge: %s'
+    uncovered_response = 'ERR: This prefix is not currently supported. ' \
+                        'Messages sent to this prefix will fail. Please ' \
+                        'contact support for assistance.'
+
+    def __init__(self, username='username', password='password',
+                    api_id='api_id', credit=1000.0, latency=0, error_rate=0,
+                    throttle=None, coverage=('27',), charge=1, status='004',
+                    seed=None, handshake=0, port=0, 
+                    handler_class=ClickatellRequestHandler):
+        LocalServer.__init__(self, handshake=handshake, port=port, 
+                                handler_class=handler_class)
+        self.credentials = (username, password, api_id)
+        self.credit = credit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.coverage = coverage
+        self.charge = charge
+        self.status = status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.window = (0, 0)
+        self.faults = []
+        self.sessions = set()
+        self.batches = {}
+        self.messages = {}
+        self.climsgids = {}
+        self.routes = {
+            '/http/auth': self.auth,
+            '/http/ping': self.with_session(self.ping),
+            '/http/sendmsg': self.with_session(self.sendmsg),
+            '/http/querymsg': self.with_session(self.querymsg),
+            '/http/getbalance': self.with_session(self.getbalance),
+            '/http/getmsgcharge': self.with_session(self.getmsgcharge),
+            '/http_batch/startbatch': self.with_session(self.startbatch),
+            '/http_batch/senditem': self.with_session(self.senditem),
+            '/http_batch/quicksend': self.with_session(self.quicksend),
+            '/http_batch/endbatch': self.with_session(self.endbatch),
+            '/utils/routeCoverage.php': self.with_session(self.coverage_for),
+        }
+
+    def fail_next(self, count=1, status=500, body='Internal Server Error'):
+        """
+        Answer the next `count` requests with the given status and body,
+        e.g. `fail_next(2, 200, 'ERR: 901, Internal error')`.
+        """
+        with self.lock:
+            self.faults.extend([(status, body)] * count)
+
+    def next_fault(self):
+        with self.lock:
+            if self.faults:
+                return self.faults.pop(0)
+
+    def throttled(self):
+        if not self.throttle:
+            return False
+        with self.lock:
+            second, count = self.window
+            now = int(time.time())
+            if now != second:
+                second, count = now, 0
+            self.window = (second, count + 1)
+            return count >= self.throttle
+
+    def new_id(self):
+        return '%032x' % self.counter.next()
+
+    def with_session(self, fn):
+        def handler(params):
+            if params.get('session_id') not in self.sessions:
+                return 'ERR: 003, Session ID expired'
+            return fn(params)
+        return handler
+
+    def auth(self, params):
+        if (params.get('user'), params.get('password'),
+                params.get('api_id')) != self.credentials:
+            return 'ERR: 001, Authentication failed'
+        session_id = self.new_id()
+        self.sessions.add(session_id)
+        return 'OK: %s' % session_id
+
+    def expire_sessions(self):
+        self.sessions.clear()
+
+    def ping(self, params):
+        return 'OK: '
+
+    def send(self, to, params, template=None):
+        """
+        Accept messages for a comma separated list of recipients, returns
+        a response line per recipient.
+        """
+        recipients = [r for r in to.split(',') if r]
+        if not recipients:
+            return ['ERR: 105, Invalid Destination Address']
+        lines = []
+        for recipient in recipients:
+            with self.lock:
+                if self.credit < self.charge:
+                    lines.append('ERR: 301, No Credit Left')
+                    continue
+                self.credit -= self.charge
+            apimsgid = self.new_id()
+            self.messages[apimsgid] = dict(params, to=recipient)
+            if params.get('climsgid'):
+                self.climsgids[params['climsgid']] = apimsgid
+            lines.append('ID: %s' % apimsgid)
+        if len(recipients) > 1:
+            lines = ['%s To: %s' % (line, recipient)
+                        for line, recipient in zip(lines, recipients)]
+        return lines
+
+    def sendmsg(self, params):
+        return '\n'.join(self.send(params.get('to', ''), params))
+
+    def querymsg(self, params):
+        apimsgid = params.get('apimsgid') or \
+                    self.climsgids.get(params.get('climsgid'))
+        if apimsgid not in self.messages:
+            return 'ERR: 103, Unknown API Message ID'
+        return 'ID: %s Status: %s' % (apimsgid, self.status)
+
+    def getbalance(self, params):
+        return 'Credit: %.2f' % self.credit
+
+    def getmsgcharge(self, params):
+        apimsgid = params.get('apimsgid')
+        if apimsgid not in self.messages:
+            return 'ERR: 103, Unknown API Message ID'
+        return 'apiMsgId: %s charge: %s status: %s' % (apimsgid, self.charge,
+                                                        self.status)
+
+    def startbatch(self, params):
+        if not params.get('template'):
+            return 'ERR: 202, No batch template'
+        batch_id = self.new_id()
+        self.batches[batch_id] = params
+        return 'ID: %s' % batch_id
+
+    def senditem(self, params):
+        if params.get('batch_id') not in self.batches:
+            return 'ERR: 201, Invalid batch ID'
+        [line] = self.send(params.get('to', '').split(',')[0], params)
+        return line
+
+    def quicksend(self, params):
+        if params.get('batch_id') not in self.batches:
+            return 'ERR: 201, Invalid batch ID'
+        return '\n'.join(self.send(params.get('to', ''), params))
+
+    def endbatch(self, params):
+        if self.batches.pop(params.get('batch_id'), None) is None:
+            return 'ERR: 201, Invalid batch ID'
+        return 'OK'
+
+    def coverage_for(self, params):
+        msisdn = params.get('msisdn', '')
+        if any(msisdn.startswith(prefix) for prefix in self.coverage):
+            return self.covered_response % self.charge
+        return self.uncovered_response
+
+
+def main():
+    parser = optparse.OptionParser(description='Run a local stand-in for '
+                                    'the Clickatell HTTP API.')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0,
+                        help='seconds added to every request')
+    parser.add_option('--error-rate', type='float', default=0,
+                        help='fraction of requests answered with a 500')
+    parser.add_option('--throttle', type='int', default=None,
+                        help='requests per second before answering with 503')
+    options, args = parser.parse_args()
+    server = ClickatellServer(port=options.port, latency=options.latency,
+                                error_rate=options.error_rate,
+                                throttle=options.throttle)
+    print 'Serving the Clickatell API on %s' % server.url
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
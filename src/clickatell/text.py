@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from clickatell import constants as cc
+
+# the GSM 03.38 basic character set, one septet each
+gsm_basic = (u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;'
+            u'<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyz'
+            u'äöñüà')
+# the extension set, these take an escape septet and one of their own
+gsm_extension = u'\x0c^{}\\[~]|€'
+
+# unicode.translate tables that delete the characters of a set
+delete_basic = dict((ord(char), None) for char in gsm_basic)
+delete_extension = dict((ord(char), None) for char in gsm_extension)
+
+GSM = 'gsm'
+UCS2 = 'ucs2'
+
+# characters in a single part message and in every part of a concatenated
+# message, which loses some to the header saying which part it is
+segment_sizes = {
+    GSM: (160, 153),
+    UCS2: (70, 67),
+}
+
+def count_segments(length, widths, single, multi):
+    """
+    Returns the number of parts a message of `length` units needs. A
+    character that takes two units is never split over two parts, `widths`
+    lists the width of every character if any take two.
+    """
+    if length <= single:
+        return 1
+    if widths is None:
+        return -(-length // multi)
+    segments, used = 1, 0
+    for width in widths:
+        if used + width > multi:
+            segments += 1
+            used = 0
+        used += width
+    return segments
+
+
+class TextInfo(object):
+    """
+    The encoding a text needs, its length in septets or UCS-2 code units
+    and the number of parts it's sent in.
+    """
+
+    __slots__ = ('encoding', 'length', 'segments')
+
+    def __init__(self, encoding, length, segments):
+        self.encoding = encoding
+        self.length = length
+        self.segments = segments
+
+    def __repr__(self):
+        return 'TextInfo: %s, %s units in %s parts' % (self.encoding,
+                                                self.length, self.segments)
+
+
+def decode_text(text, charset=None):
+    """
+    Returns a byte string as unicode, decoded with its `charset` if it is
+    known, otherwise as UTF-8 or, if it isn't valid UTF-8, as ISO-8859-1,
+    Clickatell's default.
+    """
+    if not isinstance(text, str):
+        return text
+    if charset:
+        return text.decode(charset)
+    try:
+        return text.decode('utf-8')
+    except UnicodeDecodeError:
+        return text.decode('iso-8859-1')
+
+def analyze(text):
+    """
+    Returns the TextInfo for a text, byte strings are decoded with
+    decode_text.
+    """
+    text = decode_text(text)
+    # delete the characters of the basic set, usually nothing remains
+    rest = text.translate(delete_basic)
+    if not rest or not rest.translate(delete_extension):
+        widths = None
+        if rest:
+            extension = set(gsm_extension)
+            widths = [2 if char in extension else 1 for char in text]
+        length = len(text) + len(rest)
+        single, multi = segment_sizes[GSM]
+        return TextInfo(GSM, length, count_segments(length, widths,
+                                                        single, multi))
+    # characters outside the basic multilingual plane take two code units,
+    # narrow Python builds already count them as two characters
+    encoded = text.encode('utf-16-be')
+    length = len(encoded) // 2
+    widths = None
+    if length != len(text):
+        widths = [2 if ord(char) > 0xFFFF else 1 for char in text]
+    single, multi = segment_sizes[UCS2]
+    return TextInfo(UCS2, length, count_segments(length, widths,
+                                                    single, multi))
+
+def ucs2_hex(text):
+    """
+    Clickatell expects unicode text as the hex of its UCS-2 encoding
+    """
+    text = decode_text(text)
+    return text.encode('utf-16-be').encode('hex').upper()
+
+
+class TextAnalyzer(object):
+    """
+    Analyzes outgoing texts and remembers the results for the `maxsize`
+    most recently used texts, campaigns repeat the same texts a lot.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def analyze(self, text):
+        with self.lock:
+            info = self.cache.pop(text, None)
+            if info is not None:
+                self.hits += 1
+                self.cache[text] = info
+                return info
+        info = analyze(text)
+        with self.lock:
+            self.misses += 1
+            self.cache[text] = info
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return info
+
+    def apply(self, options):
+        """
+        Sets the `unicode`, `concat` and `req_feat` options the text needs
+        and encodes texts the way Clickatell expects them: UCS-2 texts as
+        hex and GSM texts with characters outside ASCII as UTF-8, with
+        the `charset` option set. Byte strings are decoded with the
+        `charset` option if there is one.
+        """
+        text = decode_text(options['text'], options.get('charset'))
+        info = self.analyze(text)
+        features = 0
+        if info.encoding == UCS2:
+            options['unicode'] = cc.YES
+            options['text'] = ucs2_hex(text)
+            features |= cc.FEAT_UCS2
+        else:
+            text = text.encode('utf-8')
+            options['text'] = text
+            try:
+                text.decode('ascii')
+            except UnicodeDecodeError:
+                options['charset'] = cc.CHARSET_UTF8
+        if info.segments > 1:
+            options['concat'] = max(info.segments,
+                                    int(options.get('concat', 0)))
+            features |= cc.FEAT_CONCAT
+        if features:
+            options['req_feat'] = int(options.get('req_feat', 0)) | features
+        return options
+
+    def estimate(self, messages, charge=1):
+        """
+        Estimate the credits a campaign takes, `messages` is an iterable
+        of (text, number of recipients) tuples and every part costs
+        `charge` credits. Returns a dict with the number of `messages`,
+        `segments` and `credits`.
+        """
+        totals = {'messages': 0, 'segments': 0, 'credits': 0}
+        for text, recipients in messages:
+            segments = self.analyze(text).segments * recipients
+            totals['messages'] += recipients
+            totals['segments'] += segments
+        totals['credits'] = totals['segments'] * charge
+        return totals
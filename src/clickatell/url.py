@@ -1,25 +1,356 @@
 import urllib
 import urllib2
+import httplib
+import socket
 import logging
+import threading
+import time
+from urlparse import urlsplit
+from StringIO import StringIO
 from clickatell.utils import Dispatcher
+from clickatell.errors import PoolTimeoutError, ConnectError
 
-class URLDispatcher(Dispatcher):
+class PooledResponse(object):
+    """
+    Wraps an httplib response and hands the connection back to the pool
+    it came from once the body has been read completely.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def info(self):
+        return self.msg
+
+    def getcode(self):
+        return self.status
+
+    def read(self, amt=None):
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except Exception:
+            # a timeout or reset halfway through the body, the connection
+            # is in an unknown state and can't be reused
+            self.abandon()
+            raise
+        if amt is None or not data or self.response.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        """
+        Return the connection to the pool, it is closed instead if the
+        server indicated that it won't keep it alive.
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.response.will_close or not self.response.isclosed():
+            connection.close()
+            self.pool.discard(self.key)
+        else:
+            self.pool.put(self.key, connection)
+
+    def abandon(self):
+        """
+        Close the connection and give its slot in the pool back
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        self.response.close()
+        connection.close()
+        self.pool.discard(self.key)
+
+    def close(self):
+        """
+        Close the response. If the body wasn't read completely the
+        connection can't be reused and is dropped.
+        """
+        if self.connection is None:
+            return
+        if not self.response.isclosed():
+            self.abandon()
+        else:
+            self.release()
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent HTTP/1.1 connections, keyed by scheme, host & port.
+
+    At most `maxsize` connections are open per host, callers asking for
+    more wait until one is handed back, for at most `wait_timeout` seconds
+    before a PoolTimeoutError is raised. This limits the concurrency of
+    everything sharing the pool, callers that run more requests at a time
+    raise the limit with `ensure()`. Connections that have been idle for
+    longer than `idle_timeout` seconds are closed instead of reused.
+    """
+
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    def __init__(self, maxsize=4, idle_timeout=30,
+                    timeout=socket._GLOBAL_DEFAULT_TIMEOUT, wait_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.active = {}
+
+    def ensure(self, size):
+        """
+        Allow at least `size` connections per host
+        """
+        self.condition.acquire()
+        try:
+            if size > self.maxsize:
+                self.maxsize = size
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def key_for(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        return scheme, parts.hostname, port
+
+    def new_connection(self, key):
+        scheme, host, port = key
+        connection_class = self.connection_classes[scheme]
+        logging.debug('Opening new connection to %s://%s:%s' % key)
+        return connection_class(host, port, timeout=self.timeout)
+
+    def evict_idle(self, key=None):
+        """
+        Close all connections that have been idle for too long, for
+        the given key or for all hosts if no key is specified.
+        """
+        self.condition.acquire()
+        try:
+            now = time.time()
+            keys = [key] if key else self.idle.keys()
+            for k in keys:
+                fresh = []
+                for connection, last_used in self.idle.get(k, []):
+                    if now - last_used > self.idle_timeout:
+                        connection.close()
+                        self.active[k] -= 1
+                    else:
+                        fresh.append((connection, last_used))
+                self.idle[k] = fresh
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get(self, key):
+        """
+        Returns a tuple of (connection, reused) for the given key, blocking
+        if the maximum number of connections for this host are in use.
+        """
+        self.evict_idle(key)
+        deadline = time.time() + self.wait_timeout
+        self.condition.acquire()
+        try:
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    connection, last_used = idle.pop()
+                    return connection, True
+                if self.active.get(key, 0) < self.maxsize:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeoutError, 'No connection to %s://%s:%s ' \
+                            'became available within %ss' % (key + 
+                                                        (self.wait_timeout,))
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+        return self.new_connection(key), False
+
+    def put(self, key, connection):
+        self.condition.acquire()
+        try:
+            self.idle.setdefault(key, []).append((connection, time.time()))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def discard(self, key):
+        """
+        Forget about a connection that has been closed.
+        """
+        self.condition.acquire()
+        try:
+            self.active[key] -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        self.condition.acquire()
+        try:
+            for key, idle in self.idle.items():
+                for connection, last_used in idle:
+                    connection.close()
+                    self.active[key] -= 1
+            self.idle = {}
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def reset(self):
+        """
+        Forget all connections, for use in a child process that shares the
+        sockets of its parent. The idle ones are closed in the child only.
+        """
+        self.condition = threading.Condition()
+        for key, idle in self.idle.items():
+            for connection, last_used in idle:
+                connection.close()
+        self.idle = {}
+        self.active = {}
     
+    def urlopen(self, method, url, body=None, headers={}):
+        """
+        Send a request over a pooled connection and return a PooledResponse.
+        Raises urllib2.HTTPError for error statuses, like urllib2.urlopen.
+        """
+        key = self.key_for(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        while True:
+            connection, reused = self.get(key)
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except socket.error, e:
+                    connection.close()
+                    self.discard(key)
+                    raise ConnectError(*e.args)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                self.discard(key)
+                # the server may have dropped an idle keep-alive connection,
+                # that's only worth a retry if the connection was reused.
+                # A timeout means the server got the request but is slow.
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                logging.debug('Stale connection to %s://%s:%s, retrying' % key)
+        pooled = PooledResponse(self, key, connection, response)
+        if not 200 <= pooled.status < 300:
+            # read the body so the connection can be reused
+            raise urllib2.HTTPError(url, pooled.status, pooled.reason,
+                                    pooled.msg, StringIO(pooled.read()))
+        return pooled
+
+
+def urlencode(data):
+    """
+    urllib.urlencode, with unicode values sent as UTF-8
+    """
+    return urllib.urlencode([(key, value.encode('utf-8')
+                                if isinstance(value, unicode) else value)
+                                for key, value in data.items()])
+
+
+class Transport(Dispatcher):
+    """
+    The interface HttpClient sends its requests through. Transports 
+    implement `do_get` and `do_post`, which take the url, a dict of data 
+    and a dict of headers and return a (request, response) tuple. The 
+    response needs `read([amt])` and `close()` methods.
+    """
+
+    def open(self, method, url, data={}, headers={}):
+        return self.dispatch(method, url, data, headers)
+
+    def ensure(self, size):
+        """
+        Allow at least `size` requests at a time, transports without a
+        connection pool don't limit them.
+        """
+        pass
+
+
+class URLDispatcher(Transport):
+    """
+    The default transport, sends requests over a pool of keep-alive
+    connections.
+    """
+
+    def __init__(self, pool=None, *args, **kwargs):
+        super(URLDispatcher, self).__init__(*args, **kwargs)
+        self.pool = pool or ConnectionPool()
+
+    def ensure(self, size):
+        self.pool.ensure(size)
+
+    def do_post(self, url, data, headers):
+        params = urlencode(data)
+        request = urllib2.Request(url, params, headers)
+        if not request.has_header('Content-type'):
+            request.add_header('Content-type',
+                                'application/x-www-form-urlencoded')
+        logging.debug('POST %s with %s' % (url, data))
+        return request, self.pool.urlopen('POST', url, params,
+                                            dict(request.header_items()))
+
+    def do_get(self, url, data, headers):
+        params = urlencode(data)
+        full_url = "%s?%s" % (url, params)
+        logging.debug('GET %s' % full_url)
+        request = urllib2.Request(full_url, None, headers)
+        return request, self.pool.urlopen('GET', full_url, None,
+                                            dict(request.header_items()))
+
+
+class URLLibTransport(Transport):
+    """
+    Sends every request over a new connection with urllib2.urlopen
+    """
+
     def do_post(self, url, data, headers):
-        params = urllib.urlencode(data)
-        request = urllib2.Request(url, data, headers)
+        params = urlencode(data)
+        request = urllib2.Request(url, params, headers)
         logging.debug('POST %s with %s' % (url, data))
         return request, urllib2.urlopen(request)
 
     def do_get(self, url, data, headers):
-        params = urllib.urlencode(data)
+        params = urlencode(data)
         full_url = "%s?%s" % (url, params)
         logging.debug('GET %s' % full_url)
         request = urllib2.Request(full_url, None, headers)
         return request, urllib2.urlopen(request)
-    
 
-url_dispatcher = URLDispatcher()
+
+pool = ConnectionPool()
+url_dispatcher = URLDispatcher(pool)
 
 def open(method, url, data={}, headers={}):
-    return url_dispatcher.dispatch(method, url, data, headers)
+    return url_dispatcher.open(method, url, data, headers)
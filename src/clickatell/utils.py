@@ -4,11 +4,27 @@ class Dispatcher(object):
     
     def __init__(self, prefix="do_"):
         self.prefix = prefix
+        self.handlers = {}
     
-    def dispatch(self, command, *args, **kwargs):
-        command_name = '%s%s' % (self.prefix, command.lower())
-        if hasattr(self, command_name):
-            fn = getattr(self, command_name)
-            return fn(*args, **kwargs)
-        raise ClickatellError, 'No dispatcher available for %s' % command
+    def handler(self, command):
+        """
+        Returns the method handling the given command, lookups are cached
+        so only the first one for a command pays for resolving it.
+        """
+        try:
+            return self.handlers[command]
+        except KeyError:
+            command_name = '%s%s' % (self.prefix, command.lower())
+            if hasattr(self, command_name):
+                fn = self.handlers[command] = getattr(self, command_name)
+                return fn
+            raise ClickatellError, 'No dispatcher available for %s' % command
     
+    def dispatch(self, command, *args, **kwargs):
+        return self.handler(command)(*args, **kwargs)
+
+def chunks(items, size):
+    """
+    Split a list of items into lists of at most `size` items
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -1,19 +1,57 @@
-from clickatell.utils import Dispatcher
+import operator
+from clickatell.utils import Dispatcher, chunks
 from clickatell.errors import ClickatellError
 from datetime import datetime, timedelta
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# characters people format MSISDNs with, they're stripped when normalising
+msisdn_formatting = ' +-()'
+
 class Validator(Dispatcher):
     
+    def __init__(self, *args, **kwargs):
+        super(Validator, self).__init__(*args, **kwargs)
+        self.compile()
+    
     def validate_to(self, recipients):
-        if any([recipient.startswith('+') or recipient.startswith('0')
-                for recipient in recipients]):
+        to = ','.join(recipients)
+        # a recipient starts with a '+' or '0' if the joined string does or
+        # if one follows a comma, without a loop over the recipients
+        if to.startswith(('+', '0')) or ',+' in to or ',0' in to:
             raise ClickatellError, "SMS messages need to be sent in the " \
                                     "standard international format, with " \
                                     "country code followed by number. No " \
                                     "leading zero to the number and no " \
                                     "special characters such as '+' or " \
                                     "spaces must be used."
-        return ','.join(recipients)
+        return to
+    
+    def validate_recipients(self, recipients, dedupe=False, chunk_size=None,
+                            min_length=8, max_length=15):
+        """
+        Validate & normalise a bulk list of MSISDNs in one pass, returns a 
+        tuple of the comma separated `to` value, or a list of them for 
+        every `chunk_size` recipients, and the indices of the invalid ones.
+        
+        Accepts lists of strings or integers, arrays and NumPy arrays. 
+        Spaces, dashes, brackets and '+' are stripped, what remains has to 
+        be `min_length` to `max_length` digits without a leading zero.
+        With `dedupe` only the first of duplicate MSISDNs is kept.
+        """
+        if numpy is not None and isinstance(recipients, numpy.ndarray):
+            valid, bad = normalise_array(recipients, min_length, max_length,
+                                            dedupe)
+        else:
+            valid, bad = normalise_list(recipients, min_length, max_length,
+                                            dedupe)
+        if chunk_size:
+            return [','.join(chunk) for chunk in chunks(valid, chunk_size)], \
+                    bad
+        return ','.join(valid), bad
     
     def validate_from(self, _from):
         if _from.isdigit() and len(_from) <= 16:
@@ -44,35 +82,133 @@ class Validator(Dispatcher):
             return value
         raise ClickatellError, "Must be a numeric value, max: %s" % maximum
     
-    def validate(self, options):
-        # timedeltas, validated to return minutes
-        timedeltas = ['deliv_time', 'validity']
-        for option in timedeltas:
-            if option in options:
-                options[option] = self.dispatch('timedelta', options.pop(option))
-        
-        # number, validated to ensure they are indeed numbers
-        numbers = ['concat', 'max_credits', 'req_feat']
-        for option in numbers:
-            if option in options:
-                options[option] = self.dispatch('number', options.pop(option))
-        
-        # timestamps, returned in Mysql timestamp format
-        timestamps = ['scheduled_time']
-        for option in timestamps:
-            if option in options:
-                options[option] = self.dispatch('timestamp', options.pop(option))
-        
+    def compile(self):
+        """
+        Resolve the converter for every option once, instead of looking it
+        up by name on every call.
+        """
+        self.converters = (
+            # timedeltas, validated to return minutes
+            ('deliv_time', self.validate_timedelta),
+            ('validity', self.validate_timedelta),
+            # number, validated to ensure they are indeed numbers
+            ('concat', self.validate_number),
+            ('max_credits', self.validate_number),
+            ('req_feat', self.validate_number),
+            # timestamps, returned in Mysql timestamp format
+            ('scheduled_time', self.validate_timestamp),
+            ('text', self.validate_text),
+        )
+    
+    def convert(self, options):
+        """
+        Convert the options in place, without checking whether they are 
+        complete.
+        """
+        for name, convert in self.converters:
+            if name in options:
+                options[name] = convert(options[name])
+        if 'sender' in options:
+            options['from'] = self.validate_from(options.pop('sender'))
+        return options
+    
+    def check(self, options, sender):
         # if from is specified then make sure something's been set as the
         # req_feat parameter as well.
-        if 'sender' in options:
-            options['from'] = self.dispatch('from', options.pop('sender'))
-            if 'req_feat' not in options:
-                raise ClickatellError, 'When specifying `sender` you also '\
-                                        'need to specify the `req_feat` ' \
-                                        'parameter'
+        if sender and 'req_feat' not in options:
+            raise ClickatellError, 'When specifying `sender` you also '\
+                                    'need to specify the `req_feat` ' \
+                                    'parameter'
+    
+    def validate(self, options):
+        sender = 'sender' in options
+        self.convert(options)
+        self.check(options, sender)
         return options
-        
+    
+    def validate_with_defaults(self, options, defaults):
+        """
+        Validate the options and add the `defaults`, which are compiled 
+        once with `compile_defaults`. The defaults take precedence.
+        """
+        defaults, default_sender = defaults
+        sender = 'sender' in options or default_sender
+        self.convert(options)
+        options.update(defaults)
+        self.check(options, sender)
+        return options
+    
+    def compile_defaults(self, defaults):
+        """
+        Returns the converted defaults for validate_with_defaults
+        """
+        return self.convert(dict(defaults)), 'sender' in defaults
+
+def normalise_list(recipients, min_length, max_length, dedupe):
+    """
+    Returns the list of normalised MSISDNs and the indices of invalid ones.
+
+    The checks run over all recipients at once with string & builtin 
+    functions implemented in C, only if some recipients are invalid are 
+    they checked one by one to find out which.
+    """
+    if hasattr(recipients, 'tolist'):
+        recipients = recipients.tolist()
+    try:
+        msisdns = map(str, recipients)
+    except UnicodeEncodeError:
+        msisdns = [unicode(recipient).encode('ascii', 'replace')
+                    for recipient in recipients]
+    msisdns = map(operator.methodcaller('translate', None, msisdn_formatting),
+                    msisdns)
+    lengths = map(len, msisdns)
+    joined = ','.join(msisdns)
+    # a comma inside a recipient would split it in two, every comma has
+    # to be one of the separators
+    if msisdns and not joined.translate(None, '0123456789,') and \
+        joined.count(',') == len(msisdns) - 1 and \
+        min(lengths) >= min_length and max(lengths) <= max_length and \
+        not joined.startswith('0') and ',0' not in joined:
+        bad = []
+    else:
+        bad = [index for index, msisdn in enumerate(msisdns)
+                if not (msisdn.isdigit() and 
+                        min_length <= len(msisdn) <= max_length and
+                        msisdn[0] != '0')]
+        if bad:
+            invalid = set(bad)
+            msisdns = [msisdn for index, msisdn in enumerate(msisdns)
+                        if index not in invalid]
+    if dedupe and len(set(msisdns)) != len(msisdns):
+        seen = set()
+        add = seen.add
+        msisdns = [msisdn for msisdn in msisdns
+                    if not (msisdn in seen or add(msisdn))]
+    return msisdns, bad
+
+def normalise_array(recipients, min_length, max_length, dedupe):
+    """
+    normalise_list for NumPy arrays of integers or strings, without a 
+    Python level loop over the recipients.
+    """
+    if recipients.dtype.kind in 'iu':
+        msisdns = recipients.astype('int64')
+        ok = (msisdns >= 10 ** (min_length - 1)) & \
+                (msisdns < 10 ** max_length)
+    else:
+        msisdns = recipients.astype('S')
+        for char in msisdn_formatting:
+            msisdns = numpy.char.replace(msisdns, char, '')
+        lengths = numpy.char.str_len(msisdns)
+        ok = numpy.char.isdigit(msisdns) & (lengths >= min_length) & \
+                (lengths <= max_length) & \
+                ~numpy.char.startswith(msisdns, '0')
+    bad = numpy.flatnonzero(~ok).tolist()
+    msisdns = msisdns[ok]
+    if dedupe:
+        unique, first = numpy.unique(msisdns, return_index=True)
+        msisdns = msisdns[numpy.sort(first)]
+    return msisdns.astype('S').tolist(), bad
 
 validator = Validator(prefix="validate_")
 validate = validator.validate
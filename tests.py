@@ -1,12 +1,49 @@
-from unittest import TestCase
-from clickatell.api import Clickatell
-from clickatell.errors import ClickatellError
-from clickatell.response import ERRResponse, OKResponse, ApiMsgIdResponse
+from unittest import TestCase, skipUnless
+from clickatell.api import Clickatell, AsyncClickatell
+from clickatell.errors import ClickatellError, CircuitOpenError, \
+    PoolTimeoutError, ConnectError, PartialSendError
+from clickatell.retry import RetryPolicy, CircuitBreaker
+from clickatell.response import ERRResponse, OKResponse, ApiMsgIdResponse, \
+                                IDResponse, ResponseSet
 from clickatell import constants as cc
 from clickatell import validators
 from clickatell.tests.mock import TestClient
+from clickatell.tests.server import LocalServer, LocalRequestHandler, \
+    ClickatellServer
+from clickatell import url
+from clickatell.http import HttpClient, iter_lines
+from StringIO import StringIO
+from array import array
+from clickatell.session import SessionManager, FileSessionStore
+from clickatell.client import Client, AsyncClient
+from clickatell.coalesce import Coalescer
+from clickatell.futures import Future
+from clickatell.registry import BatchRegistry
+from clickatell.planner import Planner
+from clickatell.poller import StatusPoller
+from clickatell.status import StatusStore, SQLiteStatusStore
+from clickatell.coverage import CoverageCache
+from clickatell.callbacks import CallbackRecord, CallbackApp, \
+    CallbackReceiver, CallbackServer, MicroBatcher, QueueSink, FileSink, \
+    SQLiteSink, parse_callback
+from clickatell.text import TextAnalyzer, analyze, GSM, UCS2
+from clickatell.outbox import Outbox, OutboxWorker, SenderPool
+from clickatell.ratelimit import TokenBucket, FileTokenBucket, Governor
+from clickatell.idempotency import DedupIndex, SQLiteDedupIndex, PENDING
+from clickatell import idempotency
 from datetime import datetime, timedelta
 
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import urllib2
+
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -195,9 +232,31 @@ class ClickatellTestCase(TestCase):
         clickatell.session_id = 'session_id'
         clickatell.client.mock('GET', getbalance_url, {
             'session_id': 'session_id'
-        }, response=clickatell.client.parse_content('ERR: 003, Session ID Expired'))
+        }, response=clickatell.client.parse_content('ERR: 301, No Credit Left'))
         self.assertRaises(ClickatellError, clickatell.getbalance)
     
+    def test_getbalance_session_fail(self):
+        """
+        A rejected session is refreshed and the call retried only once
+        """
+        clickatell = Clickatell('username', 'password', 'api_id', 
+                                    client_class=TestClient)
+        clickatell.session_id = 'session_id'
+        client = clickatell.client
+        client.mock('GET', getbalance_url, {
+            'session_id': 'session_id'
+        }, response=client.parse_content('ERR: 003, Session ID Expired'))
+        client.mock('GET', auth_url, {
+            'user': 'username',
+            'password': 'password',
+            'api_id': 'api_id'
+        }, response=client.parse_content('OK: new_session_id'))
+        client.mock('GET', getbalance_url, {
+            'session_id': 'new_session_id'
+        }, response=client.parse_content('ERR: 003, Session ID Expired'))
+        self.assertRaises(ClickatellError, clickatell.getbalance)
+        self.assertTrue(client.all_mocks_called())
+    
     def test_check_coverage(self):
         clickatell = Clickatell('username', 'password', 'api_id',
                                     client_class=TestClient)
@@ -449,6 +508,144 @@ class SessionTestCase(TestCase):
         self.assertTrue(clickatell.client.all_mocks_called())
     
 
+class SessionManagerTestCase(TestCase):
+    def setUp(self):
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                                        client_class=TestClient)
+        self.client = self.clickatell.client
+        self.client.mock('GET', auth_url, {
+            'user': 'username',
+            'password': 'password',
+            'api_id': 'api_id'
+        }, response=self.client.parse_content('OK: new_session_id'))
+    
+    def test_reauthentication_on_rejected_session(self):
+        self.clickatell.session_id = 'old_session_id'
+        self.client.mock('GET', getbalance_url, {
+            'session_id': 'old_session_id'
+        }, response=self.client.parse_content('ERR: 003, Session ID Expired'))
+        self.client.mock('GET', getbalance_url, {
+            'session_id': 'new_session_id'
+        }, response=self.client.parse_content('Credit: 10.0'))
+        self.assertEquals(self.clickatell.getbalance(), 10.0)
+        self.assertEquals(self.clickatell.session_id, 'new_session_id')
+        self.assertTrue(self.client.all_mocks_called())
+    
+    def test_single_inflight_authentication(self):
+        calls = []
+        get_new_session_id = self.clickatell.get_new_session_id
+        def slow_get_new_session_id():
+            calls.append(1)
+            time.sleep(0.05)
+            return get_new_session_id()
+        self.clickatell.get_new_session_id = slow_get_new_session_id
+        session_ids = []
+        threads = [threading.Thread(target=lambda: 
+                        session_ids.append(self.clickatell.session_id))
+                    for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(calls, [1])
+        self.assertEquals(session_ids, ['new_session_id'] * 10)
+    
+    def test_keepalive(self):
+        pings = []
+        class StubClickatell(object):
+            def ping(stub):
+                pings.append(1)
+                session.touch()
+        session = SessionManager(StubClickatell(), 
+                                    timeout=timedelta(seconds=0.3),
+                                    refresh_margin=timedelta(seconds=0.2))
+        session.set('session_id')
+        session.start_keepalive()
+        time.sleep(0.35)
+        session.stop_keepalive()
+        self.assertTrue(len(pings) >= 2)
+        self.assertFalse(session.expired())
+
+    def test_keepalive_waits_for_async_pings(self):
+        pings = []
+        class StubClickatell(object):
+            def ping(stub):
+                pings.append(1)
+                future = Future()
+                def reject():
+                    time.sleep(0.05)
+                    try:
+                        raise ClickatellError, 'Session ID Expired'
+                    except ClickatellError:
+                        future.set_exception(sys.exc_info())
+                threading.Thread(target=reject).start()
+                return future
+        session = SessionManager(StubClickatell(),
+                                    timeout=timedelta(seconds=0.3),
+                                    refresh_margin=timedelta(seconds=0.3))
+        session.set('session_id')
+        refreshes = []
+        session.refresh = lambda stale=None: refreshes.append(stale)
+        session.start_keepalive()
+        time.sleep(0.2)
+        session.stop_keepalive()
+        # one ping at a time, and a rejected one refreshes the session
+        self.assertTrue(len(pings) <= 10, len(pings))
+        self.assertTrue('session_id' in refreshes)
+
+class SessionStoreTestCase(TestCase):
+    """Verify processes on the same host share a session"""
+    def setUp(self):
+        self.server = LocalServer(response='OK: shared_session_id').start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session')
+    
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+    
+    def clickatell(self):
+        return Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url),
+                            session_store=FileSessionStore(self.path))
+    
+    def test_processes_share_session(self):
+        queue = multiprocessing.Queue()
+        def worker():
+            queue.put(self.clickatell().session_id)
+        processes = [multiprocessing.Process(target=worker) 
+                        for i in range(4)]
+        for process in processes:
+            process.start()
+        session_ids = [queue.get(timeout=5) for process in processes]
+        for process in processes:
+            process.join()
+        self.assertEquals(session_ids, ['shared_session_id'] * 4)
+        auth_requests = [path for method, path, body in self.server.requests
+                            if path.startswith('/http/auth')]
+        self.assertEquals(len(auth_requests), 1)
+    
+    def test_stale_session_is_not_reused(self):
+        clickatell = self.clickatell()
+        clickatell.session_id = 'stale_session_id'
+        clickatell.session.refresh(stale='stale_session_id')
+        self.assertEquals(self.clickatell().session_id, 'shared_session_id')
+
+    def test_stored_as_json(self):
+        store = FileSessionStore(self.path)
+        start_time = datetime(2012, 1, 2, 3, 4, 5)
+        store.save('session_id', start_time)
+        self.assertEquals(store.load(), ('session_id', start_time))
+        self.assertEquals(json.load(open(self.path)), {
+            'session_id': 'session_id',
+            'start_time': '2012-01-02T03:04:05.000000',
+        })
+        store.save(None, None)
+        self.assertEquals(store.load(), (None, None))
+        # anything else, like an old pickled session, is no session
+        open(self.path, 'wb').write("(S'session_id'\np0\nNtp1\n.")
+        self.assertEquals(store.load(), (None, None))
+
 class AuthenticationTestCase(TestCase):
     """Test authentication schemes"""
     def test_ok_authentication(self):
@@ -512,6 +709,95 @@ class ResponseTestCase(TestCase):
         resp = OKResponse("apiMsgId To: 27123456782")
         self.assertEquals(resp.value, 'apiMsgId')
         self.assertEquals(resp.extra, {'To':'27123456782'})
+    
+    def test_parsing_of_decimal_values(self):
+        resp = ApiMsgIdResponse("apimsgid charge: 1.5 status: 002")
+        self.assertEquals(resp.value, 'apimsgid')
+        self.assertEquals(resp.extra, {'charge': '1.5', 'status': '002'})
+    
+    def test_parsing_keeps_remaining_text(self):
+        resp = OKResponse("This prefix is supported. Charge: 1. Thanks")
+        self.assertEquals(resp.value, 'This prefix is supported. . Thanks')
+        self.assertEquals(resp.extra, {'Charge': '1'})
+
+class ParsingTestCase(TestCase):
+    """Test tokenizing of response bodies"""
+    def test_parse_content(self):
+        client = TestClient()
+        self.assertEquals(client.parse_content(" ID: a To: 1 \r\n\n"
+                                                "  \nOK\nERR: 001, x: y"), [
+            ('ID', 'a To: 1'),
+            ('OK', ''),
+            ('ERR', '001, x: y'),
+        ])
+    
+    def test_unknown_response(self):
+        client = TestClient()
+        self.assertRaises(ClickatellError, client.process_response,
+                            client.parse_content('FOO: bar'))
+
+class StreamingTestCase(TestCase):
+    """Verify response bodies can be parsed while they are read"""
+    def test_iter_lines(self):
+        body = StringIO('ID: apimsgid1\nID: apimsgid2\n\nID: apimsgid3')
+        self.assertEquals(list(iter_lines(body, chunk_size=5)), 
+                            ['ID: apimsgid1', 'ID: apimsgid2', '', 
+                                'ID: apimsgid3'])
+        self.assertTrue(body.closed)
+    
+    def test_stream(self):
+        server = LocalServer(response='ID: apimsgid1\nID: apimsgid2\n')
+        server.start()
+        try:
+            responses = HttpClient().stream('get', server.url, {})
+            self.assertEquals(list(responses), [('ID', 'apimsgid1'), 
+                                                ('ID', 'apimsgid2')])
+        finally:
+            server.stop()
+
+    def test_unread_streams_release_connections(self):
+        server = ClickatellServer().start()
+        try:
+            pool = url.ConnectionPool(maxsize=2, wait_timeout=0.5)
+            client = Client(server.url, transport=url.URLDispatcher(pool))
+            for i in range(6):
+                client.http('getbalance', {}, stream=True)
+            [resp] = client.http('getbalance', {})
+            self.assertTrue(isinstance(resp, ERRResponse))
+        finally:
+            server.stop()
+    
+    def test_stream_with_dedup_index(self):
+        clickatell = Clickatell('username', 'password', 'api_id',
+                                client_class=TestClient,
+                                dedup_index=DedupIndex())
+        self.assertRaises(ClickatellError, clickatell.sendmsg,
+                            recipients=['27123456781'], text='hello world',
+                            stream=True)
+
+class ResponseSetTestCase(TestCase):
+    """Verify the compact ResponseSet"""
+    def setUp(self):
+        client = TestClient()
+        self.responses = client.process_response(client.parse_content(
+            'ID: apimsgid1 To: 27123456781\n'
+            'ERR: 114, Cannot route message To: 27123456782\n'
+            'ID: apimsgid3 To: 27123456783\n'), response_set=True)
+    
+    def test_aggregates(self):
+        self.assertEquals(self.responses.errors(), 
+                            [(1, 114, 'Cannot route message To: 27123456782')])
+        self.assertEquals(self.responses.apimsgids(), 
+                            ['apimsgid1', None, 'apimsgid3'])
+        self.assertEquals(self.responses.apimsgid_for('27123456783'), 
+                            'apimsgid3')
+    
+    def test_lazy_responses(self):
+        self.assertEquals(self.responses[-1].value, 'apimsgid3')
+        self.assertEquals(self.responses[1].code, 114)
+        self.assertEquals([r.value for r in self.responses[::2]],
+                            ['apimsgid1', 'apimsgid3'])
+        self.assertFalse(hasattr(self.responses[0], '__dict__'))
 
 class MockingTestCase(TestCase):
     """
@@ -571,3 +857,1655 @@ class ValidatorsTestCase(TestCase):
 
     def test_validate_from_too_long(self):
         self.assertIsNotAcceptableSender('Company12345')
+    
+    def test_compiled_defaults(self):
+        defaults = validators.validator.compile_defaults({
+            'validity': timedelta(hours=1), 'req_feat': 1})
+        options = validators.validator.validate_with_defaults({
+            'sender': 'Company', 'validity': timedelta(hours=2),
+            'scheduled_time': datetime(2010, 1, 1)}, defaults)
+        self.assertEquals(options, {'from': 'Company', 'validity': 60, 
+                                    'req_feat': 1, 
+                                    'scheduled_time': '2010-01-01 00:00:00'})
+        defaults = validators.validator.compile_defaults({
+            'sender': 'Company'})
+        self.assertRaises(ClickatellError, 
+                            validators.validator.validate_with_defaults,
+                            {'text': 'hello'}, defaults)
+    
+    def test_validate_recipients(self):
+        to, bad = self.validator.validate_recipients(['+27 12 345-6781', 
+                        '0027123456781', '27123456782', 'abc', 27123456783,
+                        '271', '27123456782'], dedupe=True)
+        self.assertEquals(to, '27123456781,27123456782,27123456783')
+        self.assertEquals(bad, [1, 3, 5])
+    
+    def test_validate_recipients_with_comma(self):
+        to, bad = self.validator.validate_recipients(['2782123,4567', 
+                                                        '27123456781'])
+        self.assertEquals(to, '27123456781')
+        self.assertEquals(bad, [0])
+    
+    def test_validate_recipients_chunks(self):
+        recipients = array('l', [27123456781, 27123456782, 27123456783])
+        chunks, bad = self.validator.validate_recipients(recipients, 
+                                                            chunk_size=2)
+        self.assertEquals(chunks, ['27123456781,27123456782', '27123456783'])
+        self.assertEquals(bad, [])
+
+@skipUnless(validators.numpy, 'NumPy is not installed')
+class NumpyValidatorsTestCase(TestCase):
+    """Verify NumPy arrays are normalised like lists"""
+    
+    def assertNormalisedLikeList(self, recipients, min_length=8, 
+                                    max_length=15, dedupe=False):
+        import numpy
+        self.assertEquals(validators.normalise_array(numpy.array(recipients),
+                                min_length, max_length, dedupe),
+                            validators.normalise_list(recipients, min_length,
+                                max_length, dedupe))
+    
+    def test_strings(self):
+        self.assertNormalisedLikeList(['+27 12 345-6781', '0027123456781',
+                                        '(27) 123456782', 'abc', '271',
+                                        '27123456782', '27123456781',
+                                        '2782123,4567'], dedupe=True)
+    
+    def test_integers(self):
+        self.assertNormalisedLikeList([27123456783, 27123456781, 271,
+                                        27123456781, 10 ** 15, 10 ** 14],
+                                        dedupe=True)
+    
+    def test_length_bounds(self):
+        self.assertNormalisedLikeList(['2712345', '27123456', 
+                                        '271234567812345', 
+                                        '2712345678123456'])
+        self.assertNormalisedLikeList([2712345, 27123456, 271234567812345,
+                                        2712345678123456])
+        self.assertNormalisedLikeList(['27123', '271234', '2712345'], 
+                                        min_length=6, max_length=6)
+    
+    def test_duplicates_kept(self):
+        self.assertNormalisedLikeList(['27123456782', '27123456781',
+                                        '27123456782'])
+    
+    def test_validate_recipients(self):
+        import numpy
+        recipients = ['+27 12 345-6781', 'abc', '27123456782', 
+                        '27123456781']
+        self.assertEquals(validators.validator.validate_recipients(
+                                numpy.array(recipients), dedupe=True,
+                                chunk_size=1),
+                            validators.validator.validate_recipients(
+                                recipients, dedupe=True, chunk_size=1))
+
+class ConnectionPoolTestCase(TestCase):
+    """Verify connections are kept alive and reused"""
+    def setUp(self):
+        self.server = LocalServer(response='ID: apimsgid').start()
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_connection_reuse(self):
+        dispatcher = url.URLDispatcher(url.ConnectionPool())
+        for i in range(3):
+            request, response = dispatcher.dispatch('get',
+                '%s/http/sendmsg' % self.server.url, {'to': i}, {})
+            self.assertEquals(response.read(), 'ID: apimsgid')
+        self.assertEquals(len(self.server.requests), 3)
+        self.assertEquals(len(self.server.connections), 1)
+    
+    def test_post(self):
+        dispatcher = url.URLDispatcher(url.ConnectionPool())
+        request, response = dispatcher.dispatch('post',
+            '%s/http/sendmsg' % self.server.url, {'to': '27123456789'}, {})
+        self.assertEquals(response.read(), 'ID: apimsgid')
+        self.assertEquals(self.server.requests,
+                            [('POST', '/http/sendmsg', 'to=27123456789')])
+    
+    def test_idle_eviction(self):
+        pool = url.ConnectionPool(idle_timeout=-1)
+        for i in range(2):
+            pool.urlopen('GET', '%s/http/ping' % self.server.url).read()
+        self.assertEquals(len(self.server.connections), 2)
+        self.assertEquals(pool.active, {('http', '127.0.0.1',
+                                        self.server.server_address[1]): 1})
+
+    def test_wait_timeout(self):
+        pool = url.ConnectionPool(maxsize=1, wait_timeout=0.1)
+        response = pool.urlopen('GET', '%s/http/ping' % self.server.url)
+        self.assertRaises(PoolTimeoutError, pool.urlopen, 'GET',
+                            '%s/http/ping' % self.server.url)
+        response.read()
+        pool.ensure(2)
+        self.assertEquals(pool.maxsize, 2)
+        pool.urlopen('GET', '%s/http/ping' % self.server.url).read()
+    
+    def test_failed_reads_release_connections(self):
+        class StallingHandler(LocalRequestHandler):
+            def respond(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '100')
+                self.end_headers()
+                self.wfile.write('ID: ')
+                self.wfile.flush()
+                time.sleep(0.5)
+        server = LocalServer(handler_class=StallingHandler).start()
+        try:
+            pool = url.ConnectionPool(maxsize=2, timeout=0.1, 
+                                        wait_timeout=1)
+            client = HttpClient()
+            client.transport = url.URLDispatcher(pool)
+            for i in range(3):
+                self.assertRaises(socket.timeout, client.get, 
+                                    '%s/http/ping' % server.url)
+            self.assertEquals(pool.active.values(), [0])
+        finally:
+            server.stop()
+
+class AsyncTestCase(TestCase):
+    """Verify the Future returning API"""
+    def setUp(self):
+        self.clickatell = AsyncClickatell('username', 'password', 'api_id',
+                                    client_class=TestClient,
+                                    sendmsg_defaults=sendmsg_defaults)
+        self.clickatell.session_id = 'session_id'
+    
+    def test_sendmsg(self):
+        client = self.clickatell.client
+        for i in range(1, 4):
+            client.mock('GET', sendmsg_url, merge_with_defaults({
+                'session_id': 'session_id',
+                'to': '2712345678%s' % i,
+                'text': 'hello world'
+            }), response=client.parse_content('ID: apimsgid%s' % i))
+        futures = [self.clickatell.sendmsg(recipients=['2712345678%s' % i],
+                                            text='hello world')
+                    for i in range(1, 4)]
+        self.assertEquals([f.result()[0].value for f in futures],
+                            ['apimsgid1', 'apimsgid2', 'apimsgid3'])
+        self.assertTrue(client.all_mocks_called())
+    
+    def test_getbalance_fail(self):
+        self.clickatell.client.mock('GET', getbalance_url, {
+            'session_id': 'session_id'
+        }, response=self.clickatell.client.parse_content('ERR: 301, '
+                                                            'No Credit Left'))
+        future = self.clickatell.getbalance()
+        self.assertRaises(ClickatellError, future.result)
+    
+    def test_batch(self):
+        client = self.clickatell.client
+        client.mock('GET', batch_start_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'template': 'Hello world!',
+        }), response=client.parse_content('ID: batch_id'))
+        client.mock('GET', batch_quicksend_url, {
+            'session_id': 'session_id',
+            'batch_id': 'batch_id',
+            'to': '27123456781,27123456782'
+        }, response=client.parse_content('ID: apimsgid1\nID: apimsgid2'))
+        client.mock('GET', batch_end_url, {
+            'session_id': 'session_id',
+            'batch_id': 'batch_id'
+        }, response=client.parse_content('OK'))
+        with self.clickatell.batch(template='Hello world!') as batch:
+            future = batch.quicksend(recipients=['27123456781',
+                                                    '27123456782'])
+        self.assertTrue(future.done())
+        self.assertEquals([r.value for r in future.result()],
+                            ['apimsgid1', 'apimsgid2'])
+        self.assertTrue(client.all_mocks_called())
+    
+    def test_async_client_options(self):
+        server = ClickatellServer().start()
+        try:
+            policy = RetryPolicy(max_attempts=2)
+            client = AsyncClient(base_url=server.url, retry_policy=policy,
+                                    max_workers=2)
+            self.assertTrue(client.retry_policy is policy)
+            [resp] = client.http('getbalance', {'session_id': 'x'}).result(1)
+            self.assertEquals(len(server.requests), 1)
+            client.workers.shutdown()
+        finally:
+            server.stop()
+
+class FanOutTestCase(TestCase):
+    """Verify long recipient lists are split over several requests"""
+    def setUp(self):
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                                    client_class=TestClient,
+                                    sendmsg_defaults=sendmsg_defaults,
+                                    max_recipients=2)
+        self.clickatell.session_id = 'session_id'
+    
+    def test_sendmsg(self):
+        client = self.clickatell.client
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456781,27123456782',
+            'text': 'hello world'
+        }), response=client.parse_content('ID: apimsgid1 To: 27123456781\n'
+                                            'ID: apimsgid2 To: 27123456782'))
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456783',
+            'text': 'hello world'
+        }), response=client.parse_content('ERR: 301, No Credit Left'))
+        [id1, id2, err] = self.clickatell.sendmsg(recipients=[
+                                                    '27123456781',
+                                                    '27123456782',
+                                                    '27123456783'],
+                                                text='hello world')
+        self.assertEquals(id1.extra, {'To': '27123456781'})
+        self.assertEquals(id2.extra, {'To': '27123456782'})
+        self.assertEquals(err.code, 301)
+        self.assertTrue(client.all_mocks_called())
+    
+    def test_sendmsg_response_set(self):
+        client = self.clickatell.client
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456781,27123456782',
+            'text': 'hello world'
+        }), response=client.parse_content('ID: apimsgid1 To: 27123456781\n'
+                                            'ID: apimsgid2 To: 27123456782'))
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456783',
+            'text': 'hello world'
+        }), response=client.parse_content('ERR: 301, No Credit Left '
+                                            'To: 27123456783'))
+        responses = self.clickatell.sendmsg(recipients=[
+                                                '27123456781',
+                                                '27123456782',
+                                                '27123456783'],
+                                            text='hello world',
+                                            response_set=True)
+        self.assertTrue(isinstance(responses, ResponseSet))
+        self.assertEquals(len(responses), 3)
+        self.assertEquals(responses.error_codes(), [301])
+        self.assertEquals(responses.apimsgid_for('27123456782'), 'apimsgid2')
+        self.assertEquals(responses.apimsgid_for('27123456783'), None)
+        [id1, id2, err] = responses
+        self.assertTrue(isinstance(id1, IDResponse))
+        self.assertEquals(id1.extra, {'To': '27123456781'})
+        self.assertEquals(err.reason, 'No Credit Left To: 27123456783')
+        self.assertTrue(client.all_mocks_called())
+    
+    def test_sendmsg_stream(self):
+        client = self.clickatell.client
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456781,27123456782',
+            'text': 'hello world'
+        }), response=client.parse_content('ID: apimsgid1 To: 27123456781\n'
+                                            'ID: apimsgid2 To: 27123456782'))
+        client.mock('GET', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456783',
+            'text': 'hello world'
+        }), response=client.parse_content('ID: apimsgid3 To: 27123456783'))
+        responses = self.clickatell.sendmsg(recipients=[
+                                                '27123456781',
+                                                '27123456782',
+                                                '27123456783'],
+                                            text='hello world',
+                                            stream=True)
+        self.assertEquals(responses.next().value, 'apimsgid1')
+        self.assertEquals([r.value for r in responses], 
+                            ['apimsgid2', 'apimsgid3'])
+        self.assertTrue(client.all_mocks_called())
+    
+    def test_invalid_recipient_in_later_chunk(self):
+        self.assertRaises(ClickatellError, self.clickatell.sendmsg,
+                            recipients=['27123456781', '27123456782',
+                                        '+27123456783'],
+                            text='hello world')
+
+    def test_partial_failure(self):
+        server = ClickatellServer().start()
+        try:
+            clickatell = Clickatell('username', 'password', 'api_id',
+                                client_class=lambda: Client(server.url),
+                                max_recipients=2, max_fan_out=1)
+            clickatell.getbalance()
+            server.faults.extend([None, (500, 'Internal Server Error')])
+            try:
+                clickatell.sendmsg(recipients=['27123456781', '27123456782',
+                                                '27123456783', '27123456784'],
+                                    text='hello world')
+                self.fail('PartialSendError not raised')
+            except PartialSendError, e:
+                [responses, failed] = e.results
+                self.assertEquals([resp.extra['To'] for resp in responses],
+                                    ['27123456781', '27123456782'])
+                self.assertEquals(failed, None)
+                [(to, error)] = e.errors
+                self.assertEquals(to, '27123456783,27123456784')
+                self.assertTrue(isinstance(error, urllib2.HTTPError))
+            self.assertEquals(len(server.messages), 2)
+            # when every request fails their first error is raised
+            server.fail_next(2)
+            self.assertRaises(urllib2.HTTPError, clickatell.sendmsg,
+                                recipients=['27123456781', '27123456782',
+                                            '27123456783'],
+                                text='hello world')
+        finally:
+            server.stop()
+
+    def test_close(self):
+        server = ClickatellServer().start()
+        try:
+            threads = threading.active_count()
+            for i in range(30):
+                clickatell = Clickatell('username', 'password', 'api_id',
+                                    client_class=lambda: Client(server.url),
+                                    max_recipients=1)
+                clickatell.sendmsg(recipients=['27123456781', '27123456782'],
+                                    text='hello world')
+                clickatell.close()
+            # only the server's threads for the pooled connections remain
+            self.assertTrue(threading.active_count() - threads <= 8,
+                            threading.active_count() - threads)
+        finally:
+            server.stop()
+
+    def test_post_for_long_urls(self):
+        self.clickatell.max_url_length = 10
+        client = self.clickatell.client
+        client.mock('POST', sendmsg_url, merge_with_defaults({
+            'session_id': 'session_id',
+            'to': '27123456781',
+            'text': 'hello world'
+        }), response=client.parse_content('ID: apimsgid1'))
+        [id1] = self.clickatell.sendmsg(recipients=['27123456781'],
+                                        text='hello world')
+        self.assertEquals(id1.value, 'apimsgid1')
+        self.assertTrue(client.all_mocks_called())
+
+class TransportTestCase(TestCase):
+    """Run the library against the local stand-in for Clickatell"""
+    def setUp(self):
+        self.server = ClickatellServer(credit=10).start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_sendmsg_and_querymsg(self):
+        [id1, id2] = self.clickatell.sendmsg(recipients=['27123456781',
+                                                        '27123456782'],
+                                                text='hello world')
+        self.assertEquals(id2.extra, {'To': '27123456782'})
+        status = self.clickatell.querymsg(apimsgid=id1.value)
+        self.assertEquals(status.extra, {'Status': '004'})
+        self.assertEquals(self.clickatell.getbalance(), 8.0)
+    
+    def test_batch(self):
+        with self.clickatell.batch(template='Hello world!') as batch:
+            responses = batch.quicksend(recipients=['27123456781', 
+                                                    '27123456782'])
+        self.assertEquals(len(responses), 2)
+        self.assertEquals(self.server.batches, {})
+    
+    def test_check_coverage(self):
+        self.assertTrue(isinstance(
+            self.clickatell.check_coverage('27123456781'), OKResponse))
+        self.assertTrue(isinstance(
+            self.clickatell.check_coverage('44123456781'), ERRResponse))
+    
+    def test_expired_session(self):
+        self.clickatell.getbalance()
+        self.server.expire_sessions()
+        self.assertEquals(self.clickatell.getbalance(), 10.0)
+    
+    def test_urllib_transport(self):
+        self.clickatell.client.transport = url.URLLibTransport()
+        self.assertEquals(self.clickatell.getbalance(), 10.0)
+    
+    def test_server_errors(self):
+        self.server.error_rate = 1
+        self.assertRaises(urllib2.HTTPError, self.clickatell.getbalance)
+
+class RetryTestCase(TestCase):
+    """Verify retries & circuit breaking against a failing server"""
+    def setUp(self):
+        self.server = ClickatellServer().start()
+        self.delays = []
+        self.policy = RetryPolicy(max_attempts=3, failure_threshold=3, 
+                                    sleep=self.delays.append)
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url),
+                            retry_policy=self.policy)
+        self.clickatell.getbalance()
+        del self.server.requests[:]
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_retry_server_errors(self):
+        self.server.fail_next(2, 503)
+        self.assertEquals(self.clickatell.getbalance(), 1000.0)
+        self.assertEquals(len(self.server.requests), 3)
+        self.assertEquals(len(self.delays), 2)
+        self.assertTrue(0 <= self.delays[1] <= self.policy.backoff * 2)
+    
+    def test_retry_internal_error(self):
+        self.server.fail_next(1, 200, 'ERR: 901, Internal error')
+        [resp] = self.clickatell.sendmsg(recipients=['27123456781'], 
+                                            text='hello world')
+        self.assertTrue(isinstance(resp, IDResponse))
+        self.assertEquals(len(self.server.requests), 2)
+    
+    def test_fatal_error(self):
+        self.server.fail_next(1, 200, 'ERR: 301, No Credit Left')
+        self.assertRaises(ClickatellError, self.clickatell.getbalance)
+        self.server.fail_next(1, 404)
+        self.assertRaises(urllib2.HTTPError, self.clickatell.getbalance)
+        self.assertEquals(len(self.server.requests), 2)
+    
+    def test_circuit_breaker(self):
+        self.server.fail_next(3, 500)
+        self.assertRaises(urllib2.HTTPError, self.clickatell.getbalance)
+        self.assertRaises(CircuitOpenError, self.clickatell.getbalance)
+        self.assertEquals(len(self.server.requests), 3)
+        # other endpoints have their own circuit breakers
+        self.assertTrue(isinstance(self.clickatell.check_coverage(
+                                    '27123456781'), OKResponse))
+    
+    def test_half_open(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, 
+                                    clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        now[0] = 10
+        breaker.before_call()
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        now[0] = 20
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_half_open_fatal_error(self):
+        breaker = self.clickatell.client.circuit_breaker('http')
+        breaker.state, breaker.opened_at = CircuitBreaker.OPEN, 0
+        self.server.fail_next(1, 404)
+        self.assertRaises(urllib2.HTTPError, self.clickatell.getbalance)
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEquals(self.clickatell.getbalance(), 1000.0)
+    
+    def test_sends_not_retried_after_sending(self):
+        self.server.fail_next(1, 500)
+        self.assertRaises(urllib2.HTTPError, self.clickatell.sendmsg,
+                            recipients=['27123456781'], text='hello world')
+        self.assertEquals(len(self.server.requests), 1)
+        attempts = []
+        def timeout():
+            attempts.append(1)
+            raise socket.timeout('timed out')
+        self.assertRaises(socket.timeout, self.policy.call, timeout, 
+                            idempotent=False)
+        self.assertRaises(socket.timeout, self.policy.call, timeout)
+        self.assertEquals(len(attempts), 4)
+    
+    def test_sends_retried_when_connecting_fails(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = 'http://127.0.0.1:%s' % sock.getsockname()[1]
+        sock.close()
+        client = Client(address, retry_policy=self.policy)
+        self.assertRaises(ConnectError, client.http, 'sendmsg', {})
+        self.assertEquals(len(self.delays), 2)
+
+class IdempotencyTestCase(TestCase):
+    """Verify retried sends don't send a message twice"""
+    def setUp(self):
+        self.server = ClickatellServer().start()
+        self.index = DedupIndex()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url),
+                            dedup_index=self.index)
+        self.clickatell.getbalance()
+        del self.server.requests[:]
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def sendmsg(self, **options):
+        return self.clickatell.sendmsg(recipients=['27123456781'],
+                                        text='hello world', **options)
+    
+    def test_retry_answered_from_index(self):
+        [id1] = self.sendmsg()
+        del self.server.requests[:]
+        [id2] = self.sendmsg()
+        self.assertTrue(isinstance(id2, IDResponse))
+        self.assertEquals(id1.value, id2.value)
+        self.assertEquals(self.server.requests, [])
+        self.assertEquals(len(self.server.messages), 1)
+    
+    def test_idempotency_key(self):
+        self.sendmsg(idempotency_key=1)
+        self.sendmsg(idempotency_key=2)
+        self.assertEquals(len(self.server.messages), 2)
+    
+    def test_reconcile_lost_response(self):
+        [id1] = self.sendmsg()
+        # the response never made it back to us
+        [climsgid] = self.server.climsgids.keys()
+        self.index.pending(climsgid)
+        [id2] = self.sendmsg()
+        self.assertEquals(id1.value, id2.value)
+        self.assertEquals(len(self.server.messages), 1)
+    
+    def test_reconcile_failed_request(self):
+        self.server.fail_next(1, 500)
+        self.assertRaises(urllib2.HTTPError, self.sendmsg)
+        self.assertEquals(self.server.messages, {})
+        [id1] = self.sendmsg()
+        self.assertEquals(len(self.server.messages), 1)
+    
+    def test_non_ascii_text(self):
+        [resp1] = self.clickatell.sendmsg(recipients=['27123456781'],
+                                            text=u'Jos\xe9')
+        [resp2] = self.clickatell.sendmsg(recipients=['27123456781'],
+                                            text=u'Jos\xe9')
+        self.assertEquals(resp1.value, resp2.value)
+        self.assertEquals(len(self.server.messages), 1)
+        self.assertEquals(idempotency.climsgid_for({'text': u'Jos\xe9'}),
+                            idempotency.climsgid_for({'text': 'Jos\xc3\xa9'}))
+    
+    def test_claimed_once(self):
+        now = [1000]
+        self.index.clock = lambda: now[0]
+        # another thread or process is sending it right now
+        self.assertEquals(self.index.claim('abc'), (None, None))
+        self.assertRaises(ClickatellError, self.sendmsg, climsgid='abc')
+        self.assertEquals(self.server.messages, {})
+        # until it has been pending for too long
+        now[0] += self.index.pending_timeout
+        [resp] = self.sendmsg(climsgid='abc')
+        self.assertEquals(self.index.get('abc'), ('sent', [('ID', 
+                                                            resp.value)]))
+    
+    def test_reconcile_multiple_recipients(self):
+        recipients = ['27123456781', '27123456782']
+        responses = self.clickatell.sendmsg(recipients=recipients,
+                                            text='hello world')
+        [climsgid] = self.server.climsgids.keys()
+        # the responses never made it back to us
+        self.index.unknown(climsgid)
+        self.assertRaises(ClickatellError, self.clickatell.sendmsg,
+                            recipients=recipients, text='hello world')
+        self.assertEquals(len(self.server.messages), 2)
+        self.assertEquals(self.index.get(climsgid), ('unknown', None))
+    
+    def test_errors_are_not_remembered(self):
+        self.server.fail_next(1, 200, 'ERR: 301, No Credit Left')
+        [err] = self.sendmsg()
+        self.assertTrue(isinstance(err, ERRResponse))
+        [resp] = self.sendmsg()
+        self.assertTrue(isinstance(resp, IDResponse))
+    
+    def test_ttl(self):
+        now = [0]
+        index = DedupIndex(ttl=10, maxsize=2, clock=lambda: now[0])
+        index.pending('a')
+        index.sent('b', [('ID', 'apimsgid')])
+        index.pending('c')
+        self.assertEquals(index.get('a'), (None, None))
+        self.assertEquals(index.get('c'), (PENDING, None))
+        now[0] = 10
+        self.assertEquals(index.get('b'), (None, None))
+    
+    def test_sqlite_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'dedup.db')
+            self.clickatell.dedup_index = SQLiteDedupIndex(path)
+            [id1] = self.sendmsg(response_set=True)
+            self.clickatell.dedup_index = SQLiteDedupIndex(path)
+            [id2] = self.sendmsg()
+            self.assertEquals(id1.value, id2.value)
+            self.assertEquals(len(self.server.messages), 1)
+            index = SQLiteDedupIndex(path, maxsize=5, evict_every=10)
+            self.assertEquals(index.claim('abc'), (None, None))
+            self.assertEquals(index.claim('abc'), (PENDING, None))
+            self.assertFalse(index.takeover('abc'))
+            index.unknown('abc')
+            self.assertTrue(index.takeover('abc'))
+            # the 20th write evicts down to maxsize
+            for i in range(17):
+                index.sent(str(i), [('ID', str(i))])
+            [count] = index.db.execute('SELECT COUNT(*) FROM dedup'
+                                        ).fetchone()
+            self.assertEquals(count, 5)
+        finally:
+            shutil.rmtree(directory)
+
+class RateLimitTestCase(TestCase):
+    """Verify the token bucket & the priority lanes of the governor"""
+    def test_token_bucket(self):
+        now = [0]
+        bucket = TokenBucket(rate=10, capacity=5, clock=lambda: now[0])
+        self.assertEquals(bucket.acquire(5), 0)
+        self.assertAlmostEquals(bucket.acquire(1), 0.1)
+        now[0] = 0.5
+        # more than the capacity is allowed once the bucket is full
+        self.assertEquals(bucket.acquire(20), 0)
+        now[0] = 1
+        self.assertAlmostEquals(bucket.acquire(1), 1.1)
+    
+    def test_file_token_bucket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bucket')
+            now = [0]
+            bucket1 = FileTokenBucket(path, rate=10, clock=lambda: now[0])
+            bucket2 = FileTokenBucket(path, rate=10, clock=lambda: now[0])
+            self.assertEquals(bucket1.acquire(6), 0)
+            self.assertAlmostEquals(bucket2.acquire(6), 0.2)
+            now[0] = 0.2
+            self.assertEquals(bucket2.acquire(6), 0)
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_priority_lanes(self):
+        governor = Governor(TokenBucket(rate=20, capacity=1))
+        governor.acquire(1)
+        order = []
+        def send(priority):
+            governor.throttle({'to': '27123456781', 'queue': priority})
+            order.append(priority)
+        def start(priority):
+            thread = threading.Thread(target=send, args=(priority,))
+            thread.start()
+            return thread
+        threads = [start(cc.QUEUE_LOW) for i in range(3)]
+        while len(governor.waiting) < 3:
+            time.sleep(0.001)
+        threads.append(start(cc.QUEUE_HIGH))
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [cc.QUEUE_HIGH] + [cc.QUEUE_LOW] * 3)
+    
+    def test_governed_sendmsg(self):
+        server = ClickatellServer().start()
+        try:
+            clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(server.url),
+                            governor=Governor(TokenBucket(rate=100, 
+                                                            capacity=2)))
+            start = time.time()
+            for i in range(3):
+                clickatell.sendmsg(recipients=['27123456781', '27123456782'],
+                                    text='hello world')
+            # the auth request doesn't count, the last 4 messages wait
+            self.assertTrue(time.time() - start >= 0.03)
+            self.assertEquals(len(server.messages), 6)
+        finally:
+            server.stop()
+
+class OutboxTestCase(TestCase):
+    """Verify the durable outbox and its sender processes"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.db')
+        self.outbox = Outbox(self.path)
+        self.server = ClickatellServer().start()
+    
+    def tearDown(self):
+        self.outbox.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+    
+    def clickatell(self):
+        return Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+    
+    def test_lease(self):
+        job_id = self.outbox.sendmsg(recipients=['27123456781'], text='hi')
+        [job] = self.outbox.lease('worker1', lease_time=-1)
+        self.assertEquals(job.id, job_id)
+        self.assertEquals(job.options, {'recipients': ['27123456781'], 
+                                        'text': 'hi'})
+        # the lease of worker1 expired, as if it crashed
+        [job] = self.outbox.lease('worker2')
+        self.assertEquals(self.outbox.lease('worker3'), [])
+        self.outbox.fail(job)
+        self.assertEquals(self.outbox.get(job_id).attempts, 1)
+        self.assertEquals(self.outbox.counts(), {'queued': 1})
+    
+    def test_stored_as_json(self):
+        options = {'recipients': ['27123456781'], 'text': 'caf\xe9',
+                    'scheduled_time': datetime(2026, 1, 1, 12, 30),
+                    'validity': timedelta(hours=2), 'batch': {'concat': 3}}
+        job_id = self.outbox.put('sendmsg', options)
+        [stored] = self.outbox.db.execute('SELECT options FROM outbox '
+                                            'WHERE id = ?', (job_id,)).fetchone()
+        self.assertEquals(json.loads(stored)['scheduled_time'],
+                            {'__datetime__': '2026-01-01T12:30:00.000000'})
+        [job] = self.outbox.lease('worker1')
+        self.assertEquals(job.options, options)
+        job.result = [('ID', 'apimsgid1 To: 27123456781')]
+        self.outbox.complete([job])
+        self.assertEquals(self.outbox.get(job_id).result, job.result)
+        # jobs pickled by older versions don't parse and fail
+        self.outbox.db.execute('INSERT INTO outbox (kind, options, state) '
+                                'VALUES (?, ?, ?)', ('sendmsg',
+                                buffer('\x80\x02}q\x00.'), 'queued'))
+        self.assertEquals(self.outbox.lease('worker1'), [])
+        self.assertEquals(self.outbox.counts(), {'done': 1, 'failed': 1})
+    
+    def test_concurrent_puts(self):
+        ids = []
+        def put():
+            ids.append(self.outbox.sendmsg(recipients=['27123456781'], 
+                                            text='hi'))
+        threads = [threading.Thread(target=put) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(ids), range(1, 21))
+    
+    def test_drain(self):
+        for i in range(10):
+            self.outbox.sendmsg(recipients=['2712345678%s' % i], 
+                                text='hello world')
+        job_id = self.outbox.quicksend(batch={'template': 'hello'}, 
+                                recipients=['27123456781', '27123456782'])
+        SenderPool(self.path, self.clickatell, processes=2).drain()
+        self.assertEquals(self.outbox.counts(), {'done': 11})
+        self.assertEquals(len(self.server.messages), 12)
+        self.assertEquals(len(self.outbox.get(job_id).apimsgids()), 2)
+    
+    def test_resume_after_crash(self):
+        job_id = self.outbox.sendmsg(recipients=['27123456781'], 
+                                        text='hello world')
+        # a worker sends the job & crashes before checkpointing it
+        worker = OutboxWorker(self.path, self.clickatell)
+        [job] = self.outbox.lease('crashed', lease_time=-1)
+        clickatell = self.clickatell()
+        clickatell.dedup_index = SQLiteDedupIndex(self.path)
+        [resp] = worker.send(clickatell, job)
+        worker.run(until_empty=True)
+        self.assertEquals(len(self.server.messages), 1)
+        self.assertEquals(self.outbox.get(job_id).apimsgids(), [resp.value])
+    
+    def test_quicksend_not_sent_twice(self):
+        job_id = self.outbox.quicksend(batch={'template': 'hello'},
+                                recipients=['27123456781', '27123456782'])
+        # a worker sends the job & crashes before checkpointing it
+        worker = OutboxWorker(self.path, self.clickatell)
+        [job] = self.outbox.lease('crashed', lease_time=-1)
+        worker.send(self.clickatell(), job, self.outbox)
+        worker.run(until_empty=True)
+        self.assertEquals(len(self.server.messages), 2)
+        self.assertEquals(self.outbox.get(job_id).state, 'unknown')
+    
+    def test_quicksend_failures(self):
+        failed_id = self.outbox.quicksend(batch={'template': 'hello'},
+                                            recipients=['27123456781'])
+        clickatell = self.clickatell()
+        clickatell.getbalance()
+        # startbatch succeeds, the quicksend fails with an unknown outcome
+        self.server.faults.extend([None, (500, 'Internal Server Error')])
+        worker = OutboxWorker(self.path, lambda: clickatell)
+        worker.run(until_empty=True)
+        self.assertEquals(self.outbox.get(failed_id).state, 'unknown')
+    
+    def test_quicksend_retried_when_never_sent(self):
+        job_id = self.outbox.quicksend(batch={'template': 'hello'},
+                                        recipients=['27123456781'])
+        [job] = self.outbox.lease('worker', lease_time=60)
+        self.outbox.start(job)
+        self.outbox.fail(job)
+        job = self.outbox.get(job_id)
+        self.assertEquals((job.state, job.started), ('queued', None))
+        OutboxWorker(self.path, self.clickatell).run(until_empty=True)
+        self.assertEquals(self.outbox.get(job_id).state, 'done')
+    
+    def test_renew(self):
+        job_id = self.outbox.sendmsg(recipients=['27123456781'], text='hi')
+        jobs = self.outbox.lease('worker1', lease_time=60)
+        self.assertEquals(self.outbox.renew('worker1', jobs, -1), 
+                            set([job_id]))
+        # the lease expired and was taken over
+        self.assertEquals(len(self.outbox.lease('worker2')), 1)
+        self.assertEquals(self.outbox.renew('worker1', jobs), set())
+
+class CoalescerTestCase(TestCase):
+    """Verify sends with the same text are merged into one request"""
+    def setUp(self):
+        self.server = ClickatellServer().start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+        self.clickatell.getbalance()
+        del self.server.requests[:]
+        self.coalescer = Coalescer(self.clickatell, deadline=0.05, 
+                                    max_recipients=5)
+    
+    def tearDown(self):
+        self.coalescer.close()
+        self.server.stop()
+    
+    def test_coalesce(self):
+        future1 = self.coalescer.sendmsg(recipients=['27123456781'], 
+                                            text='hello world')
+        future2 = self.coalescer.sendmsg(recipients=['27123456782', 
+                                            '27123456783'], text='hello world')
+        future3 = self.coalescer.sendmsg(recipients=['27123456784'], 
+                                            text='goodbye world')
+        [resp1] = future1.result(1)
+        [resp2, resp3] = future2.result(1)
+        [resp4] = future3.result(1)
+        self.assertEquals(resp1.extra, {'To': '27123456781'})
+        self.assertEquals(resp3.extra, {'To': '27123456783'})
+        self.assertTrue(isinstance(resp4, IDResponse))
+        self.assertEquals(len(self.server.requests), 2)
+    
+    def test_max_recipients(self):
+        futures = [self.coalescer.sendmsg(recipients=['2712345678%s' % i],
+                                            text='hello world')
+                    for i in range(5)]
+        # sent without waiting for the deadline
+        [future.result(0.04) for future in futures]
+        self.assertEquals(len(self.server.requests), 1)
+    
+    def test_request_errors(self):
+        self.server.fail_next(1, 200, 'ERR: 301, No Credit Left')
+        future1 = self.coalescer.sendmsg(recipients=['27123456781'], 
+                                            text='hello world')
+        future2 = self.coalescer.sendmsg(recipients=['27123456782'], 
+                                            text='hello world')
+        self.assertEquals(future1.result(1)[0].code, 301)
+        self.assertEquals(future2.result(1)[0].code, 301)
+        self.server.fail_next(1, 404)
+        future = self.coalescer.sendmsg(recipients=['27123456781'], 
+                                            text='hello world')
+        self.assertRaises(urllib2.HTTPError, future.result, 1)
+
+    def test_invalid_recipients(self):
+        future1 = self.coalescer.sendmsg(recipients=['27123456781'],
+                                            text='hello world')
+        future2 = self.coalescer.sendmsg(recipients=['0123456782'],
+                                            text='hello world')
+        future3 = self.coalescer.sendmsg(recipients=['+27 12 345 6783'],
+                                            text='hello world')
+        self.assertRaises(ClickatellError, future2.result, 1)
+        [resp1] = future1.result(1)
+        [resp3] = future3.result(1)
+        self.assertEquals(resp3.extra, {'To': '27123456783'})
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_single_response(self):
+        # only an error is meant for every recipient of the request
+        self.server.fail_next(1, 200, 'ID: 1234')
+        future1 = self.coalescer.sendmsg(recipients=['27123456781'],
+                                            text='hello world')
+        future2 = self.coalescer.sendmsg(recipients=['27123456782'],
+                                            text='hello world')
+        self.assertRaises(ClickatellError, future1.result, 1)
+        self.assertRaises(ClickatellError, future2.result, 1)
+
+    def test_match_by_recipient(self):
+        self.server.fail_next(1, 200, 'ID: apimsgid2 To: 27123456782\n'
+                                        'ID: apimsgid1 To: 27123456781')
+        future1 = self.coalescer.sendmsg(recipients=['27123456781'],
+                                            text='hello world')
+        future2 = self.coalescer.sendmsg(recipients=['27123456782'],
+                                            text='hello world')
+        self.assertEquals(future1.result(1)[0].value, 'apimsgid1')
+        self.assertEquals(future2.result(1)[0].value, 'apimsgid2')
+
+    def test_partial_failure(self):
+        clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url),
+                            max_recipients=2, max_fan_out=1)
+        clickatell.getbalance()
+        coalescer = Coalescer(clickatell, max_recipients=5)
+        try:
+            self.server.faults.extend([None, None, 
+                                        (500, 'Internal Server Error')])
+            future1 = coalescer.sendmsg(recipients=['27123456781', 
+                                        '27123456782'], text='hello world')
+            future2 = coalescer.sendmsg(recipients=['27123456783'],
+                                        text='hello world')
+            future3 = coalescer.sendmsg(recipients=['27123456784', 
+                                        '27123456785'], text='hello world')
+            self.assertEquals([resp.extra['To'] 
+                                for resp in future1.result(1)],
+                                ['27123456781', '27123456782'])
+            [resp3] = future2.result(1)
+            self.assertEquals(resp3.extra['To'], '27123456783')
+            self.assertRaises(urllib2.HTTPError, future3.result, 1)
+        finally:
+            coalescer.close()
+            clickatell.close()
+
+class BatchRegistryTestCase(TestCase):
+    """Verify batches are shared between jobs until they expire"""
+    def setUp(self):
+        self.server = ClickatellServer().start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+        self.now = [0]
+        self.registry = BatchRegistry(self.clickatell, max_age=60, maxsize=2,
+                                        clock=lambda: self.now[0])
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def startbatches(self):
+        return [path for method, path, query in self.server.requests
+                if path == '/http_batch/startbatch']
+    
+    def test_shared_batch(self):
+        for i in range(3):
+            with self.registry.batch(template='Hello #field1#') as batch:
+                batch.sendmsg({'field1': 'world'}, to='27123456781')
+        self.assertTrue(self.registry.batch(template='Hello #field1#') is 
+                        batch)
+        self.assertEquals(len(self.startbatches()), 1)
+        self.assertEquals(len(self.server.batches), 1)
+        self.registry.close()
+        self.assertEquals(self.server.batches, {})
+    
+    def test_expiry(self):
+        batch = self.registry.batch(template='Hello world')
+        batch.quicksend(recipients=['27123456781'])
+        self.now[0] = 60
+        batch.quicksend(recipients=['27123456781'])
+        self.assertEquals(len(self.startbatches()), 2)
+    
+    def test_invalid_batch_id(self):
+        batch = self.registry.batch(template='Hello world')
+        batch.quicksend(recipients=['27123456781'])
+        self.server.batches.clear()
+        [resp] = batch.quicksend(recipients=['27123456781'])
+        self.assertTrue(isinstance(resp, IDResponse))
+        self.assertEquals(len(self.startbatches()), 2)
+    
+    def test_lru(self):
+        batch = self.registry.batch(template='one')
+        self.registry.batch(template='two')
+        self.registry.batch(template='one')
+        self.registry.batch(template='three')
+        self.assertEquals(len(self.registry.batches), 2)
+        self.assertTrue(self.registry.batch(template='one') is batch)
+    
+    def test_threads(self):
+        batch = self.registry.batch(template='Hello world')
+        threads = [threading.Thread(target=batch.quicksend, 
+                                    kwargs={'recipients': ['27123456781']})
+                    for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(self.startbatches()), 1)
+        self.assertEquals(len(self.server.messages), 10)
+    
+    def test_coalescer(self):
+        coalescer = Coalescer(self.clickatell, deadline=0.01, 
+                                registry=self.registry)
+        futures = [coalescer.sendmsg(recipients=['2712345678%s' % i],
+                                        text='hello world')
+                    for i in range(3)]
+        responses = [future.result(1) for future in futures]
+        coalescer.close()
+        self.assertEquals(len(self.startbatches()), 1)
+        self.assertEquals(len(self.server.messages), 3)
+        self.assertEquals(self.server.batches.values()[0]['template'], 
+                            'hello world')
+
+class SendManyTestCase(TestCase):
+    """Verify pipelined batch items"""
+    def setUp(self):
+        self.server = ClickatellServer(latency=0.01).start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def contexts(self, number):
+        for i in range(number):
+            self.pulled += 1
+            yield {'to': '2712345%04d' % i, 'field1': str(i)}
+    
+    def test_sendmany(self):
+        self.pulled = 0
+        with self.clickatell.batch(template='Hello #field1#') as batch:
+            pipeline = batch.sendmany(self.contexts(20), max_in_flight=4)
+            results = []
+            for index, resp, error in pipeline:
+                # contexts are only pulled when there is room for them
+                self.assertTrue(self.pulled <= len(results) + 5)
+                self.assertTrue(pipeline.in_flight <= 4)
+                self.assertEquals(error, None)
+                results.append((index, resp))
+        self.assertEquals(sorted(index for index, resp in results), 
+                            range(20))
+        self.assertTrue(all(isinstance(resp, IDResponse) 
+                            for index, resp in results))
+        self.assertEquals((pipeline.submitted, pipeline.completed, 
+                            pipeline.failed), (20, 20, 0))
+        recipients = sorted(message['to'] 
+                            for message in self.server.messages.values())
+        self.assertEquals(recipients, ['2712345%04d' % i for i in range(20)])
+    
+    def test_failures(self):
+        self.pulled = 0
+        with self.clickatell.batch(template='Hello #field1#') as batch:
+            self.server.fail_next(1, 404)
+            results = dict((index, (resp, error)) for index, resp, error
+                            in batch.sendmany(self.contexts(3),
+                                                max_in_flight=1))
+        self.assertEquals(results[0][0], None)
+        self.assertTrue(isinstance(results[0][1], urllib2.HTTPError))
+        self.assertTrue(isinstance(results[2][0], IDResponse))
+        self.assertEquals(results[2][1], None)
+
+    def test_max_in_flight_beyond_pool(self):
+        self.server.latency = 0.1
+        self.pulled = 0
+        with self.clickatell.batch(template='Hello #field1#') as batch:
+            start = time.time()
+            results = list(batch.sendmany(self.contexts(20),
+                                            max_in_flight=10))
+            elapsed = time.time() - start
+        self.assertEquals(len(results), 20)
+        # 2 rounds of 10 requests, not 5 rounds of the pool's default 4
+        self.assertTrue(elapsed < 0.4, elapsed)
+
+class PlannerTestCase(TestCase):
+    """Verify bulk jobs are planned into the fewest requests"""
+    def setUp(self):
+        self.rows = [('2712345678%s' % i, 'hello world', {}) 
+                        for i in range(5)]
+        self.rows += [('2712345679%s' % i, None, {'template': 'Hi #field1#',
+                        'field1': 'user %s' % i}) for i in range(3)]
+        self.rows += [('27123456800', 'goodbye', {})]
+        self.server = ClickatellServer().start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_sendmsg_plan(self):
+        plan = Planner(max_recipients=2).plan(self.rows)
+        self.assertEquals(plan.requests['sendmsg'], 7)
+        self.assertEquals(plan.total_requests, 7)
+        self.assertEquals(plan.messages, 9)
+        steps = list(plan.steps())
+        self.assertEquals([len(step.items) for step in steps],
+                            [1, 1, 1, 1, 2, 2, 1])
+        self.assertEquals(steps[0].options, {'text': 'Hi user 0'})
+    
+    def test_batch_plan(self):
+        registry = BatchRegistry(self.clickatell)
+        plan = Planner(max_recipients=2, batch_overhead=0).plan(self.rows)
+        self.assertEquals(plan.requests, {'sendmsg': 1, 'quicksend': 3, 
+                                            'senditem': 3, 'startbatch': 0,
+                                            'endbatch': 0})
+        results = list(plan.execute(self.clickatell, registry))
+        self.assertEquals([step.kind for step, responses in results],
+                            ['senditem', 'senditem', 'sendmsg', 'quicksend',
+                            'quicksend', 'quicksend'])
+        self.assertEquals(sum(len(responses) 
+                            for step, responses in results), 9)
+        self.assertEquals(len(self.server.messages), 9)
+        registry.close()
+    
+    def test_execute(self):
+        plan = Planner(max_recipients=100).plan(self.rows)
+        results = list(plan.execute(self.clickatell))
+        self.assertEquals(len(self.server.requests), plan.total_requests + 1)
+        texts = sorted(message['text'] 
+                        for message in self.server.messages.values())
+        self.assertEquals(texts, ['Hi user 0', 'Hi user 1', 'Hi user 2', 
+                                    'goodbye'] + ['hello world'] * 5)
+    
+    def test_non_ascii_fields(self):
+        rows = [('27123456781', None, {'template': 'Hi #field1#',
+                                        'field1': u'Jos\xe9'}),
+                ('27123456782', None, {'template': 'Hi #field1#',
+                                        'field1': 'Jos\xc3\xa9'})]
+        for planner in [Planner(), Planner(batch_overhead=0)]:
+            self.server.messages.clear()
+            plan = planner.plan(rows)
+            list(plan.execute(self.clickatell, BatchRegistry(self.clickatell)))
+            texts = [message.get('text') or message['field1'] 
+                        for message in self.server.messages.values()]
+            self.assertEquals([text.decode('utf-8') for text in texts],
+                                [u'Hi Jos\xe9'] * 2 
+                                if planner.batch_overhead else 
+                                [u'Jos\xe9'] * 2)
+            if planner.batch_overhead:
+                charsets = [message['charset'] 
+                            for message in self.server.messages.values()]
+            else:
+                charsets = [batch['charset'] 
+                            for batch in self.server.batches.values()]
+            self.assertEquals(set(charsets), set(['UTF-8']))
+    
+    def test_row_defaults(self):
+        rows = [('27123456781', 'hello', {'sender': '27123456789'})]
+        self.assertRaises(ClickatellError, Planner().plan, rows)
+        plan = Planner(defaults={'req_feat': 48}).plan(rows)
+        self.assertEquals(plan.total_requests, 1)
+    
+    def test_external_sort(self):
+        plan = Planner(max_recipients=2, run_size=2).plan(self.rows)
+        try:
+            self.assertEquals(plan.total_requests, 7)
+            self.assertEquals([len(step.items) for step in plan.steps()],
+                                [1, 1, 1, 1, 2, 2, 1])
+        finally:
+            plan.close()
+
+class TextTestCase(TestCase):
+    """Verify the encoding & number of parts of texts are worked out"""
+    def assertInfo(self, text, encoding, length, segments):
+        info = analyze(text)
+        self.assertEquals((info.encoding, info.length, info.segments),
+                            (encoding, length, segments))
+    
+    def test_gsm(self):
+        self.assertInfo('hello world', GSM, 11, 1)
+        self.assertInfo('a' * 160, GSM, 160, 1)
+        self.assertInfo('a' * 161, GSM, 161, 2)
+        self.assertInfo('a' * 306, GSM, 306, 2)
+        self.assertInfo('a' * 307, GSM, 307, 3)
+        self.assertInfo(u'\xa3 \xe9 \u0394', GSM, 5, 1)
+    
+    def test_gsm_extension(self):
+        self.assertInfo(u'\u20ac10', GSM, 4, 1)
+        self.assertInfo('[' * 80, GSM, 160, 1)
+        # escape sequences aren't split over two parts
+        self.assertInfo('a' + '[' * 80, GSM, 161, 2)
+        self.assertInfo('a' * 152 + '[' + 'a' * 10, GSM, 164, 2)
+        self.assertInfo('a' * 152 + '[' * 77, GSM, 306, 3)
+    
+    def test_ucs2(self):
+        self.assertInfo(u'\u4f60\u597d', UCS2, 2, 1)
+        self.assertInfo('\xd0\x9f' * 70, UCS2, 70, 1)
+        self.assertInfo(u'\u4f60' * 71, UCS2, 71, 2)
+        self.assertInfo(u'\u4f60' * 135, UCS2, 135, 3)
+    
+    def test_apply(self):
+        analyzer = TextAnalyzer()
+        options = analyzer.apply({'text': u'\u4f60\u597d', 'req_feat': 48})
+        self.assertEquals(options, {'text': '4F60597D', 'unicode': 1,
+                                    'req_feat': 56})
+        options = analyzer.apply({'text': 'a' * 200})
+        self.assertEquals(options['concat'], 2)
+        self.assertEquals(options['req_feat'], 16384)
+        self.assertEquals(analyzer.apply({'text': 'hello'}), 
+                            {'text': 'hello'})
+        self.assertEquals(analyzer.apply({'text': u'hello'}), 
+                            {'text': 'hello'})
+    
+    def test_apply_non_ascii_gsm(self):
+        analyzer = TextAnalyzer()
+        for text in [u'Caf\xe9 \xa35', 'Caf\xc3\xa9 \xc2\xa35', u'\u20ac10']:
+            options = analyzer.apply({'text': text})
+            self.assertTrue(isinstance(options['text'], str))
+            self.assertEquals(options['text'].decode('utf-8'), 
+                                text.decode('utf-8') 
+                                if isinstance(text, str) else text)
+            self.assertEquals(options['charset'], cc.CHARSET_UTF8)
+            self.assertFalse('unicode' in options)
+    
+    def test_apply_latin1(self):
+        analyzer = TextAnalyzer()
+        for options in [{'text': 'caf\xe9'},
+                        {'text': 'caf\xe9', 'charset': 'ISO-8859-1'}]:
+            options = analyzer.apply(options)
+            self.assertEquals(options['text'], 'caf\xc3\xa9')
+            self.assertEquals(options['charset'], cc.CHARSET_UTF8)
+        options = analyzer.apply({'text': 'caf\xe9 \x80', 
+                                    'charset': 'cp1252'})
+        self.assertEquals(options['text'].decode('utf-8'), u'caf\xe9 \u20ac')
+    
+    def test_lru(self):
+        analyzer = TextAnalyzer(maxsize=2)
+        for text in ['one', 'two', 'one', 'three', 'one']:
+            analyzer.analyze(text)
+        self.assertEquals((analyzer.hits, analyzer.misses), (2, 3))
+        self.assertEquals(analyzer.cache.keys(), ['three', 'one'])
+    
+    def test_estimate(self):
+        analyzer = TextAnalyzer()
+        self.assertEquals(analyzer.estimate([('hello', 10), ('a' * 200, 5),
+                                            (u'\u4f60', 1)], charge=0.8),
+                            {'messages': 16, 'segments': 21, 
+                             'credits': 21 * 0.8})
+    
+    def test_sendmsg(self):
+        server = ClickatellServer().start()
+        try:
+            clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(server.url),
+                            text_analyzer=TextAnalyzer())
+            clickatell.sendmsg(recipients=['27123456781'], text=u'\u4f60')
+            [message] = server.messages.values()
+            self.assertEquals(message['text'], '4F60')
+            self.assertEquals(message['unicode'], '1')
+            clickatell.sendmsg(recipients=['27123456782'], 
+                                text=u'Caf\xe9 \xa35 \u20ac')
+            [message] = [message for message in server.messages.values()
+                            if message['to'] == '27123456782']
+            self.assertEquals(message['text'].decode('utf-8'), 
+                                u'Caf\xe9 \xa35 \u20ac')
+            self.assertEquals(message['charset'], 'UTF-8')
+            clickatell.sendmsg(recipients=['27123456783'], text='caf\xe9')
+            [message] = [message for message in server.messages.values()
+                            if message['to'] == '27123456783']
+            self.assertEquals(message['text'], 'caf\xc3\xa9')
+        finally:
+            server.stop()
+
+class StatusPollerTestCase(TestCase):
+    """Verify the statuses of many messages are polled concurrently"""
+    def setUp(self):
+        self.server = ClickatellServer(status=cc.STATUS_QUEUED).start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+        self.apimsgids = [resp.value for resp in self.clickatell.sendmsg(
+                            recipients=['2712345678%s' % i for i in range(5)],
+                            text='hello world')]
+        self.poller = StatusPoller(self.clickatell, max_in_flight=2, 
+                                    default_delay=0.01, delays={})
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_poll(self):
+        results = []
+        for apimsgid, status, resp in self.poller.poll(self.apimsgids):
+            results.append((apimsgid, status))
+            if len(results) == 5:
+                self.server.status = cc.STATUS_RECEIVED
+        self.assertEquals(sorted(results[:5]), sorted(
+                            (apimsgid, '002') for apimsgid in self.apimsgids))
+        self.assertEquals(sorted(results[5:]), sorted(
+                            (apimsgid, '004') for apimsgid in self.apimsgids))
+
+    def test_status_store(self):
+        self.clickatell.status_store = StatusStore()
+        self.server.status = cc.STATUS_RECEIVED
+        self.poller.run(self.apimsgids, lambda *result: None, timeout=1)
+        self.assertEquals(self.clickatell.status_store.counts(),
+                            {cc.STATUS_RECEIVED: 5})
+    
+    def test_errors_drop_out(self):
+        results = []
+        pending = self.poller.run(['unknown'], 
+                                    lambda *result: results.append(result),
+                                    timeout=1)
+        [(message_id, status, resp)] = results
+        self.assertEquals(status, None)
+        self.assertEquals(resp.code, 103)
+        self.assertEquals(pending, 0)
+    
+    def test_timeout(self):
+        pending = self.poller.run(self.apimsgids, lambda *result: None,
+                                    timeout=0.1)
+        self.assertEquals(pending, 5)
+    
+    def test_backoff(self):
+        polls = len(self.server.requests)
+        self.poller.backoff = 3
+        self.poller.run(self.apimsgids[:1], lambda *result: None, 
+                        timeout=0.2)
+        # polled at 0, 0.01, 0.04, 0.13 with a growing delay in between
+        self.assertTrue(len(self.server.requests) - polls <= 5)
+
+class StatusStoreTestCase(TestCase):
+    """Verify message statuses are answered locally once they're known"""
+    def setUp(self):
+        self.now = 1000.0
+        self.store = StatusStore(max_age=60, clock=lambda: self.now)
+        self.server = ClickatellServer(status=cc.STATUS_QUEUED).start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url),
+                            status_store=self.store)
+        self.recipients = ['2712345678%s' % i for i in range(3)]
+        self.apimsgids = [resp.value for resp in self.clickatell.sendmsg(
+                            recipients=self.recipients, text='hello world')]
+        del self.server.requests[:]
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_track(self):
+        for apimsgid, recipient in zip(self.apimsgids, self.recipients):
+            self.assertEquals(self.store.get(apimsgid).recipient, recipient)
+            self.assertEquals(self.store.for_recipient(recipient),
+                                [self.store.get(apimsgid)])
+        [resp] = self.clickatell.sendmsg(recipients=['27987654321'],
+                                            text='hello', climsgid='abc')
+        entry = self.store.get(climsgid='abc')
+        self.assertEquals(entry.apimsgid, resp.value)
+        self.assertEquals(entry.recipient, '27987654321')
+    
+    def test_querymsg(self):
+        apimsgid = self.apimsgids[0]
+        self.assertEquals(self.clickatell.querymsg(apimsgid=apimsgid).extra,
+                            {'Status': cc.STATUS_QUEUED})
+        self.clickatell.querymsg(apimsgid=apimsgid)
+        self.assertEquals(len(self.server.requests), 1)
+        # stale intermediate statuses are asked again
+        self.now += 60
+        self.server.status = cc.STATUS_RECEIVED
+        self.clickatell.querymsg(apimsgid=apimsgid)
+        self.assertEquals(len(self.server.requests), 2)
+        # final statuses never are
+        self.now += 3600
+        resp = self.clickatell.querymsg(apimsgid=apimsgid)
+        self.assertEquals(resp.value, apimsgid)
+        self.assertEquals(resp.extra, {'Status': cc.STATUS_RECEIVED})
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(self.store.counts(), {None: 2, 
+                                                cc.STATUS_RECEIVED: 1})
+    
+    def test_getmsgcharge(self):
+        apimsgid = self.apimsgids[0]
+        self.server.status = cc.STATUS_RECEIVED
+        self.clickatell.getmsgcharge(apimsgid)
+        resp = self.clickatell.getmsgcharge(apimsgid)
+        self.assertEquals(resp.extra, {'charge': '1.0', 'status': '004'})
+        self.assertEquals(len(self.server.requests), 1)
+    
+    def test_callbacks(self):
+        records = [parse_callback('apiMsgId=%s&status=004&charge=0.8' % 
+                                    apimsgid) for apimsgid in self.apimsgids]
+        records.append(parse_callback('apiMsgId=%s&status=003' % 
+                                        self.apimsgids[0]))
+        self.store.write(records)
+        self.assertEquals(len(self.store.with_status(cc.STATUS_RECEIVED)), 3)
+        resp = self.clickatell.getmsgcharge(self.apimsgids[0])
+        self.assertEquals(resp.extra, {'charge': '0.8', 'status': '004'})
+        self.assertEquals(self.server.requests, [])
+    
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'statuses.db')
+            store = SQLiteStatusStore(path)
+            store.track(self.clickatell.sendmsg(recipients=['27987654321'],
+                                    text='hello', climsgid='abc'),
+                        ['27987654321'], 'abc')
+            store.observe('abc', cc.STATUS_RECEIVED, 
+                            self.clickatell.querymsg(climsgid='abc'))
+            store.close()
+            entry = SQLiteStatusStore(path).get(climsgid='abc')
+            self.assertEquals(entry.recipient, '27987654321')
+            self.assertEquals(entry.status, cc.STATUS_RECEIVED)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_eviction(self):
+        store = StatusStore(clock=lambda: self.now, ttl=60, maxsize=2)
+        store.update('1', cc.STATUS_QUEUED, recipient='27123456781')
+        self.now += 30
+        store.update('2', cc.STATUS_QUEUED, climsgid='abc')
+        store.update('3', cc.STATUS_QUEUED)
+        # the least recently touched entry goes when there are too many
+        self.assertEquals(store.entries.keys(), ['2', '3'])
+        self.assertEquals(store.for_recipient('27123456781'), [])
+        self.now += 70
+        store.update('3', cc.STATUS_RECEIVED)
+        # and any that weren't touched for ttl seconds
+        self.assertEquals(store.entries.keys(), ['3'])
+        self.assertEquals((store.climsgids, store.recipients),  ({}, {}))
+        self.assertEquals(store.counts(), {cc.STATUS_RECEIVED: 1})
+
+    def test_sqlite_queries(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = SQLiteStatusStore(os.path.join(directory, 'statuses.db'),
+                                        clock=lambda: self.now, ttl=60,
+                                        maxsize=2, evict_every=1)
+            store.update('1', cc.STATUS_QUEUED, recipient='27123456781')
+            self.now += 1
+            store.update_many([{'apimsgid': '2', 'climsgid': 'abc'},
+                                {'apimsgid': '2', 'status': cc.STATUS_QUEUED}])
+            self.assertEquals(store.get(climsgid='abc').status,
+                                cc.STATUS_QUEUED)
+            self.assertEquals([entry.apimsgid for entry in 
+                                store.with_status(cc.STATUS_QUEUED)],
+                                ['1', '2'])
+            self.assertEquals(store.counts(), {cc.STATUS_QUEUED: 2})
+            self.now += 30
+            store.update('3', cc.STATUS_RECEIVED)
+            self.assertEquals(store.get('1'), None)
+            self.assertEquals(store.for_recipient('27123456781'), [])
+            self.now += 40
+            self.assertEquals(store.get(climsgid='abc'), None)
+            self.assertEquals(store.counts(), {cc.STATUS_RECEIVED: 1})
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+class CallbacksTestCase(TestCase):
+    
+    body = ('apiMsgId=996411ad91fa211e7d17bc873aa4a41d&'
+            'cliMsgId=abc&to=27123456789&timestamp=1218007814&'
+            'from=27987654321&status=004&charge=0.800000')
+    
+    def setUp(self):
+        self.sink = QueueSink()
+        self.batcher = MicroBatcher(self.sink, max_batch=10, max_delay=0.01)
+    
+    def tearDown(self):
+        self.batcher.close()
+    
+    def records(self, count):
+        return [self.sink.queue.get(timeout=1) for i in range(count)]
+    
+    def test_parse_callback(self):
+        record = parse_callback(self.body)
+        self.assertEquals(record.apimsgid, '996411ad91fa211e7d17bc873aa4a41d')
+        self.assertEquals(record.climsgid, 'abc')
+        self.assertEquals(record.to, '27123456789')
+        self.assertEquals(record.sender, '27987654321')
+        self.assertEquals(record.timestamp, 1218007814)
+        self.assertEquals(record.status, cc.STATUS_RECEIVED)
+        self.assertEquals(record.charge, 0.8)
+        self.assertEquals(parse_callback('status=004'), None)
+    
+    def test_micro_batches(self):
+        sizes = []
+        class Sink(QueueSink):
+            def write(self, records):
+                sizes.append(len(records))
+        batcher = MicroBatcher(Sink(), max_batch=10, max_delay=0.05)
+        for i in range(25):
+            batcher.add(CallbackRecord(str(i)))
+        batcher.close()
+        self.assertEquals(sum(sizes), 25)
+        self.assertTrue(max(sizes) <= 10)
+        self.assertEquals(batcher.written, 25)
+
+    def test_sink_failures(self):
+        written = []
+        class Sink(QueueSink):
+            failures = 2
+            def write(self, records):
+                if self.failures:
+                    self.failures -= 1
+                    raise IOError('disk full')
+                written.extend(records)
+        batcher = MicroBatcher(Sink(), max_batch=10, max_delay=0.01,
+                                retry_delay=0.01)
+        for i in range(15):
+            batcher.add(CallbackRecord(str(i)))
+        batcher.close()
+        # failed batches are retried in order, nothing is lost
+        self.assertEquals([record.apimsgid for record in written],
+                            [str(i) for i in range(15)])
+        self.assertEquals(batcher.written, 15)
+        # once closing a sink that keeps failing gives up
+        class BrokenSink(QueueSink):
+            def write(self, records):
+                raise IOError('disk full')
+        batcher = MicroBatcher(BrokenSink(), retry_delay=0.01, max_retries=2)
+        batcher.add(CallbackRecord('1'))
+        batcher.close()
+        self.assertEquals(batcher.written, 0)
+    
+    def test_wsgi_app(self):
+        app = CallbackApp(self.batcher, 'user', 'pass')
+        statuses = []
+        start_response = lambda status, headers: statuses.append(status)
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(self.body)),
+            'wsgi.input': StringIO(self.body),
+        }
+        app(environ, start_response)
+        environ['HTTP_AUTHORIZATION'] = 'Basic dXNlcjpwYXNz'
+        environ['wsgi.input'] = StringIO(self.body)
+        app(environ, start_response)
+        app({'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'to=27123456789',
+            'HTTP_AUTHORIZATION': 'Basic dXNlcjpwYXNz'}, start_response)
+        self.assertEquals(statuses, ['401 Unauthorized', '200 OK',
+                                        '400 Bad Request'])
+        [record] = self.records(1)
+        self.assertEquals(record, parse_callback(self.body))
+        del statuses[:]
+        bad_charge = self.body.replace('0.800000', 'free')
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(bad_charge)),
+            'wsgi.input': StringIO(bad_charge),
+            'HTTP_AUTHORIZATION': 'Basic dXNlcjpwYXNz'}, start_response)
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(10 ** 9),
+            'wsgi.input': StringIO(self.body),
+            'HTTP_AUTHORIZATION': 'Basic dXNlcjpwYXNz'}, start_response)
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': 'many',
+            'wsgi.input': StringIO(self.body),
+            'HTTP_AUTHORIZATION': 'Basic dXNlcjpwYXNz'}, start_response)
+        self.assertEquals(statuses, ['400 Bad Request',
+                                        '413 Request Entity Too Large',
+                                        '400 Bad Request'])
+    
+    def test_server(self):
+        server = CallbackServer(CallbackReceiver(self.batcher),
+                                '127.0.0.1', 0).start()
+        try:
+            urllib2.urlopen('%s/callback?%s' % (server.url, self.body)).read()
+            urllib2.urlopen('%s/callback' % server.url, self.body).read()
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                                '%s/callback' % server.url)
+            try:
+                urllib2.urlopen('%s/callback?%s&timestamp=never' % (
+                                server.url, self.body))
+                self.fail('HTTPError not raised')
+            except urllib2.HTTPError, e:
+                self.assertEquals(e.code, 400)
+            try:
+                urllib2.urlopen('%s/callback' % server.url, 'x' * (
+                                CallbackReceiver.max_body + 1))
+                self.fail('HTTPError not raised')
+            except urllib2.HTTPError, e:
+                self.assertEquals(e.code, 413)
+        finally:
+            server.stop()
+        self.assertEquals(self.records(2), [parse_callback(self.body)] * 2)
+    
+    def test_file_sinks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            records = [parse_callback(self.body), CallbackRecord('1')]
+            sink = FileSink(os.path.join(directory, 'callbacks.txt'))
+            sink.write(records)
+            sink.close()
+            lines = open(os.path.join(directory, 'callbacks.txt')).readlines()
+            self.assertEquals(lines[1], '1\t\t\t\t\t\t\n')
+            sink = SQLiteSink(os.path.join(directory, 'callbacks.db'))
+            sink.write(records)
+            self.assertEquals(sink.db.execute('SELECT status, charge '
+                                'FROM callbacks').fetchall(),
+                                [('004', 0.8), (None, None)])
+            sink.close()
+        finally:
+            shutil.rmtree(directory)
+
+class CoverageCacheTestCase(TestCase):
+    """Verify coverage is checked once per prefix"""
+    def setUp(self):
+        self.now = 1000.0
+        self.server = ClickatellServer(coverage=('2782', '2783')).start()
+        self.clickatell = Clickatell('username', 'password', 'api_id',
+                            client_class=lambda: Client(self.server.url))
+        self.clickatell.getbalance()
+        del self.server.requests[:]
+        self.cache = CoverageCache(self.clickatell, prefix_length=4, ttl=60,
+                                    maxsize=3, clock=lambda: self.now)
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_check_coverage(self):
+        self.assertTrue(isinstance(self.cache.check_coverage('27821234567'),
+                                    OKResponse))
+        self.assertTrue(isinstance(self.cache.check_coverage('27827654321'),
+                                    OKResponse))
+        self.assertTrue(isinstance(self.cache.check_coverage('27721234567'),
+                                    ERRResponse))
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 2))
+        # answers expire
+        self.now += 60
+        self.cache.check_coverage('27821234567')
+        self.assertEquals(len(self.server.requests), 3)
+    
+    def test_longest_prefix(self):
+        self.cache.add('44', ERRResponse('This prefix is not supported'))
+        self.cache.add('4477', OKResponse('Supported Charge: 2'))
+        self.assertEquals(self.cache.lookup('447712345678').extra,
+                            {'Charge': '2'})
+        self.assertTrue(isinstance(self.cache.lookup('+447812345678'), 
+                                    ERRResponse))
+        self.assertEquals(self.cache.lookup('27821234567'), None)
+    
+    def test_eviction(self):
+        for prefix in ['2782', '2783', '2784', '2785']:
+            self.cache.add(prefix, OKResponse('Supported'))
+        self.assertEquals(self.cache.answers.keys(), ['2783', '2784', '2785'])
+        self.assertEquals(self.cache.lookup('27821234567'), None)
+        self.assertEquals(sorted(self.cache.trie['2']['7']['8'].keys()),
+                            ['3', '4', '5'])
+    
+    def test_check_coverage_many(self):
+        msisdns = ['2782%07d' % i for i in range(20)] + \
+                    ['2772%07d' % i for i in range(20)] + ['27830000000']
+        answers = self.cache.check_coverage_many(msisdns)
+        self.assertEquals(len(answers), 41)
+        self.assertEquals(len(self.server.requests), 3)
+        covered, uncovered = self.cache.filter(msisdns)
+        self.assertEquals(covered, msisdns[:20] + msisdns[40:])
+        self.assertEquals(uncovered, msisdns[20:40])
+        self.assertEquals(len(self.server.requests), 3)
+    
+    def test_check_coverage_many_errors(self):
+        self.server.fail_next(1)
+        self.assertRaises(urllib2.HTTPError, self.cache.check_coverage_many,
+                            ['27821234567'])
+        self.assertEquals(self.cache.hits, 0)
+
+    def test_errors_are_not_cached(self):
+        self.server.fail_next(1)
+        self.assertRaises(Exception, self.cache.filter, ['27821234567'])
+        self.assertEquals(self.cache.filter(['27821234567']), 
+                            (['27821234567'], []))